@@ -0,0 +1,95 @@
+# === ПАКЕТНЫЙ РАСЧЕТ ПЛАНА ВИЗИТОВ (без интерфейса) ===
+"""
+Расчет плана по входному файлу и выгрузка файлов на диск: маршруты EasyMerch (Excel),
+полигоны (KML) и полный отчет (Excel). Подходит для ночных расчетов из cron.
+
+    python plan_cli.py data.xlsx --year 2025 --quarter 1 --output plans/
+    python plan_cli.py tables.zip --year 2025 --quarter 2 --coefficients 0.8 1.0 1.2 0.9
+"""
+
+import argparse
+import os
+import sys
+
+from plan_engine import (
+    get_quarter_dates, load_input_frames, plan, collect_diagnostics,
+    create_easymerch_excel, create_kml_file, create_full_excel_report, DEFAULT_SERVICE_MINUTES,
+    calculate_auditor_workload, get_weeks_in_quarter
+)
+
+DEFAULT_COEFFICIENTS = [0.8, 1.0, 1.2, 0.9]
+
+def print_diagnostic(level, message):
+    """Сообщение движка в stderr"""
+    print(f"[{level}] {message}", file=sys.stderr)
+
+def write_file(output_dir, file_name, data):
+    """Записывает файл выгрузки и печатает его путь. False - файл не удалось создать"""
+    if not data:
+        print_diagnostic('error', f"не удалось создать {file_name}")
+        return False
+    path = os.path.join(output_dir, file_name)
+    with open(path, 'wb') as handle:
+        handle.write(data)
+    print(path)
+    return True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Расчет плана визитов и выгрузка файлов EasyMerch, KML и полного отчета"
+    )
+    parser.add_argument('input', help="Excel-файл (Точки, Аудиторы, Факт_посещений) или zip/папка с CSV/Parquet")
+    parser.add_argument('--year', type=int, required=True, help="Год")
+    parser.add_argument('--quarter', type=int, choices=[1, 2, 3, 4], required=True, help="Квартал")
+    parser.add_argument('--coefficients', type=float, nargs=4, default=DEFAULT_COEFFICIENTS,
+                        metavar='K', help="Коэффициенты нагрузки 4 этапов квартала")
+    parser.add_argument('--improve-routes', action='store_true',
+                        help="Улучшать маршруты дней ходами 2-opt / Or-opt (дольше, маршруты короче)")
+    parser.add_argument('--service-minutes', type=float, nargs=len(DEFAULT_SERVICE_MINUTES),
+                        default=list(DEFAULT_SERVICE_MINUTES.values()), metavar='MIN',
+                        help="Время визита в минутах по типам точек: " + ", ".join(DEFAULT_SERVICE_MINUTES))
+    parser.add_argument('--output', default='.', help="Папка для файлов выгрузки")
+    args = parser.parse_args(argv)
+
+    year, quarter = args.year, args.quarter
+
+    with collect_diagnostics(handler=print_diagnostic):
+        # Факт посещений читается только за выбранный квартал
+        points_df, auditors_df, visits_df, _, _, rejections_df = load_input_frames(
+            args.input, visits_date_range=get_quarter_dates(year, quarter)
+        )
+        if points_df is None or auditors_df is None:
+            return 1
+
+        result = plan(points_df, auditors_df, visits_df, year, quarter, args.coefficients,
+                      improve_routes=args.improve_routes,
+                      service_minutes=dict(zip(DEFAULT_SERVICE_MINUTES, args.service_minutes)))
+
+    for name, error in result['errors'].items():
+        print_diagnostic('error', f"этап {name}: {error}")
+    if 'routes_df' not in result or 'summary_df' not in result:
+        return 1
+
+    os.makedirs(args.output, exist_ok=True)
+
+    written = [
+        write_file(args.output, f"easymerch_маршруты_{year}_Q{quarter}.xlsx",
+                   create_easymerch_excel(result['routes_df'])),
+        write_file(args.output, f"polygons_{year}_Q{quarter}.kml",
+                   create_kml_file(points_df, result['polygons'], store=result['store']).encode('utf-8')),
+        write_file(args.output, f"full_report_{year}_Q{quarter}.xlsx",
+                   create_full_excel_report(points_df, auditors_df, result['city_stats_df'], result['type_stats_df'],
+                                            result['summary_df'], result['polygons'],
+                                            workload_df=calculate_auditor_workload(
+                                                result['polygons_info'], len(get_weeks_in_quarter(year, quarter))
+                                            )))
+    ]
+
+    if not rejections_df.empty:
+        write_file(args.output, "rejected_rows.csv",
+                   rejections_df.to_csv(index=False, sep=';').encode('utf-8-sig'))
+
+    return 0 if all(written) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,5361 @@
+# === ДВИЖОК РАСЧЕТА ПЛАНА ВИЗИТОВ (без Streamlit) ===
+"""
+Загрузка и проверка входных таблиц, распределение точек по аудиторам, недельные кластеры,
+маршруты, статистика и выгрузки.
+
+Модуль не импортирует Streamlit: его используют интерфейс (app.py), пакетный запуск
+(plan_cli.py) и рабочие процессы фонового расчета. Сообщения для пользователя идут
+в канал диагностики (diag.warning, diag.error), а не в st.warning / st.error.
+
+    from plan_engine import get_quarter_dates, load_input_frames, plan
+
+    points, auditors, visits, *_ = load_input_frames('data.xlsx', get_quarter_dates(2025, 1))
+    result = plan(points, auditors, visits, 2025, 1, [0.8, 1.0, 1.2, 0.9])
+"""
+
+# === ИМПОРТЫ ===
+import pandas as pd
+import numpy as np
+import math
+import io
+from datetime import datetime, date, timedelta
+import calendar
+import json
+import hashlib
+import logging
+import os
+import shutil
+import zipfile
+import threading
+import multiprocessing
+import multiprocessing.util
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import Dict, List, Tuple, Optional, Any
+import warnings
+warnings.filterwarnings('ignore')
+
+# ГЕОМЕТРИЯ - всегда используем упрощенную версию
+SCIPY_AVAILABLE = False
+try:
+    import scipy
+    from scipy.spatial import ConvexHull
+    SCIPY_AVAILABLE = True
+except ImportError:
+    SCIPY_AVAILABLE = False
+
+# Кластеризация (KMeans) - без scikit-learn центры берутся из бисекции
+try:
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+    SKLEARN_AVAILABLE = True
+except ImportError:
+    SKLEARN_AVAILABLE = False
+
+# Для расчета рабочих дней с праздниками
+try:
+    from workalendar.europe import Russia
+    WORKALENDAR_AVAILABLE = True
+except ImportError:
+    WORKALENDAR_AVAILABLE = False
+
+# ==============================================
+# КАНАЛ ДИАГНОСТИКИ
+# ==============================================
+
+DIAGNOSTIC_LEVELS = ['info', 'success', 'warning', 'error']
+
+logger = logging.getLogger('plan_engine')
+
+class Diagnostics:
+    """
+    Сообщения движка для пользователя: список (уровень, текст).
+    handler, если задан, получает каждое сообщение сразу (интерфейс показывает его
+    через st.warning и т.п., CLI печатает в stderr).
+    """
+
+    def __init__(self, handler=None, keep=True):
+        self.messages = []
+        self.handler = handler
+        self.keep = keep
+
+    def emit(self, level, message):
+        if self.keep:
+            self.messages.append((level, message))
+        if self.handler is not None:
+            self.handler(level, message)
+
+    def info(self, message):
+        self.emit('info', message)
+
+    def success(self, message):
+        self.emit('success', message)
+
+    def warning(self, message):
+        self.emit('warning', message)
+
+    def error(self, message):
+        self.emit('error', message)
+
+def _log_diagnostic(level, message):
+    logger.log(logging.ERROR if level == 'error' else logging.WARNING if level == 'warning' else logging.INFO, message)
+
+# Канал по умолчанию (поток не выбрал свой): только журнал, сообщения не копятся
+_LOG_DIAGNOSTICS = Diagnostics(handler=_log_diagnostic, keep=False)
+_diagnostics_local = threading.local()
+
+def get_diagnostics():
+    """Канал диагностики текущего потока"""
+    return getattr(_diagnostics_local, 'channel', None) or _LOG_DIAGNOSTICS
+
+def set_diagnostics(channel):
+    """Назначает канал диагностики текущему потоку, возвращает прежний"""
+    previous = getattr(_diagnostics_local, 'channel', None)
+    _diagnostics_local.channel = channel
+    return previous
+
+@contextmanager
+def collect_diagnostics(handler=None):
+    """
+    Собирает сообщения блока в новый канал (with collect_diagnostics() as channel).
+    По умолчанию сообщения передаются и в прежний канал потока.
+    """
+    previous = get_diagnostics()
+    channel = Diagnostics(handler=handler or previous.emit)
+    set_diagnostics(channel)
+    try:
+        yield channel
+    finally:
+        set_diagnostics(previous)
+
+class _CurrentDiagnostics:
+    """diag.warning(...) и т.п. - сообщение в канал текущего потока"""
+
+    def info(self, message):
+        get_diagnostics().info(message)
+
+    def success(self, message):
+        get_diagnostics().success(message)
+
+    def warning(self, message):
+        get_diagnostics().warning(message)
+
+    def error(self, message):
+        get_diagnostics().error(message)
+
+diag = _CurrentDiagnostics()
+
+# ==============================================
+# ФУНКЦИИ ДЛЯ ОБРАБОТКИ ДАННЫХ
+# ==============================================
+
+INPUT_SHEETS = ['Точки', 'Аудиторы', 'Факт_посещений']
+
+SHEET_CHUNK_ROWS = 100000
+
+# Имя индекса прочитанных таблиц: номер строки в исходном файле (строка 1 - заголовок).
+# По нему отчет об отклоненных строках указывает строку файла
+SOURCE_ROW_INDEX = 'Строка_файла'
+
+def _number_source_rows(df, first_row):
+    """Индекс DataFrame - номера строк файла подряд, начиная с first_row"""
+    df.index = pd.RangeIndex(first_row, first_row + len(df), name=SOURCE_ROW_INDEX)
+    return df
+
+def _columns_to_frame(columns, values, row_numbers):
+    """Собирает DataFrame из списков значений по колонкам; индекс - номера строк файла"""
+    # pd.Series сам выводит тип колонки (float, int, datetime, object)
+    data = {}
+    for i, name in enumerate(columns):
+        if name is None:
+            # Колонка без заголовка: оставляем только если в ней есть данные
+            if all(value is None for value in values[i]):
+                continue
+            name = f"Unnamed: {i}"
+        if name not in data:
+            data[name] = pd.Series(values[i], dtype=None if values[i] else object)
+
+    frame = pd.DataFrame(data) if data else pd.DataFrame(index=range(len(row_numbers)))
+    frame.index = pd.Index(np.asarray(row_numbers, dtype=np.int64), name=SOURCE_ROW_INDEX)
+    return frame
+
+def _sheet_rows_to_frame(rows, max_rows=None, chunk_filter=None, chunk_rows=SHEET_CHUNK_ROWS):
+    """
+    Построчно собирает строки листа в колонки и возвращает DataFrame.
+    Первая строка - заголовок, полностью пустые строки пропускаются
+    (индекс DataFrame - номера строк листа, см. SOURCE_ROW_INDEX).
+    Если задан chunk_filter, строки собираются порциями по chunk_rows,
+    и от каждой порции сохраняется только то, что вернул фильтр.
+    """
+    header = next(rows, None)
+    if header is None:
+        return pd.DataFrame()
+
+    columns = [str(name).strip() if name is not None else None for name in header]
+    n_cols = len(columns)
+    values = [[] for _ in range(n_cols)]
+    row_numbers = []
+    kept_chunks = []
+
+    n_rows = 0
+    chunk_size = 0
+    for row_number, row in enumerate(rows, start=2):
+        if max_rows is not None and n_rows >= max_rows:
+            break
+        if row is None or all(value is None for value in row):
+            continue
+
+        row_len = len(row)
+        for i in range(n_cols):
+            values[i].append(row[i] if i < row_len else None)
+        row_numbers.append(row_number)
+        n_rows += 1
+        chunk_size += 1
+
+        if chunk_filter is not None and chunk_size >= chunk_rows:
+            kept_chunks.append(chunk_filter(_columns_to_frame(columns, values, row_numbers)))
+            values = [[] for _ in range(n_cols)]
+            row_numbers = []
+            chunk_size = 0
+
+    if chunk_filter is None:
+        return _columns_to_frame(columns, values, row_numbers)
+
+    if chunk_size > 0 or not kept_chunks:
+        kept_chunks.append(chunk_filter(_columns_to_frame(columns, values, row_numbers)))
+
+    return pd.concat(kept_chunks)
+
+def read_workbook_sheets(file, sheet_names=None, max_rows=None, chunk_filters=None):
+    """
+    Читает книгу Excel за один проход: файл открывается один раз
+    (openpyxl в режиме read-only), каждый нужный лист обходится построчно.
+    chunk_filters - {лист: функция}, отбирающая строки из каждой прочитанной порции.
+    Возвращает (словарь {лист: DataFrame}, список всех листов книги).
+    """
+    chunk_filters = chunk_filters or {}
+    from openpyxl import load_workbook
+
+    if hasattr(file, 'seek'):
+        file.seek(0)
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        all_sheets = list(workbook.sheetnames)
+        wanted = all_sheets if sheet_names is None else [s for s in sheet_names if s in all_sheets]
+
+        frames = {}
+        for sheet_name in wanted:
+            rows = workbook[sheet_name].iter_rows(values_only=True)
+            frames[sheet_name] = _sheet_rows_to_frame(
+                rows, max_rows=max_rows, chunk_filter=chunk_filters.get(sheet_name)
+            )
+
+        return frames, all_sheets
+    finally:
+        workbook.close()
+
+# Имена файлов (без расширения) для каждой вкладки при загрузке CSV/Parquet
+TABLE_FILE_NAMES = {
+    'Точки': ['points', 'точки'],
+    'Аудиторы': ['auditors', 'аудиторы'],
+    'Факт_посещений': ['visits', 'факт_посещений'],
+    # Файл изменений (дельта-загрузка)
+    'Точки_удалить': ['points_removed', 'точки_удалить'],
+    'Аудиторы_удалить': ['auditors_removed', 'аудиторы_удалить'],
+}
+
+# Объявленные типы колонок: город и тип - категории, координаты - float
+TABLE_DTYPES = {
+    'Точки': {
+        'ID_Точки': str,
+        'Название_Точки': str,
+        'Адрес': str,
+        'Широта': 'float64',
+        'Долгота': 'float64',
+        'Город': 'category',
+        'Тип': 'category'
+    },
+    'Аудиторы': {
+        'ID_Сотрудника': str,
+        'Город': 'category'
+    },
+    'Факт_посещений': {
+        'ID_Точки': str,
+        'ID_Сотрудника': str
+    },
+    'Точки_удалить': {
+        'ID_Точки': str
+    },
+    'Аудиторы_удалить': {
+        'ID_Сотрудника': str,
+        'Город': str
+    }
+}
+
+TABLE_DATE_COLUMNS = {
+    'Факт_посещений': ['Дата_визита']
+}
+
+TABLE_EXTENSIONS = ('.csv', '.parquet', '.pq')
+
+def is_table_bundle(file):
+    """Проверяет, что источник - папка или zip-архив с таблицами CSV/Parquet"""
+    if isinstance(file, (str, os.PathLike)):
+        path = os.fspath(file)
+        return os.path.isdir(path) or path.lower().endswith('.zip')
+
+    name = getattr(file, 'name', '') or ''
+    return name.lower().endswith('.zip')
+
+def _match_table_files(file_names):
+    """Сопоставляет файлы в папке/архиве с вкладками: {вкладка: имя файла}"""
+    matched = {}
+    for file_name in file_names:
+        base_name = os.path.basename(file_name)
+        stem, ext = os.path.splitext(base_name)
+        if ext.lower() not in TABLE_EXTENSIONS or base_name.startswith('.'):
+            continue
+
+        for sheet_name, aliases in TABLE_FILE_NAMES.items():
+            if stem.lower() in aliases and sheet_name not in matched:
+                matched[sheet_name] = file_name
+
+    return matched
+
+def _read_csv_table(handle, sheet_name, max_rows=None, chunk_filter=None):
+    """
+    Читает CSV с объявленными типами колонок (разделитель ',' или ';').
+    С chunk_filter файл читается порциями, и от каждой остается только отобранное.
+    Индекс - номера строк файла (строка 1 - заголовок, см. SOURCE_ROW_INDEX).
+    """
+    head = handle.read(64 * 1024)
+    handle.seek(0)
+    if isinstance(head, bytes):
+        head = head.decode('utf-8-sig', errors='ignore')
+
+    first_line = head.splitlines()[0] if head else ''
+    # Выгрузки с ';' обычно используют запятую как десятичный разделитель
+    if first_line.count(';') > first_line.count(','):
+        sep, decimal = ';', ','
+    else:
+        sep, decimal = ',', '.'
+
+    header = [col.strip().strip('"') for col in first_line.split(sep)]
+    dtypes = {col: dtype for col, dtype in TABLE_DTYPES.get(sheet_name, {}).items() if col in header}
+    date_cols = [col for col in TABLE_DATE_COLUMNS.get(sheet_name, []) if col in header]
+
+    read_kwargs = dict(
+        sep=sep,
+        decimal=decimal,
+        dtype=dtypes,
+        parse_dates=date_cols,
+        dayfirst=True,
+        nrows=max_rows,
+        encoding='utf-8-sig'
+    )
+
+    if chunk_filter is None:
+        return _number_source_rows(pd.read_csv(handle, **read_kwargs), 2)
+
+    kept_chunks = []
+    first_row = 2
+    with pd.read_csv(handle, chunksize=SHEET_CHUNK_ROWS, **read_kwargs) as reader:
+        for chunk in reader:
+            kept_chunks.append(chunk_filter(_number_source_rows(chunk, first_row)))
+            first_row += len(chunk)
+
+    if not kept_chunks:
+        return pd.DataFrame(columns=header)
+    return pd.concat(kept_chunks)
+
+def _apply_declared_dtypes(df, sheet_name):
+    """Приводит колонки к объявленным типам TABLE_DTYPES"""
+    for col, dtype in TABLE_DTYPES.get(sheet_name, {}).items():
+        if col in df.columns and df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+    return df
+
+def _read_parquet_table(handle, sheet_name, max_rows=None, chunk_filter=None):
+    """
+    Читает Parquet и приводит колонки к объявленным типам.
+    С chunk_filter файл читается пакетами строк, и от каждого остается только отобранное.
+    Индекс - номера строк как в CSV (первая строка данных - 2, см. SOURCE_ROW_INDEX).
+    """
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(handle)
+    if max_rows is not None:
+        batch = next(parquet_file.iter_batches(batch_size=max_rows), None)
+        df = batch.to_pandas() if batch is not None else parquet_file.schema_arrow.empty_table().to_pandas()
+    elif chunk_filter is not None:
+        kept_chunks = []
+        first_row = 2
+        for batch in parquet_file.iter_batches(batch_size=SHEET_CHUNK_ROWS):
+            chunk = _number_source_rows(_apply_declared_dtypes(batch.to_pandas(), sheet_name), first_row)
+            kept_chunks.append(chunk_filter(chunk))
+            first_row += len(chunk)
+        if not kept_chunks:
+            return _apply_declared_dtypes(parquet_file.schema_arrow.empty_table().to_pandas(), sheet_name)
+        return pd.concat(kept_chunks)
+    else:
+        df = parquet_file.read().to_pandas()
+
+    return _number_source_rows(_apply_declared_dtypes(df, sheet_name), 2)
+
+def _read_table(handle, file_name, sheet_name, max_rows=None, chunk_filter=None):
+    """Читает одну таблицу CSV/Parquet из открытого файла"""
+    if file_name.lower().endswith('.csv'):
+        return _read_csv_table(handle, sheet_name, max_rows=max_rows, chunk_filter=chunk_filter)
+    return _read_parquet_table(handle, sheet_name, max_rows=max_rows, chunk_filter=chunk_filter)
+
+def read_table_bundle(source, max_rows=None, chunk_filters=None):
+    """
+    Читает таблицы points/auditors/visits (CSV или Parquet) из папки или zip-архива.
+    Возвращает (словарь {вкладка: DataFrame}, список найденных вкладок) -
+    в том же виде, что и read_workbook_sheets.
+    """
+    chunk_filters = chunk_filters or {}
+    frames = {}
+
+    if isinstance(source, (str, os.PathLike)) and os.path.isdir(source):
+        root = os.fspath(source)
+        matched = _match_table_files(os.listdir(root))
+        for sheet_name, file_name in matched.items():
+            with open(os.path.join(root, file_name), 'rb') as handle:
+                frames[sheet_name] = _read_table(
+                    handle, file_name, sheet_name,
+                    max_rows=max_rows, chunk_filter=chunk_filters.get(sheet_name)
+                )
+    else:
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        with zipfile.ZipFile(source) as archive:
+            matched = _match_table_files(archive.namelist())
+            for sheet_name, file_name in matched.items():
+                with archive.open(file_name) as member:
+                    # Parquet читается с произвольным доступом - распаковываем в память
+                    handle = member if file_name.lower().endswith('.csv') else io.BytesIO(member.read())
+                    frames[sheet_name] = _read_table(
+                        handle, file_name, sheet_name,
+                        max_rows=max_rows, chunk_filter=chunk_filters.get(sheet_name)
+                    )
+
+    found = [sheet for sheet in TABLE_FILE_NAMES if sheet in frames]
+    return frames, found
+
+def make_visits_date_filter(date_range):
+    """
+    Возвращает фильтр порций факта посещений: оставляет только строки,
+    дата визита которых попадает в date_range = (первый день, последний день).
+    Строки с пустой или неразборчивой датой тоже остаются (NaT): их отклоняет
+    проверка load_and_process_visits, и они попадают в отчет об отклоненных строках.
+    Дата в оставленных строках уже разобрана в datetime.
+    """
+    start_date, end_date = date_range
+    start_ts = pd.Timestamp(start_date)
+    end_ts = pd.Timestamp(end_date) + pd.Timedelta(days=1)
+
+    def visits_date_filter(chunk):
+        date_col = VISITS_COLUMNS.find(chunk.columns, 'Дата_визита')
+        if date_col is None or chunk.empty:
+            return chunk
+
+        dates = parse_visit_dates(chunk[date_col])
+        in_range = (((dates >= start_ts) & (dates < end_ts)) | dates.isna()).to_numpy()
+
+        chunk = chunk.loc[in_range].copy()
+        chunk[date_col] = dates[in_range].to_numpy()
+        return chunk
+
+    return visits_date_filter
+
+def read_input_sheets(file, max_rows=None, visits_date_range=None):
+    """
+    Читает входные таблицы из Excel-файла либо из папки/архива CSV/Parquet.
+    visits_date_range - (первый день, последний день): факт посещений читается порциями,
+    и в памяти остаются только визиты внутри этого периода.
+    """
+    chunk_filters = {}
+    if visits_date_range is not None:
+        chunk_filters['Факт_посещений'] = make_visits_date_filter(visits_date_range)
+
+    if is_table_bundle(file):
+        return read_table_bundle(file, max_rows=max_rows, chunk_filters=chunk_filters)
+    return read_workbook_sheets(file, INPUT_SHEETS, max_rows=max_rows, chunk_filters=chunk_filters)
+
+def load_and_process_data(file, visits_date_range=None):
+    """
+    Загружает и обрабатывает файл с тремя вкладками.
+    visits_date_range - период (обычно квартал плана), вне которого визиты не загружаются.
+    """
+    try:
+        # Читаем все три вкладки за одно открытие файла
+        frames, sheets = read_input_sheets(file, visits_date_range=visits_date_range)
+
+        missing_sheets = [sheet for sheet in ['Точки', 'Аудиторы'] if sheet not in sheets]
+        if missing_sheets:
+            raise ValueError(f"в файле отсутствуют вкладки: {', '.join(missing_sheets)}")
+
+        points_df = frames['Точки']
+        auditors_df = frames['Аудиторы']
+
+        # Для факта посещений может быть пустая вкладка
+        if 'Факт_посещений' in sheets:
+            visits_df = frames['Факт_посещений']
+        else:
+            visits_df = pd.DataFrame(columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника'])
+
+        return points_df, auditors_df, visits_df
+        
+    except Exception as e:
+        diag.error(f"❌ Ошибка при загрузке файла: {str(e)}")
+        return None, None, None
+
+# ==============================================
+# НОРМАЛИЗАЦИЯ И ВАЛИДАЦИЯ ВХОДНЫХ ТАБЛИЦ
+# ==============================================
+
+# Альтернативные названия колонок по вкладкам.
+# Сравнение без учета регистра, пробелов по краям и разницы между '_' и пробелом
+POINTS_COLUMN_MAPPING = {
+    'ID_Точки': ['ID точки', 'ID_точки', 'Point_ID'],
+    'Широта': ['Latitude', 'Lat', 'широта'],
+    'Долгота': ['Longitude', 'Lon', 'долгота'],
+    'Город': ['City', 'city', 'Город работы'],
+    'Тип': ['Type', 'Category', 'Тип точки'],
+    'Название_Точки': [],
+    'Адрес': [],
+    'Кол-во_посещений': []
+}
+
+AUDITORS_COLUMN_MAPPING = {
+    'ID_Сотрудника': ['ID Сотрудника', 'ID_сотрудника', 'Employee_ID', 'employee_id', 'Сотрудник'],
+    'Город': ['City', 'city', 'Город работы'],
+    'Часов_в_неделю': ['Часы в неделю', 'Hours per week', 'Capacity', 'Емкость']
+}
+
+# Необязательная колонка Аудиторов: емкость сотрудника (рабочих часов в неделю).
+# Полигоны города делятся пропорционально емкости; без колонки - поровну
+AUDITOR_CAPACITY_COLUMN = 'Часов_в_неделю'
+
+VISITS_COLUMN_MAPPING = {
+    'ID_Точки': ['ID точки', 'ID_точки', 'Point_ID'],
+    'Дата_визита': ['Дата визита', 'Дата', 'Date', 'Visit Date', 'Дата посещения'],
+    'ID_Сотрудника': ['ID Сотрудника', 'ID_сотрудника', 'Employee_ID', 'Сотрудник']
+}
+
+# Типы точек (ключи - в нижнем регистре), все неизвестные типы считаются "Мини"
+POINT_TYPE_MAPPING = {
+    'convenience': 'Мини',
+    'convenience store': 'Мини',
+    'hypermarket': 'Гипер',
+    'supermarket': 'Супер',
+    'мини': 'Мини',
+    'гипер': 'Гипер',
+    'супер': 'Супер'
+}
+POINT_TYPES = ['Мини', 'Супер', 'Гипер']
+DEFAULT_POINT_TYPE = 'Мини'
+
+# Время одного визита по типу точки (минуты) - нагрузка аудиторов и деление территорий
+DEFAULT_SERVICE_MINUTES = {'Мини': 20.0, 'Супер': 45.0, 'Гипер': 90.0}
+
+# Допустимые координаты точек (только Россия)
+LAT_RANGE = (41, 82)
+LON_RANGE = (19, 180)
+
+REJECTION_COLUMNS = ['Вкладка', 'Строка', 'ID', 'Причина']
+
+def _normalize_name(name):
+    """Ключ для сравнения названий: нижний регистр, '_' = пробел, без лишних пробелов"""
+    return ' '.join(str(name).replace('_', ' ').split()).casefold()
+
+class ColumnAliasResolver:
+    """
+    Предкомпилированный поиск колонок по альтернативным названиям.
+    Словарь "ключ названия -> стандартная колонка" строится один раз при импорте.
+    """
+
+    def __init__(self, mapping):
+        self.lookup = {}
+        for target, aliases in mapping.items():
+            for name in [target] + list(aliases):
+                self.lookup.setdefault(_normalize_name(name), target)
+
+    def rename_map(self, columns):
+        """{исходное название: стандартное} для колонок, которые нужно переименовать"""
+        taken = set(columns)
+        rename = {}
+        for column in columns:
+            target = self.lookup.get(_normalize_name(column))
+            if target is None or target in taken:
+                continue
+            rename[column] = target
+            taken.add(target)
+        return rename
+
+    def find(self, columns, target):
+        """Название колонки, соответствующей стандартной target (None, если такой нет)"""
+        if target in columns:
+            return target
+        for column in columns:
+            if self.lookup.get(_normalize_name(column)) == target:
+                return column
+        return None
+
+    def apply(self, df):
+        """Копия DataFrame со стандартными названиями колонок"""
+        return df.rename(columns=self.rename_map(df.columns))
+
+POINTS_COLUMNS = ColumnAliasResolver(POINTS_COLUMN_MAPPING)
+AUDITORS_COLUMNS = ColumnAliasResolver(AUDITORS_COLUMN_MAPPING)
+VISITS_COLUMNS = ColumnAliasResolver(VISITS_COLUMN_MAPPING)
+
+def coerce_categorical(values, mapping, categories, default):
+    """
+    Приводит колонку к категориям по словарю (без учета регистра).
+    Словарь применяется один раз к каждому уникальному значению, а не к каждой строке.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+        uniques = values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+
+    # Последний элемент lookup - значение для пропусков (код -1)
+    lookup = np.array(
+        [categories.index(mapping.get(_normalize_name(value), default)) for value in uniques]
+        + [categories.index(default)],
+        dtype=np.int8
+    )
+    return pd.Series(
+        pd.Categorical.from_codes(lookup[codes], categories=categories),
+        index=values.index, name=values.name
+    )
+
+def to_coordinate(values):
+    """Координаты в float64 (десятичная запятая допускается), нечисловые значения - NaN"""
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype(np.float64)
+    return pd.to_numeric(values.astype(str).str.replace(',', '.', regex=False).str.strip(), errors='coerce')
+
+def blank_mask(values):
+    """Пустые значения: пропуск или строка из пробелов"""
+    return (values.isna() | (values.astype(str).str.strip() == '')).to_numpy()
+
+def empty_rejection_report():
+    """Пустой отчет об отклоненных строках"""
+    return pd.DataFrame({column: pd.Series(dtype=object) for column in REJECTION_COLUMNS})
+
+def validate_rows(df, sheet_name, checks, id_column=None, unique_column=None):
+    """
+    Проверка строк одним проходом масок.
+    checks - список (причина, маска плохих строк) в порядке приоритета.
+    unique_column - колонка или список колонок, повторы в которых отклоняются (первое
+    вхождение остается); повторы ищутся по хэш-индексу только среди строк, прошедших
+    остальные проверки.
+    Номер строки в файле берется из индекса SOURCE_ROW_INDEX (его задают функции чтения),
+    без него - позиция строки + 2 (строка 1 - заголовок).
+    Возвращает (чистый DataFrame, отчет: вкладка, номер строки в файле, ID, причина).
+    """
+    reasons = [reason for reason, _ in checks]
+    masks = [np.asarray(mask, dtype=bool) for _, mask in checks]
+    rejected = np.logical_or.reduce(masks) if masks else np.zeros(len(df), dtype=bool)
+
+    unique_columns = [unique_column] if isinstance(unique_column, str) else list(unique_column or [])
+    if unique_columns and all(column in df.columns for column in unique_columns):
+        duplicated = np.zeros(len(df), dtype=bool)
+        duplicated[~rejected] = df.loc[~rejected, unique_columns].duplicated(keep='first').to_numpy()
+        reasons.append(f"дубликат {' + '.join(unique_columns)}")
+        masks.append(duplicated)
+        rejected = rejected | duplicated
+
+    if not rejected.any():
+        return df.reset_index(drop=True), empty_rejection_report()
+
+    positions = np.flatnonzero(rejected)
+    if id_column is not None and id_column in df.columns:
+        ids = df[id_column].astype(str).to_numpy()[positions]
+    else:
+        ids = ''
+
+    if df.index.name == SOURCE_ROW_INDEX:
+        rows = df.index.to_numpy(dtype=np.int64)[positions]
+    else:
+        rows = positions + 2  # строка 1 - заголовок
+
+    report = pd.DataFrame({
+        'Вкладка': sheet_name,
+        'Строка': rows,
+        'ID': ids,
+        'Причина': np.select(masks, reasons, default='')[positions]
+    })
+
+    return df.loc[~rejected].reset_index(drop=True), report
+
+def warn_rejections(report):
+    """Сводка отклоненных строк: одно предупреждение на каждую причину"""
+    if report is None or report.empty:
+        return
+    for (sheet_name, reason), count in report.groupby(['Вкладка', 'Причина'], sort=False).size().items():
+        diag.warning(f"⚠️ {sheet_name}: пропущено строк - {count} ({reason})")
+
+def load_and_process_points(df):
+    """
+    Обрабатывает данные из вкладки Точки.
+    Возвращает (points_df, отчет об отклоненных строках).
+    """
+    try:
+        # Стандартные названия колонок (rename возвращает копию)
+        points_df = POINTS_COLUMNS.apply(df)
+
+        # Проверяем обязательные колонки
+        required_cols = ['ID_Точки', 'Широта', 'Долгота', 'Город', 'Тип']
+        missing_cols = [col for col in required_cols if col not in points_df.columns]
+        if missing_cols:
+            diag.error(f"❌ В файле Точки отсутствуют обязательные колонки: {', '.join(missing_cols)}")
+            return None, empty_rejection_report()
+
+        # Конвертируем типы точек в категории
+        points_df['Тип'] = coerce_categorical(points_df['Тип'], POINT_TYPE_MAPPING, POINT_TYPES, DEFAULT_POINT_TYPE)
+
+        # Обрабатываем количество посещений
+        if 'Кол-во_посещений' in points_df.columns:
+            points_df['Кол-во_посещений'] = pd.to_numeric(points_df['Кол-во_посещений'], errors='coerce').fillna(1).astype(int)
+        else:
+            points_df['Кол-во_посещений'] = 1
+
+        # Добавляем недостающие колонки
+        if 'Название_Точки' not in points_df.columns:
+            points_df['Название_Точки'] = points_df['ID_Точки']
+        if 'Адрес' not in points_df.columns:
+            points_df['Адрес'] = ''
+
+        # Валидация: пустые ID и города, координаты вне России, повторы ID
+        points_df['Широта'] = to_coordinate(points_df['Широта'])
+        points_df['Долгота'] = to_coordinate(points_df['Долгота'])
+        valid_coords = (
+            points_df['Широта'].between(*LAT_RANGE) & points_df['Долгота'].between(*LON_RANGE)
+        ).to_numpy()
+
+        points_df, report = validate_rows(points_df, 'Точки', [
+            ('не указан ID_Точки', blank_mask(points_df['ID_Точки'])),
+            ('не указан город', blank_mask(points_df['Город'])),
+            (f"некорректные координаты (только Россия: широта {LAT_RANGE[0]}-{LAT_RANGE[1]}, "
+             f"долгота {LON_RANGE[0]}-{LON_RANGE[1]})", ~valid_coords)
+        ], id_column='ID_Точки', unique_column='ID_Точки')
+
+        warn_rejections(report)
+
+        if points_df.empty:
+            diag.error("❌ Нет точек с корректными координатами")
+            return None, report
+
+        return points_df, report
+
+    except Exception as e:
+        diag.error(f"❌ Ошибка при обработке данных Точки: {str(e)}")
+        return None, empty_rejection_report()
+
+def load_and_process_auditors(df):
+    """
+    Обрабатывает данные из вкладки Аудиторы.
+    Возвращает (auditors_df, отчет об отклоненных строках).
+    """
+    try:
+        # Стандартизируем названия колонок
+        auditors_df = AUDITORS_COLUMNS.apply(df)
+
+        # Проверяем обязательные колонки
+        required_cols = ['ID_Сотрудника', 'Город']
+        missing_cols = [col for col in required_cols if col not in auditors_df.columns]
+
+        if missing_cols:
+            diag.error(f"❌ В файле Аудиторы отсутствуют обязательные колонки: {', '.join(missing_cols)}")
+            return None, empty_rejection_report()
+
+        auditors_df, report = validate_rows(auditors_df, 'Аудиторы', [
+            ('не указан ID_Сотрудника', blank_mask(auditors_df['ID_Сотрудника'])),
+            ('не указан город', blank_mask(auditors_df['Город']))
+        ], id_column='ID_Сотрудника', unique_column=['ID_Сотрудника', 'Город'])
+
+        warn_rejections(report)
+
+        # Емкость: число часов > 0, иначе - не указана (берется средняя по городу)
+        if AUDITOR_CAPACITY_COLUMN in auditors_df.columns:
+            raw_capacity = auditors_df[AUDITOR_CAPACITY_COLUMN]
+            capacity = pd.to_numeric(raw_capacity, errors='coerce')
+            capacity = capacity.where(capacity > 0)
+            invalid = int((capacity.isna() & ~blank_mask(raw_capacity)).sum())
+            if invalid:
+                diag.warning(f"⚠️ Аудиторы: некорректная емкость у {invalid} сотрудников - "
+                             f"используется средняя по городу")
+            auditors_df[AUDITOR_CAPACITY_COLUMN] = capacity.astype('float64')
+
+        return auditors_df, report
+
+    except Exception as e:
+        diag.error(f"❌ Ошибка при обработке данных Аудиторы: {str(e)}")
+        return None, empty_rejection_report()
+
+# Форматы дат в файле Факт_посещений (в порядке приоритета)
+DATE_FORMATS = ['%d.%m.%Y', '%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d', '%Y/%m/%d']
+
+DATE_SAMPLE_SIZE = 1000
+DATE_FALLBACK_LIMIT = 10000
+
+def detect_date_format(values, sample_size=DATE_SAMPLE_SIZE):
+    """Определяет формат даты по небольшой выборке значений (None, если ни один не подошел)"""
+    if len(values) == 0:
+        return None
+
+    # Равномерная выборка по всей колонке, а не только начало файла
+    step = max(1, len(values) // sample_size)
+    sample = pd.Series(values[::step][:sample_size])
+
+    best_format, best_matches = None, 0
+    for date_format in DATE_FORMATS:
+        matches = pd.to_datetime(sample, format=date_format, errors='coerce').notna().sum()
+        if matches > best_matches:
+            best_format, best_matches = date_format, matches
+
+    return best_format
+
+def parse_visit_dates(dates, fallback_limit=DATE_FALLBACK_LIMIT):
+    """
+    Разбирает колонку дат визитов за один проход.
+    Формат определяется по выборке, затем вся колонка разбирается с этим форматом.
+    Строки, не подошедшие под формат, разбираются поштучно (не более fallback_limit),
+    остальные получают NaT.
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+
+    # Даты из Excel приходят объектами datetime - их разбирать не нужно.
+    # infer_dtype работает на уровне C, поштучная проверка нужна только для смешанных колонок
+    inferred = pd.api.types.infer_dtype(dates, skipna=True)
+    if inferred in ('datetime', 'datetime64', 'date'):
+        return pd.to_datetime(dates, errors='coerce')
+
+    values = dates.to_numpy(dtype=object)
+    result = np.full(len(values), np.datetime64('NaT'), dtype='datetime64[ns]')
+
+    if inferred == 'string':
+        is_text = pd.notna(values)
+    else:
+        is_datetime = np.fromiter((isinstance(value, (datetime, date)) for value in values), dtype=bool, count=len(values))
+        if is_datetime.any():
+            result[is_datetime] = pd.to_datetime(pd.Series(values[is_datetime]), errors='coerce').to_numpy()
+        is_text = pd.notna(values) & ~is_datetime
+
+    # Пробелы по краям не убираем заранее: такие строки уйдут в поштучный разбор
+    all_text = is_text.all()
+    text = values if all_text else values[is_text]
+    if inferred != 'string':
+        text = text.astype(str)
+
+    date_format = detect_date_format(text)
+
+    if date_format is None:
+        # Ни один формат не подошел - автоопределение (один проход)
+        parsed = pd.to_datetime(pd.Series(text), errors='coerce').to_numpy()
+    else:
+        # Явный формат: ISO разбирается C-парсером pandas, дд.мм.гггг - скомпилированным strptime,
+        # без попыток угадать формат для каждой строки
+        parsed = pd.to_datetime(pd.Series(text), format=date_format, errors='coerce').to_numpy()
+
+    # Поштучный разбор для строк, не подошедших под формат (ограниченное количество)
+    unmatched = np.flatnonzero(np.isnat(parsed))
+    for i in unmatched[:fallback_limit]:
+        value = pd.to_datetime(text[i], dayfirst=True, errors='coerce')
+        if not pd.isna(value):
+            parsed[i] = value.to_datetime64()
+
+    if all_text:
+        result = parsed
+    else:
+        result[is_text] = parsed
+
+    return pd.Series(result, index=dates.index, name=dates.name)
+
+def load_and_process_visits(df):
+    """
+    Обрабатывает данные из вкладки Факт_посещений.
+    Возвращает (visits_df, отчет об отклоненных строках).
+    """
+    empty_visits = pd.DataFrame(columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника'])
+    try:
+        if df.empty:
+            return empty_visits, empty_rejection_report()
+
+        # Стандартизируем названия колонок
+        visits_df = VISITS_COLUMNS.apply(df)
+
+        # Проверяем обязательные колонки
+        required_cols = ['ID_Точки', 'Дата_визита', 'ID_Сотрудника']
+        missing_cols = [col for col in required_cols if col not in visits_df.columns]
+
+        if missing_cols:
+            diag.warning(f"⚠️ В файле Факт_посещений отсутствуют колонки: {', '.join(missing_cols)}")
+            return empty_visits, empty_rejection_report()
+
+        # Преобразуем даты: формат определяется по выборке, колонка разбирается один раз
+        visits_df['Дата_визита'] = parse_visit_dates(visits_df['Дата_визита'])
+
+        # Удаляем строки с невалидными датами
+        visits_df, report = validate_rows(visits_df, 'Факт_посещений', [
+            ('некорректная дата визита', visits_df['Дата_визита'].isna().to_numpy())
+        ], id_column='ID_Точки')
+
+        warn_rejections(report)
+
+        return visits_df, report
+
+    except Exception as e:
+        diag.error(f"❌ Ошибка при обработке данных Факт_посещений: {str(e)}")
+        return empty_visits, empty_rejection_report()
+
+# ==============================================
+# КЭШ ВХОДНЫХ ДАННЫХ (ПО ХЭШУ СОДЕРЖИМОГО ФАЙЛА)
+# ==============================================
+
+INPUT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'inputs')
+INPUT_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1 ГБ на все закэшированные файлы
+INPUT_CACHE_TABLES = ['points', 'auditors', 'visits', 'rejections']
+# Версия нормализации входных таблиц - входит в ключ кэша. Меняется при каждом
+# изменении того, что возвращают загрузчики (колонки, типы, проверки строк),
+# чтобы таблицы, закэшированные прежней версией, не использовались
+INPUT_NORMALIZATION_VERSION = 1
+
+def get_file_hash(file):
+    """Возвращает SHA-256 содержимого загруженного файла (или файлов папки с таблицами)"""
+    hasher = hashlib.sha256()
+
+    if isinstance(file, (str, os.PathLike)):
+        path = os.fspath(file)
+        if os.path.isdir(path):
+            file_paths = [os.path.join(path, name) for name in sorted(_match_table_files(os.listdir(path)).values())]
+        else:
+            file_paths = [path]
+
+        for file_path in file_paths:
+            hasher.update(os.path.basename(file_path).encode('utf-8'))
+            with open(file_path, 'rb') as handle:
+                for chunk in iter(lambda: handle.read(1024 * 1024), b''):
+                    hasher.update(chunk)
+        return hasher.hexdigest()
+
+    if hasattr(file, 'getvalue'):
+        hasher.update(file.getvalue())
+    else:
+        if hasattr(file, 'seek'):
+            file.seek(0)
+        hasher.update(file.read())
+        if hasattr(file, 'seek'):
+            file.seek(0)
+
+    return hasher.hexdigest()
+
+def _dir_size(path):
+    """Суммарный размер файлов в папке"""
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+def evict_input_cache(max_bytes=INPUT_CACHE_MAX_BYTES, cache_dir=INPUT_CACHE_DIR):
+    """
+    Удаляет самые давно использованные записи кэша (LRU по времени
+    последнего обращения), пока общий размер не станет меньше max_bytes
+    """
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir():
+            entries.append((entry.stat().st_mtime, entry.path, _dir_size(entry.path)))
+
+    total = sum(size for _, _, size in entries)
+    for _, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+def load_input_cache(cache_key):
+    """
+    Читает нормализованные таблицы из кэша.
+    Возвращает (points_df, auditors_df, visits_df, rejections_df) или None, если записи нет.
+    """
+    entry_dir = os.path.join(INPUT_CACHE_DIR, cache_key)
+    paths = [os.path.join(entry_dir, f"{name}.feather") for name in INPUT_CACHE_TABLES]
+
+    if not all(os.path.exists(path) for path in paths):
+        return None
+
+    try:
+        frames = tuple(pd.read_feather(path) for path in paths)
+    except Exception:
+        # Поврежденная запись - удаляем и считаем промахом
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        return None
+
+    # Отмечаем обращение для LRU
+    os.utime(entry_dir, None)
+    return frames
+
+def save_input_cache(cache_key, points_df, auditors_df, visits_df, rejections_df):
+    """Сохраняет нормализованные таблицы в кэш (Arrow/Feather)"""
+    entry_dir = os.path.join(INPUT_CACHE_DIR, cache_key)
+    tmp_dir = f"{entry_dir}.tmp{os.getpid()}"
+
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, df in zip(INPUT_CACHE_TABLES, [points_df, auditors_df, visits_df, rejections_df]):
+            df.reset_index(drop=True).to_feather(os.path.join(tmp_dir, f"{name}.feather"))
+
+        # Атомарно публикуем запись, чтобы параллельный сеанс не прочитал ее наполовину
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            os.replace(tmp_dir, entry_dir)
+    except Exception:
+        # Кэш - только ускорение: если таблицу нельзя сохранить, просто не кэшируем
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    evict_input_cache()
+
+def load_input_frames(file, visits_date_range=None):
+    """
+    Загружает и нормализует точки, аудиторов и факт посещений.
+    Повторная загрузка того же файла берет готовые таблицы из кэша без разбора Excel.
+    visits_date_range - период, за который загружаются визиты (см. load_and_process_data).
+    Возвращает (points_df, auditors_df, visits_df, file_hash, from_cache, rejections_df),
+    rejections_df - отклоненные при проверке строки всех вкладок.
+    """
+    file_hash = get_file_hash(file)
+
+    # Факт посещений зависит от периода, поэтому период входит в ключ кэша
+    cache_key = f"v{INPUT_NORMALIZATION_VERSION}-{file_hash}"
+    if visits_date_range is not None:
+        cache_key = f"{cache_key}-{visits_date_range[0]:%Y%m%d}-{visits_date_range[1]:%Y%m%d}"
+
+    cached = load_input_cache(cache_key)
+    if cached is not None:
+        points_df, auditors_df, visits_df, rejections_df = cached
+        return points_df, auditors_df, visits_df, file_hash, True, rejections_df
+
+    points_raw, auditors_raw, visits_raw = load_and_process_data(file, visits_date_range=visits_date_range)
+    if points_raw is None or auditors_raw is None:
+        return None, None, None, file_hash, False, empty_rejection_report()
+
+    points_df, points_rejected = load_and_process_points(points_raw)
+    auditors_df, auditors_rejected = load_and_process_auditors(auditors_raw)
+    visits_df, visits_rejected = load_and_process_visits(visits_raw)
+
+    reports = [report for report in [points_rejected, auditors_rejected, visits_rejected] if not report.empty]
+    rejections_df = pd.concat(reports, ignore_index=True) if reports else empty_rejection_report()
+
+    if points_df is not None and auditors_df is not None:
+        save_input_cache(cache_key, points_df, auditors_df, visits_df, rejections_df)
+
+    return points_df, auditors_df, visits_df, file_hash, False, rejections_df
+
+# ==============================================
+# СНИМОК РАССЧИТАННОГО ПЛАНА НА ДИСКЕ
+# ==============================================
+
+PLAN_SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'plans')
+PLAN_SNAPSHOT_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2 ГБ на все снимки
+# Версия снимка: меняется при изменении состава таблиц или результата расчета,
+# чтобы снимки, посчитанные прежним алгоритмом, не открывались
+# 2 - маршруты дня на общем расчете расстояний
+# 3 - большие города делятся на компактные зоны
+# 4 - территории выравниваются по нагрузке, колонки часов работы
+PLAN_SNAPSHOT_VERSION = 4
+
+# Таблицы снимка (ключи session state). Хранятся в Arrow IPC без сжатия,
+# чтобы их можно было открыть через memory map без чтения файла целиком
+PLAN_SNAPSHOT_TABLES = [
+    'points_df', 'auditors_df', 'visits_df', 'input_rejections',
+    'points_assignment_df', 'weekly_clusters_df', 'detailed_plan_df', 'routes_df',
+    'city_stats_df', 'type_stats_df', 'summary_df', 'details_df'
+]
+# Словари полигонов хранятся в JSON
+PLAN_SNAPSHOT_OBJECTS = ['polygons_info', 'polygons']
+
+def get_plan_snapshot_key(input_hash, year, quarter, coefficients, improve_routes=False, service_minutes=None):
+    """Ключ снимка: хэш входных данных + настройки расчета + версия формата"""
+    settings = [PLAN_SNAPSHOT_VERSION, year, quarter, [float(c) for c in coefficients]]
+    if improve_routes:
+        settings.append('improve_routes')
+    # Время визита - в ключе, только если отличается от значений по умолчанию
+    service_minutes = get_service_minutes(service_minutes)
+    if service_minutes != DEFAULT_SERVICE_MINUTES:
+        settings.append(service_minutes)
+    settings = json.dumps(settings)
+    return hashlib.sha256(f"{input_hash}|{settings}".encode('utf-8')).hexdigest()[:32]
+
+def _encode_for_arrow(df):
+    """
+    Готовит DataFrame к записи в Arrow.
+    Колонки вида "1 или пусто" (отметки дней в маршрутах) хранятся как Int64 с пропусками,
+    прочие смешанные колонки - строками. Возвращает (DataFrame, {колонка: способ}).
+    """
+    encoded = {}
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        if values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) == 'mixed-integer':
+            is_blank = values.eq('').to_numpy()
+            if pd.api.types.is_integer_dtype(pd.Series(values[~is_blank].tolist())):
+                columns[column] = values.mask(is_blank).astype('Int64')
+                encoded[column] = 'int_or_blank'
+                continue
+            columns[column] = values.astype(str)
+            encoded[column] = 'str'
+    if columns:
+        df = df.assign(**columns)
+    return df.reset_index(drop=True), encoded
+
+def _decode_from_arrow(df, encoded):
+    """Обратное преобразование колонок, закодированных в _encode_for_arrow"""
+    for column, method in encoded.items():
+        if method == 'int_or_blank' and column in df.columns:
+            values = df[column].astype(object)
+            df[column] = values.where(values.notna(), '')
+    return df
+
+def _json_default(value):
+    """Сериализация numpy-значений в JSON"""
+    if hasattr(value, 'item'):
+        return value.item()
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+def save_plan_snapshot(snapshot_key, tables, objects, meta=None):
+    """
+    Сохраняет рассчитанный план: tables - {имя: DataFrame}, objects - {имя: dict}.
+    Запись публикуется атомарно (временная папка + переименование).
+    """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    entry_dir = os.path.join(PLAN_SNAPSHOT_DIR, snapshot_key)
+    tmp_dir = f"{entry_dir}.tmp{os.getpid()}"
+    encoded_columns = {}
+
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        for name, df in tables.items():
+            if df is None:
+                continue
+            df, encoded_columns[name] = _encode_for_arrow(df)
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            feather.write_feather(table, os.path.join(tmp_dir, f"{name}.arrow"), compression='uncompressed')
+
+        for name, value in objects.items():
+            if value is None:
+                continue
+            with open(os.path.join(tmp_dir, f"{name}.json"), 'w', encoding='utf-8') as handle:
+                json.dump(value, handle, ensure_ascii=False, default=_json_default)
+
+        snapshot_meta = dict(meta or {})
+        snapshot_meta.update({
+            'version': PLAN_SNAPSHOT_VERSION,
+            'created': datetime.now().strftime('%d.%m.%Y %H:%M'),
+            'encoded_columns': encoded_columns
+        })
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as handle:
+            json.dump(snapshot_meta, handle, ensure_ascii=False, default=_json_default)
+
+        # Снимок с тем же ключом уже есть - это тот же план, оставляем его
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            os.replace(tmp_dir, entry_dir)
+    except Exception as e:
+        # Снимок - только ускорение повторного открытия, расчет от него не зависит
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        diag.warning(f"⚠️ Не удалось сохранить план на диск: {str(e)}")
+        return False
+
+    evict_input_cache(PLAN_SNAPSHOT_MAX_BYTES, cache_dir=PLAN_SNAPSHOT_DIR)
+    return True
+
+class PlanSnapshot:
+    """
+    Сохраненный план, открытый с диска.
+    Таблицы открываются через memory map и переводятся в DataFrame только при обращении
+    (числовые колонки без пропусков ссылаются на страницы файла без копирования).
+    """
+
+    def __init__(self, snapshot_key):
+        self.key = snapshot_key
+        self.path = os.path.join(PLAN_SNAPSHOT_DIR, snapshot_key)
+        with open(os.path.join(self.path, 'meta.json'), encoding='utf-8') as handle:
+            self.meta = json.load(handle)
+        if self.meta.get('version') != PLAN_SNAPSHOT_VERSION:
+            raise ValueError("снимок сохранен в старом формате")
+        self._frames = {}
+
+    def has(self, name):
+        return os.path.exists(os.path.join(self.path, f"{name}.arrow")) or \
+            os.path.exists(os.path.join(self.path, f"{name}.json"))
+
+    def frame(self, name):
+        """Таблица снимка (None, если ее нет)"""
+        if name not in self._frames:
+            import pyarrow.feather as feather
+
+            path = os.path.join(self.path, f"{name}.arrow")
+            if not os.path.exists(path):
+                return None
+            table = feather.read_table(path, memory_map=True)
+            df = table.to_pandas(split_blocks=True, date_as_object=True)
+            self._frames[name] = _decode_from_arrow(df, self.meta.get('encoded_columns', {}).get(name, {}))
+        return self._frames[name]
+
+    def object(self, name):
+        """Словарь снимка (полигоны), None - если его нет"""
+        path = os.path.join(self.path, f"{name}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as handle:
+            return json.load(handle)
+
+def open_plan_snapshot(snapshot_key):
+    """Открывает снимок по ключу; None, если снимка нет или он поврежден"""
+    if not snapshot_key or not os.path.isfile(os.path.join(PLAN_SNAPSHOT_DIR, snapshot_key, 'meta.json')):
+        return None
+    try:
+        snapshot = PlanSnapshot(snapshot_key)
+    except Exception:
+        return None
+    # Отмечаем обращение для LRU
+    os.utime(snapshot.path, None)
+    return snapshot
+
+def list_plan_snapshots(limit=20):
+    """Сохраненные планы (новые первыми): список (ключ, meta)"""
+    if not os.path.isdir(PLAN_SNAPSHOT_DIR):
+        return []
+
+    snapshots = []
+    for entry in os.scandir(PLAN_SNAPSHOT_DIR):
+        meta_path = os.path.join(entry.path, 'meta.json')
+        if not entry.is_dir() or not os.path.isfile(meta_path):
+            continue
+        try:
+            with open(meta_path, encoding='utf-8') as handle:
+                meta = json.load(handle)
+        except Exception:
+            continue
+        if meta.get('version') == PLAN_SNAPSHOT_VERSION:
+            snapshots.append((entry.stat().st_mtime, entry.name, meta))
+
+    snapshots.sort(key=lambda item: item[0], reverse=True)
+    return [(key, meta) for _, key, meta in snapshots[:limit]]
+
+# ==============================================
+# ФУНКЦИИ ДЛЯ РАБОТЫ С ДАТАМИ И НЕДЕЛЯМИ
+# ==============================================
+
+def get_quarter_dates(year, quarter):
+    """Возвращает даты начала и конца квартала"""
+    quarter_starts = [date(year, 1, 1), date(year, 4, 1), date(year, 7, 1), date(year, 10, 1)]
+    quarter_start = quarter_starts[quarter - 1]
+    
+    if quarter == 4:
+        quarter_end = date(year + 1, 1, 1) - timedelta(days=1)
+    else:
+        quarter_end = quarter_starts[quarter] - timedelta(days=1)
+    
+    return quarter_start, quarter_end
+
+def get_iso_week(date_obj):
+    """Возвращает ISO номер недели для даты"""
+    return date_obj.isocalendar()[1]
+
+def get_weeks_in_quarter(year, quarter):
+    """Возвращает список недель в квартале с ISO номерами"""
+    quarter_start, quarter_end = get_quarter_dates(year, quarter)
+    
+    weeks = []
+    current_date = quarter_start
+    
+    while current_date <= quarter_end:
+        week_start = current_date
+        week_end = min(current_date + timedelta(days=6), quarter_end)
+        
+        iso_week = get_iso_week(week_start)
+        
+        weeks.append({
+            'iso_week_number': iso_week,
+            'start_date': week_start,
+            'end_date': week_end,
+            'week_display': f"Неделя {iso_week} ({week_start.strftime('%d.%m')}-{week_end.strftime('%d.%m')})"
+        })
+        
+        current_date = week_end + timedelta(days=1)
+    
+    return weeks
+    
+def calculate_weekly_targets(total_points, year, quarter, coefficients):
+    """
+    Рассчитывает, сколько точек должно быть в каждую неделю квартала
+    с учетом коэффициентов нагрузки. Использует ТУ ЖЕ логику, что и
+    оригинальная функция distribute_visits_by_weeks():
+    - Коэффициенты применяются циклически по ISO номеру недели
+    - week_index = (iso_week - 1) % 4
+    """
+    weeks_info = get_weeks_in_quarter(year, quarter)
+    if not weeks_info:
+        return []
+    
+    n_weeks = len(weeks_info)
+    
+    # 1. Базовая нагрузка (равномерная)
+    base_per_week = total_points / n_weeks
+    
+    # 2. Применяем коэффициенты (ЦИКЛИЧЕСКИ по ISO неделе)
+    weekly_targets = []
+    for week_info in weeks_info:
+        iso_week = week_info['iso_week_number']
+        week_index = (iso_week - 1) % 4  # 0, 1, 2, 3, 0, 1, ...
+        coefficient = coefficients[week_index % len(coefficients)]
+        
+        raw_target = base_per_week * coefficient
+        weekly_target = max(1, int(round(raw_target)))  # минимум 1 точка
+        weekly_targets.append(weekly_target)
+    
+    # 3. Корректируем сумму до total_points
+    current_sum = sum(weekly_targets)
+    difference = total_points - current_sum
+    
+    if difference != 0:
+        # Сортируем недели по "гибкости" (насколько можно изменить)
+        # Приоритет у недель с самым высоким коэффициентом (могут взять больше)
+        week_flexibility = []
+        for i, week_info in enumerate(weeks_info):
+            iso_week = week_info['iso_week_number']
+            week_index = (iso_week - 1) % 4
+            coefficient = coefficients[week_index % len(coefficients)]
+            
+            # "Гибкость" = коэффициент (высокий коэффициент = может взять больше)
+            week_flexibility.append((i, coefficient))
+        
+        # Сортируем по коэффициенту (убывание)
+        week_flexibility.sort(key=lambda x: -x[1])
+        
+        # Корректируем
+        week_idx = 0
+        while difference != 0 and week_idx < len(week_flexibility):
+            i = week_flexibility[week_idx][0]
+            
+            if difference > 0:
+                # Добавляем точку
+                weekly_targets[i] += 1
+                difference -= 1
+            elif difference < 0 and weekly_targets[i] > 1:
+                # Убираем точку (но не ниже 1)
+                weekly_targets[i] -= 1
+                difference += 1
+            
+            week_idx += 1
+    
+    # 4. Финальная гарантия (аварийный клапан)
+    if sum(weekly_targets) != total_points:
+        # Всю оставшуюся разницу на первую неделю
+        weekly_targets[0] += (total_points - sum(weekly_targets))
+    
+    # 5. Проверка (для отладки)
+    final_sum = sum(weekly_targets)
+    if final_sum != total_points:
+        # Это не должно случиться, но если случилось — логируем
+        pass
+    
+    return weekly_targets
+
+# ==============================================
+# РАССТОЯНИЯ (ГАВЕРСИНУС И ПРОЕКЦИЯ В КИЛОМЕТРЫ)
+# ==============================================
+
+EARTH_RADIUS_KM = 6371.0088
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Расстояние по дуге большого круга в км. Аргументы - числа или массивы NumPy
+    (с broadcasting), результат - массив той же формы.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(value, dtype=np.float64)) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def project_to_km(lat, lon, ref_lat=None, ref_lon=None):
+    """
+    Равнопромежуточная проекция вокруг опорной точки (по умолчанию - центр точек):
+    (x, y) в км на восток и на север. В пределах города расстояние по x, y отличается
+    от гаверсинуса на доли процента, а считается как обычный Евклид.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if len(lat) == 0:
+        return np.array([], dtype=np.float64), np.array([], dtype=np.float64)
+    if ref_lat is None:
+        ref_lat = np.mean(lat)
+    if ref_lon is None:
+        ref_lon = np.mean(lon)
+    x = np.radians(lon - ref_lon) * EARTH_RADIUS_KM * np.cos(np.radians(ref_lat))
+    y = np.radians(lat - ref_lat) * EARTH_RADIUS_KM
+    return x, y
+
+def project_cities_to_km(lat, lon, city_codes):
+    """
+    Проекция в км отдельно для каждого города: опорная точка - центр точек города
+    (коды городов - как в PointStore, -1 - город не указан).
+    """
+    if len(lat) == 0:
+        return project_to_km(lat, lon)
+    _, groups = np.unique(city_codes, return_inverse=True)
+    counts = np.bincount(groups)
+    ref_lat = (np.bincount(groups, weights=lat) / counts)[groups]
+    ref_lon = (np.bincount(groups, weights=lon) / counts)[groups]
+    return project_to_km(lat, lon, ref_lat, ref_lon)
+
+def calculate_route_lengths(routes_df):
+    """
+    Длина маршрутов дней (км, по гаверсинусу между соседними точками маршрута).
+    routes_df - маршруты в формате EasyMerch (строки дня идут в порядке обхода).
+    Возвращает DataFrame: Login пользователя, Цикл посещения, День, Точек, Длина_км.
+    """
+    columns = ['Login пользователя', 'Цикл посещения', 'День', 'Точек', 'Длина_км']
+    days = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
+    if routes_df is None or routes_df.empty or not set(days).issubset(routes_df.columns):
+        return pd.DataFrame(columns=columns)
+
+    # День визита - первая отмеченная колонка дня
+    marks = routes_df[days].eq(1).to_numpy()
+    day = np.where(marks.any(axis=1), np.array(days, dtype=object)[marks.argmax(axis=1)], '')
+
+    lat = pd.to_numeric(routes_df['Широта'], errors='coerce').to_numpy(dtype=np.float64)
+    lon = pd.to_numeric(routes_df['Долгота'], errors='coerce').to_numpy(dtype=np.float64)
+    login = routes_df['Login пользователя'].to_numpy(dtype=object)
+    cycle = routes_df['Цикл посещения'].to_numpy(dtype=object)
+
+    # Переход к следующей строке - часть маршрута, если это тот же аудитор, неделя и день
+    same = (login[1:] == login[:-1]) & (cycle[1:] == cycle[:-1]) & (day[1:] == day[:-1])
+    legs = np.where(same, haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:]), 0.0)
+
+    lengths = pd.DataFrame({
+        'Login пользователя': login, 'Цикл посещения': cycle, 'День': day,
+        'Длина_км': np.concatenate([[0.0], np.nan_to_num(legs)])
+    })
+    result = lengths.groupby(['Login пользователя', 'Цикл посещения', 'День'], sort=False).agg(
+        Точек=('Длина_км', 'size'), Длина_км=('Длина_км', 'sum')
+    ).reset_index()
+    result['Длина_км'] = result['Длина_км'].round(2)
+    return result[columns]
+
+# ==============================================
+# ПРОСТРАНСТВЕННЫЙ ИНДЕКС (РАВНОМЕРНАЯ СЕТКА)
+# ==============================================
+
+# Среднее число точек в ячейке сетки
+SPATIAL_INDEX_POINTS_PER_CELL = 8
+# Размер блока матрицы расстояний запросов до кандидатов в knn (элементов float64)
+SPATIAL_INDEX_BLOCK_ELEMENTS = 1 << 20
+
+class SpatialIndex:
+    """
+    Равномерная сетка по точкам (x, y в км, см. project_to_km): позиции точек упорядочены
+    по ячейкам (построчно), у каждой ячейки - диапазон в этом порядке, поэтому строка
+    ячеек прямоугольника - один непрерывный срез. Строится один раз за O(n log n);
+    запросы - k ближайших (knn), точки в радиусе (within_radius), в прямоугольнике
+    (within_bbox) и равномерная по площади выборка (spread).
+    Позиции - номера точек во входных массивах.
+    """
+
+    def __init__(self, x, y, points_per_cell=SPATIAL_INDEX_POINTS_PER_CELL):
+        self.x = np.ascontiguousarray(x, dtype=np.float64)
+        self.y = np.ascontiguousarray(y, dtype=np.float64)
+        self.n = len(self.x)
+
+        if self.n == 0:
+            self.min_x = self.min_y = 0.0
+            extent_x = extent_y = 0.0
+        else:
+            self.min_x, self.min_y = float(self.x.min()), float(self.y.min())
+            extent_x, extent_y = float(self.x.max()) - self.min_x, float(self.y.max()) - self.min_y
+
+        # Размер ячейки - чтобы в ячейке было в среднем points_per_cell точек
+        # (точки на одной линии - по длине линии, совпадающие точки - одна ячейка)
+        cells = max(self.n / max(points_per_cell, 1e-9), 1.0)
+        if extent_x > 0 and extent_y > 0:
+            self.cell = math.sqrt(extent_x * extent_y / cells)
+        elif max(extent_x, extent_y) > 0:
+            self.cell = max(extent_x, extent_y) / cells
+        else:
+            self.cell = 1.0
+        self.nx = int(extent_x // self.cell) + 1
+        self.ny = int(extent_y // self.cell) + 1
+
+        self.cell_x, self.cell_y = self._cells(self.x, self.y)
+        codes = self.cell_y * self.nx + self.cell_x
+        self.order = np.argsort(codes, kind='stable')
+        self.starts = np.searchsorted(codes[self.order], np.arange(self.nx * self.ny + 1))
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.x, self.y, self.order, self.starts, self.cell_x, self.cell_y))
+
+    def _cells(self, x, y):
+        """Ячейки сетки (столбец, строка) для координат; вне сетки - крайние ячейки"""
+        cell_x = np.clip(((np.asarray(x, dtype=np.float64) - self.min_x) // self.cell), 0, self.nx - 1)
+        cell_y = np.clip(((np.asarray(y, dtype=np.float64) - self.min_y) // self.cell), 0, self.ny - 1)
+        return cell_x.astype(np.int64), cell_y.astype(np.int64)
+
+    def _block(self, x0, x1, y0, y1):
+        """Позиции точек в ячейках [x0, x1] x [y0, y1] (границы обрезаются по сетке)"""
+        x0, x1 = max(x0, 0), min(x1, self.nx - 1)
+        y0, y1 = max(y0, 0), min(y1, self.ny - 1)
+        if x0 > x1 or y0 > y1:
+            return np.empty(0, dtype=np.int64)
+        rows = np.arange(y0, y1 + 1) * self.nx
+        parts = [self.order[self.starts[row + x0]:self.starts[row + x1 + 1]] for row in rows]
+        return np.concatenate(parts)
+
+    def _reach(self, x, y, cell_x, cell_y, ring):
+        """
+        Расстояние от запросов до края квадрата ring ячеек вокруг ячейки (cell_x, cell_y):
+        все точки ближе него лежат в квадрате
+        """
+        reach = np.full(len(x), np.inf)
+        if cell_x - ring > 0:
+            reach = np.minimum(reach, x - (self.min_x + (cell_x - ring) * self.cell))
+        if cell_x + ring < self.nx - 1:
+            reach = np.minimum(reach, self.min_x + (cell_x + ring + 1) * self.cell - x)
+        if cell_y - ring > 0:
+            reach = np.minimum(reach, y - (self.min_y + (cell_y - ring) * self.cell))
+        if cell_y + ring < self.ny - 1:
+            reach = np.minimum(reach, self.min_y + (cell_y + ring + 1) * self.cell - y)
+        return reach
+
+    def within_bbox(self, min_x, min_y, max_x, max_y):
+        """Позиции точек в прямоугольнике (включая границы), по возрастанию"""
+        (x0, x1), (y0, y1) = self._cells([min_x, max_x], [min_y, max_y])
+        candidates = self._block(x0, x1, y0, y1)
+        inside = ((self.x[candidates] >= min_x) & (self.x[candidates] <= max_x) &
+                  (self.y[candidates] >= min_y) & (self.y[candidates] <= max_y))
+        return np.sort(candidates[inside])
+
+    def within_radius(self, x, y, radius):
+        """Позиции точек не дальше radius км от (x, y), по возрастанию"""
+        candidates = self.within_bbox(x - radius, y - radius, x + radius, y + radius)
+        return candidates[np.hypot(self.x[candidates] - x, self.y[candidates] - y) <= radius]
+
+    def knn(self, k, x=None, y=None):
+        """
+        k ближайших точек для каждого запроса - массив (число запросов, k) позиций
+        (порядок внутри строки не задан). Без x, y запросы - сами точки индекса,
+        точка не считается своим соседом.
+        Запросы одной ячейки обрабатываются вместе: кандидаты - точки квадрата ячеек
+        вокруг нее, квадрат расширяется, пока k-й сосед не окажется ближе его края.
+        Расстояния считаются блоками строк (не больше SPATIAL_INDEX_BLOCK_ELEMENTS), поэтому
+        память ограничена и при тысячах точек с одинаковыми координатами в одной ячейке.
+        """
+        own = x is None
+        if own:
+            x, y = self.x, self.y
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        k = min(k, self.n - 1 if own else self.n)
+        neighbours = np.empty((len(x), max(k, 0)), dtype=np.int64)
+        if k <= 0 or len(x) == 0:
+            return neighbours
+
+        cell_x, cell_y = self._cells(x, y)
+        codes = cell_y * self.nx + cell_x
+        query_order = np.argsort(codes, kind='stable')
+        bounds = np.flatnonzero(np.diff(codes[query_order])) + 1
+
+        for queries in np.split(query_order, bounds):
+            qx, qy = int(cell_x[queries[0]]), int(cell_y[queries[0]])
+            ring = 1
+            while len(queries):
+                candidates = self._block(qx - ring, qx + ring, qy - ring, qy + ring)
+                if len(candidates) >= k + own:
+                    if own:
+                        # Позиция самой точки среди кандидатов - ее расстояние исключается
+                        sorter = np.argsort(candidates, kind='stable')
+                    block = max(1, SPATIAL_INDEX_BLOCK_ELEMENTS // len(candidates))
+                    pending = []
+                    for start in range(0, len(queries), block):
+                        rows = queries[start:start + block]
+                        squared = ((x[rows, None] - self.x[None, candidates]) ** 2 +
+                                   (y[rows, None] - self.y[None, candidates]) ** 2)
+                        if own:
+                            squared[np.arange(len(rows)), sorter[np.searchsorted(candidates, rows, sorter=sorter)]] = np.inf
+                        nearest = np.argpartition(squared, k - 1, axis=1)[:, :k]
+                        kth = np.take_along_axis(squared, nearest, axis=1).max(axis=1)
+                        # Сосед точный, если k-й ближе края квадрата (за краем сетки точек нет)
+                        done = kth <= self._reach(x[rows], y[rows], qx, qy, ring) ** 2
+                        neighbours[rows[done]] = candidates[nearest[done]]
+                        pending.append(rows[~done])
+                    queries = np.concatenate(pending)
+                ring += 1
+
+        return neighbours
+
+    def spread(self, max_points):
+        """
+        Не больше max_points позиций, равномерно по площади: по одной точке из ячеек
+        более крупной сетки (для карт и предпросмотра вместо случайной выборки)
+        """
+        if self.n <= max_points:
+            return np.arange(self.n, dtype=np.int64)
+        coarse = SpatialIndex(self.x, self.y, points_per_cell=self.n / max(max_points, 1))
+        first = coarse.order[coarse.starts[:-1][np.diff(coarse.starts) > 0]]
+        return np.sort(first[:max_points])
+
+# ==============================================
+# КОМПАКТНОЕ ХРАНИЛИЩЕ ТОЧЕК
+# ==============================================
+
+class PointStore:
+    """
+    Компактное хранилище точек для всего конвейера расчета.
+    Координаты лежат в непрерывных массивах float64, Город и Тип - категориальные
+    коды, ID_Точки - целочисленный индекс (позиция строки). Распределение,
+    кластеризация, маршруты и выгрузки передают между собой массивы индексов,
+    а не копии DataFrame.
+    """
+
+    def __init__(self, points_df):
+        self.frame = points_df.reset_index(drop=True)
+        n = len(self.frame)
+
+        self.ids = self.frame['ID_Точки'].to_numpy(dtype=object)
+        self.lat = np.ascontiguousarray(
+            pd.to_numeric(self.frame['Широта'], errors='coerce').to_numpy(dtype=np.float64)
+        )
+        self.lon = np.ascontiguousarray(
+            pd.to_numeric(self.frame['Долгота'], errors='coerce').to_numpy(dtype=np.float64)
+        )
+
+        # Город и Тип - коды категорий (порядок категорий = порядок появления)
+        self.city_codes, self.cities = self._encode('Город', n)
+        self.type_codes, self.types = self._encode('Тип', n)
+
+        # Координаты в км (проекция отдельно для каждого города) - для расстояний
+        self.x_km, self.y_km = project_cities_to_km(self.lat, self.lon, self.city_codes)
+
+        if 'Кол-во_посещений' in self.frame.columns:
+            self.visits = self.frame['Кол-во_посещений'].fillna(0).to_numpy(dtype=np.int64)
+        else:
+            self.visits = np.ones(n, dtype=np.int64)
+
+        # ID_Точки -> позиция в хранилище
+        self.id_index = pd.Index(self.ids)
+
+        # Пространственные индексы городов (строятся при первом запросе)
+        self._city_indexes = {}
+
+    def _encode(self, column, n):
+        """Кодирует колонку в int32-коды категорий"""
+        if column not in self.frame.columns:
+            return np.full(n, -1, dtype=np.int32), np.array([], dtype=object)
+        codes, uniques = pd.factorize(self.frame[column], sort=False)
+        return codes.astype(np.int32), np.asarray(uniques, dtype=object)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def all_indices(self):
+        """Индексы всех точек"""
+        return np.arange(len(self.ids), dtype=np.int64)
+
+    def indices_for_ids(self, point_ids):
+        """
+        Позиции точек по списку ID_Точки в порядке хранилища.
+        Неизвестные ID пропускаются, повторяющиеся ID дают все свои строки.
+        """
+        if not self.id_index.is_unique:
+            return np.flatnonzero(self.id_index.isin(point_ids)).astype(np.int64)
+        positions = self.id_index.get_indexer(pd.Index(point_ids))
+        positions = positions[positions >= 0]
+        return np.unique(positions).astype(np.int64)
+
+    def first_positions(self, point_ids):
+        """Позиция первой строки для каждого ID_Точки (-1, если ID нет)"""
+        first = ~self.id_index.duplicated()
+        positions = self.id_index[first].get_indexer(pd.Index(point_ids))
+        return np.where(positions >= 0, np.flatnonzero(first)[positions], -1)
+
+    def city_groups(self):
+        """Список (город, индексы точек города) в порядке появления городов"""
+        order = np.argsort(self.city_codes, kind='stable')
+        bounds = np.searchsorted(self.city_codes[order], np.arange(len(self.cities) + 1))
+        return [
+            (self.cities[code], order[bounds[code]:bounds[code + 1]])
+            for code in range(len(self.cities))
+        ]
+
+    def city_spatial_index(self, city_idx):
+        """
+        Пространственный индекс точек города по координатам в км (строится один раз на город).
+        city_idx - индексы точек города из city_groups(); позиции индекса - позиции в city_idx.
+        """
+        code = int(self.city_codes[city_idx[0]]) if len(city_idx) else -1
+        index = self._city_indexes.get(code)
+        if index is None or index.n != len(city_idx):
+            index = SpatialIndex(self.x_km[city_idx], self.y_km[city_idx])
+            self._city_indexes[code] = index
+        return index
+
+    def column(self, name, default=''):
+        """Значения исходной колонки (для текстовых полей выгрузок)"""
+        if name in self.frame.columns:
+            return self.frame[name].to_numpy(dtype=object)
+        return np.full(len(self.ids), default, dtype=object)
+
+    def point_records(self, idx):
+        """Список [ID_Точки, Широта, Долгота] для полигонов"""
+        return [list(row) for row in zip(self.ids[idx].tolist(), self.lat[idx].tolist(), self.lon[idx].tolist())]
+
+def get_point_store(points_df, store=None):
+    """Возвращает переданное хранилище или строит новое по DataFrame"""
+    if store is not None:
+        return store
+    return PointStore(points_df)
+
+# ==============================================
+# КЛАСС ДЛЯ ОПТИМИЗАЦИИ МАРШРУТОВ ПО ДНЯМ
+# ==============================================
+
+class WeeklyRouteOptimizer:
+    """
+    Оптимизатор маршрутов на основе логики из optimizer.py
+    Распределяет точки по дням недели и строит оптимальные маршруты
+    """
+    
+    @staticmethod
+    def calculate_distance(lat1, lon1, lat2, lon2):
+        """Расстояние между точками по дуге большого круга (км)"""
+        return float(haversine_km(lat1, lon1, lat2, lon2))
+    
+    @staticmethod
+    def greedy_route(points):
+        """
+        Жадный алгоритм построения маршрута
+        Начинает с самой дальней точки от центра
+        """
+        if len(points) <= 1:
+            return points
+
+        order = WeeklyRouteOptimizer.greedy_order(
+            [p['Широта'] for p in points],
+            [p['Долгота'] for p in points]
+        )
+        return [points[i] for i in order]
+
+    @staticmethod
+    def greedy_order(lats, lons):
+        """
+        Жадный маршрут по массивам широт и долгот (точки проецируются в км).
+        Возвращает порядок обхода - массив позиций во входных массивах.
+        """
+        x, y = project_to_km(lats, lons)
+        return WeeklyRouteOptimizer.greedy_permutation(cluster_distances(x, y))
+
+    @staticmethod
+    def greedy_permutation(distances):
+        """
+        Жадный маршрут (ближайший сосед) по расстояниям кластера (ClusterDistances).
+        Начинает с самой дальней точки от центра, далее - ближайшая непосещенная точка
+        (при равных расстояниях - с меньшей позицией).
+        Расстояния от последней точки берутся строкой матрицы, посещенные точки
+        маскируются. Возвращает перестановку - массив позиций точек кластера.
+        """
+        n = distances.n
+        if n <= 1:
+            return np.arange(n, dtype=np.int64)
+
+        x, y = distances.x, distances.y
+
+        # Находим самую дальнюю точку от центра
+        start_idx = int(((x - np.mean(x)) ** 2 + (y - np.mean(y)) ** 2).argmax())
+
+        route = np.empty(n, dtype=np.int64)
+        route[0] = start_idx
+        # Маска посещенных: 0 или inf, прибавляется к расстояниям
+        visited = np.zeros(n, dtype=distances.dtype)
+        visited[start_idx] = np.inf
+        buffer = np.empty(n, dtype=distances.dtype)
+
+        last = start_idx
+        for step in range(1, n):
+            # Расстояния от последней точки, посещенные - исключаем
+            np.add(distances.row(last), visited, out=buffer)
+
+            last = int(buffer.argmin())
+            route[step] = last
+            visited[last] = np.inf
+
+        return route
+    
+    @staticmethod
+    def distribute_points_to_days(points_list, visits_per_point, working_days):
+        """
+        Распределяет точки по рабочим дням недели
+        points_list: список словарей с точками
+        visits_per_point: сколько раз нужно посетить каждую точку
+        working_days: список дат рабочих дней недели
+        """
+        if not points_list or not working_days:
+            return {}
+        
+        # Создаем список всех посещений
+        all_visits = []
+        for point in points_list:
+            point_id = point['ID_Точки']
+            visits = visits_per_point.get(point_id, 1)
+            for _ in range(visits):
+                all_visits.append(point.copy())
+        
+        # Равномерно распределяем по дням
+        visits_by_day = {}
+        days_count = len(working_days)
+        
+        for i, visit in enumerate(all_visits):
+            day_index = i % days_count
+            day_date = working_days[day_index]
+            
+            if day_date not in visits_by_day:
+                visits_by_day[day_date] = []
+            
+            visits_by_day[day_date].append(visit)
+        
+        return visits_by_day
+    
+    @staticmethod
+    def optimize_week_for_auditor(auditor_points, visits_needed, week_dates, auditor_id):
+        """
+        Оптимизирует маршруты для аудитора на неделю
+        Возвращает список визитов с указанием дня недели
+        """
+        results = []
+        
+        # Определяем рабочие дни (понедельник-пятница)
+        working_days = []
+        for day_date in week_dates:
+            # Проверяем что это datetime/date объект
+            if hasattr(day_date, 'weekday'):
+                if day_date.weekday() < 5:  # 0-4 = Пн-Пт
+                    working_days.append(day_date)
+        
+        if not working_days:
+            return results
+        
+        # Распределяем точки по дням
+        visits_by_day = WeeklyRouteOptimizer.distribute_points_to_days(
+            auditor_points, visits_needed, working_days
+        )
+        
+        # Для каждого дня строим оптимальный маршрут
+        for day_date, day_points in visits_by_day.items():
+            if not day_points:
+                continue
+            
+            # Строим оптимальный маршрут для дня
+            optimized_route = WeeklyRouteOptimizer.greedy_route(day_points)
+            
+            # Добавляем каждую точку в результат с указанием дня
+            # Преобразуем в datetime если нужно
+            if isinstance(day_date, date):
+                day_datetime = datetime.combine(day_date, datetime.min.time())
+            else:
+                day_datetime = day_date
+            
+            day_of_week = day_datetime.weekday()  # 0=понедельник, 4=пятница
+            
+            for point in optimized_route:
+                results.append({
+                    'ID_Точки': point['ID_Точки'],
+                    'Дата': day_datetime,
+                    'День_недели': day_of_week,
+                    'Аудитор': auditor_id,
+                    'Широта': point['Широта'],
+                    'Долгота': point['Долгота']
+                })
+        
+        return results
+
+# ==============================================
+# ФУНКЦИИ ДЛЯ РАСЧЕТА РАБОЧИХ ДНЕЙ И КЛАСТЕРИЗАЦИИ
+# ==============================================
+
+def get_working_days_for_quarter(year, quarter):
+    """
+    Возвращает список рабочих дней в квартале
+    с учетом российских праздников (использует workalendar если доступен)
+    """
+    quarter_start, quarter_end = get_quarter_dates(year, quarter)
+    
+    if WORKALENDAR_AVAILABLE:
+        # Используем библиотеку workalendar для точного расчета
+        cal = Russia()
+        working_days = []
+        current_date = quarter_start
+        
+        while current_date <= quarter_end:
+            if cal.is_working_day(current_date):
+                working_days.append(current_date)
+            current_date += timedelta(days=1)
+        
+        return working_days
+    else:
+        # Простая версия: только понедельник-пятница
+        diag.warning("⚠️ Для учета праздников установите: pip install workalendar")
+        
+        working_days = []
+        current_date = quarter_start
+        
+        while current_date <= quarter_end:
+            if current_date.weekday() < 5:  # Пн-Пт
+                working_days.append(current_date)
+            current_date += timedelta(days=1)
+        
+        return working_days
+
+# def simple_cluster_points(points, n_clusters):
+#     """
+#     Простая кластеризация без sklearn
+#     """
+#     if not points or n_clusters <= 0:
+#         return [[] for _ in range(n_clusters)] if n_clusters > 0 else []
+    
+#     if len(points) <= n_clusters:
+#         # Каждая точка в своей группе
+#         clusters = [[p] for p in points]
+#         # Добавляем пустые группы если нужно
+#         while len(clusters) < n_clusters:
+#             clusters.append([])
+#         return clusters
+    
+#     # Выбираем начальные центры
+#     centers = []
+    
+#     # Первый центр - первая точка
+#     if points:
+#         centers.append(points[0])
+    
+#     # Остальные центры - самые удаленные
+#     for _ in range(1, min(n_clusters, len(points))):
+#         max_min_distance = -1
+#         best_point = None
+        
+#         for point in points:
+#             if point in centers:
+#                 continue
+            
+#             # Минимальное расстояние до существующих центров
+#             min_dist = float('inf')
+#             for center in centers:
+#                 dist = WeeklyRouteOptimizer.calculate_distance(
+#                     point['Широта'], point['Долгота'],
+#                     center['Широта'], center['Долгота']
+#                 )
+#                 min_dist = min(min_dist, dist)
+            
+#             if min_dist > max_min_distance:
+#                 max_min_distance = min_dist
+#                 best_point = point
+        
+#         if best_point:
+#             centers.append(best_point)
+#         else:
+#             # Если не нашли, берем любую неиспользованную
+#             for point in points:
+#                 if point not in centers:
+#                     centers.append(point)
+#                     break
+    
+#     # Если не набрали достаточно центров
+#     while len(centers) < n_clusters:
+#         centers.append(points[0])  # дублируем первую точку
+    
+#     # Назначаем точки ближайшим центрам
+#     clusters = [[] for _ in range(n_clusters)]
+    
+#     for point in points:
+#         # Находим ближайший центр
+#         min_dist = float('inf')
+#         nearest_idx = 0
+        
+#         for i, center in enumerate(centers):
+#             dist = WeeklyRouteOptimizer.calculate_distance(
+#                 point['Широта'], point['Долгота'],
+#                 center['Широта'], center['Долгота']
+#             )
+#             if dist < min_dist:
+#                 min_dist = dist
+#                 nearest_idx = i
+        
+#         if 0 <= nearest_idx < n_clusters:
+#             clusters[nearest_idx].append(point)
+    
+#     return clusters
+
+def create_daily_routes_for_auditor(auditor_points, working_days, auditor_id):
+    """
+    УНИВЕРСАЛЬНЫЙ АЛГОРИТМ ДЛЯ ГОРОДОВ-МИЛЛИОННИКОВ РОССИИ
+    """
+    try:
+        if not auditor_points or not working_days:
+            return []
+        
+        N = len(auditor_points)
+        K = len(working_days)
+        
+        if K == 0:
+            return []
+        
+        # === 1. ПРЕПРОЦЕССИНГ КООРДИНАТ ===
+        valid_points = []
+        for point in auditor_points:
+            try:
+                lat = float(point['Широта'])
+                lon = float(point['Долгота'])
+                # Проверка на валидные координаты России
+                if 41 <= lat <= 82 and 19 <= lon <= 180:
+                    valid_points.append(point)
+            except (ValueError, TypeError):
+                continue
+        
+        if not valid_points:
+            return []
+        
+        # === 2. ЕСЛИ ТОЧЕК МАЛО ===
+        if len(valid_points) <= K:
+            # Просто распределяем по дням
+            return simple_distribute_points(valid_points, working_days, auditor_id)
+        
+        # === 3. АНАЛИЗ ГЕОГРАФИЧЕСКОГО РАСПРЕДЕЛЕНИЯ ===
+        lats = [p['Широта'] for p in valid_points]
+        lons = [p['Долгота'] for p in valid_points]
+        
+        lat_min, lat_max = min(lats), max(lats)
+        lon_min, lon_max = min(lons), max(lons)
+        
+        lat_range = lat_max - lat_min
+        lon_range = lon_max - lon_min
+        
+        # Размах точек в километрах
+        x_km, y_km = project_to_km(lats, lons)
+        lat_km = y_km.max() - y_km.min()
+        lon_km = x_km.max() - x_km.min()
+        
+        # Определяем тип распределения
+        city_type = "compact"
+        if lat_km > 50 or lon_km > 50:
+            city_type = "scattered"
+        elif max(lat_km, lon_km) / min(lat_km, lon_km) > 3:
+            city_type = "linear"
+        
+        # === 4. КЛАСТЕРИЗАЦИЯ ===
+        # KMeans с ограничением размера: в каждый день - поровну точек
+        day_sizes = [len(part) for part in np.array_split(np.arange(len(valid_points)), K)]
+        labels = size_constrained_clusters(x_km, y_km, day_sizes)
+
+        balanced_clusters = [[] for _ in range(K)]
+        for point, label in zip(valid_points, labels.tolist()):
+            balanced_clusters[label].append(point)
+        
+        # === 6. ПОСТРОЕНИЕ МАРШРУТОВ ===
+        routes = []
+        
+        for day_idx, (day_date, cluster_points) in enumerate(zip(working_days, balanced_clusters)):
+            if not cluster_points:
+                continue
+            
+            # Обработка даты
+            if isinstance(day_date, date) and not isinstance(day_date, datetime):
+                visit_datetime = datetime.combine(day_date, datetime.min.time())
+            else:
+                visit_datetime = day_date
+            
+            # Сортировка точек внутри кластера для лучшего маршрута
+            if len(cluster_points) > 1:
+                # Сортируем по географическому порядку
+                if city_type == "linear" and lon_range > lat_range:
+                    cluster_points.sort(key=lambda p: p['Долгота'])  # запад → восток
+                else:
+                    cluster_points.sort(key=lambda p: (-p['Широта'], p['Долгота']))  # север→юг, запад→восток
+            
+            # Строим маршрут
+            try:
+                optimized_route = WeeklyRouteOptimizer.greedy_route(cluster_points)
+            except:
+                optimized_route = cluster_points
+            
+            # Добавляем точки
+            for point in optimized_route:
+                routes.append({
+                    'ID_Точки': point['ID_Точки'],
+                    'Дата': visit_datetime,
+                    'День_недели': visit_datetime.weekday(),
+                    'Аудитор': auditor_id,
+                    'Широта': point['Широта'],
+                    'Долгота': point['Долгота'],
+                    'Название_Точки': point.get('Название_Точки', point['ID_Точки']),
+                    'Адрес': point.get('Адрес', ''),
+                    'Тип': point.get('Тип', 'Неизвестно')
+                })
+        
+        return routes
+    
+    except Exception as e:
+        diag.error(f"❌ Критическая ошибка: {str(e)}")
+        import traceback
+        diag.error(f"Детали:\n{traceback.format_exc()}")
+        return []
+
+
+def simple_distribute_points(points, working_days, auditor_id):
+    """Простое распределение точек по дням"""
+    routes = []
+    
+    for i, point in enumerate(points):
+        if i >= len(working_days):
+            break
+        
+        day_date = working_days[i]
+        if isinstance(day_date, date) and not isinstance(day_date, datetime):
+            visit_datetime = datetime.combine(day_date, datetime.min.time())
+        else:
+            visit_datetime = day_date
+        
+        routes.append({
+            'ID_Точки': point['ID_Точки'],
+            'Дата': visit_datetime,
+            'День_недели': visit_datetime.weekday(),
+            'Аудитор': auditor_id,
+            'Широта': point['Широта'],
+            'Долгота': point['Долгота'],
+            'Название_Точки': point.get('Название_Точки', point['ID_Точки']),
+            'Адрес': point.get('Адрес', ''),
+            'Тип': point.get('Тип', 'Неизвестно')
+        })
+    
+    return routes
+
+
+# def balance_clusters_simple(clusters, target_k):
+#     """Простая балансировка кластеров"""
+#     # Собираем все точки
+#     all_points = []
+#     for cluster in clusters:
+#         all_points.extend(cluster)
+    
+#     if len(all_points) == 0:
+#         return [[] for _ in range(target_k)]
+    
+#     # Сортируем по географии
+#     sorted_points = sorted(all_points, key=lambda p: (-p['Широта'], p['Долгота']))
+    
+#     # Распределяем равномерно
+#     balanced = [[] for _ in range(target_k)]
+#     for i, point in enumerate(sorted_points):
+#         balanced[i % target_k].append(point)
+    
+#     return balanced
+
+
+# def simple_geographic_distribution(points, working_days, auditor_id):
+#     """Простое географическое распределение"""
+#     if not points or not working_days:
+#         return []
+    
+#     K = len(working_days)
+    
+#     # Сортируем точки
+#     sorted_points = sorted(points, key=lambda p: (-p['Широта'], p['Долгота']))
+    
+#     # Делим на части
+#     daily_clusters = []
+#     base_size = len(sorted_points) // K
+#     remainder = len(sorted_points) % K
+    
+#     start_idx = 0
+#     for day_idx in range(K):
+#         size = base_size + (1 if day_idx < remainder else 0)
+#         end_idx = start_idx + size
+        
+#         if start_idx < len(sorted_points):
+#             daily_clusters.append(sorted_points[start_idx:end_idx])
+#             start_idx = end_idx
+#         else:
+#             daily_clusters.append([])
+    
+#     # Строим маршруты
+#     routes = []
+#     for day_idx, (day_date, cluster_points) in enumerate(zip(working_days, daily_clusters)):
+#         if not cluster_points:
+#             continue
+        
+#         if isinstance(day_date, date) and not isinstance(day_date, datetime):
+#             visit_datetime = datetime.combine(day_date, datetime.min.time())
+#         else:
+#             visit_datetime = day_date
+        
+#         for point in cluster_points:
+#             routes.append({
+#                 'ID_Точки': point['ID_Точки'],
+#                 'Дата': visit_datetime,
+#                 'День_недели': visit_datetime.weekday(),
+#                 'Аудитор': auditor_id,
+#                 'Широта': point['Широта'],
+#                 'Долгота': point['Долгота'],
+#                 'Название_Точки': point.get('Название_Точки', point['ID_Точки']),
+#                 'Адрес': point.get('Адрес', ''),
+#                 'Тип': point.get('Тип', 'Неизвестно')
+#             })
+    
+#     return routes
+    
+# ==============================================
+# ФУНКЦИИ ДЛЯ СОЗДАНИЯ ВЫХОДНОЙ ТАБЛИЦЫ
+# ==============================================
+def create_weekly_route_schedule(points_df, points_assignment_df, auditors_df, year, quarter):
+    """
+    Создает ежедневные маршруты для аудиторов в формате EasyMerch
+    """
+    
+    if points_df is None or points_df.empty:
+        return pd.DataFrame()
+    
+    if points_assignment_df is None or points_assignment_df.empty:
+        return pd.DataFrame()
+    
+    # 1. Получаем рабочие дни квартала
+    working_days = get_working_days_for_quarter(year, quarter)
+    
+    if not working_days:
+        diag.warning(f"⚠️ В {year} квартале {quarter} нет рабочих дней")
+        return pd.DataFrame()
+    
+    all_visits = []
+    
+    # 2. Для каждого аудитора создаем ежедневные маршруты
+    for auditor in auditors_df['ID_Сотрудника'].unique():
+        # Находим точки этого аудитора
+        auditor_point_ids = points_assignment_df[
+            points_assignment_df['Аудитор'] == auditor
+        ]['ID_Точки'].tolist()
+        
+        if not auditor_point_ids:
+            continue
+        
+        # Получаем данные точек
+        auditor_points_data = points_df[
+            points_df['ID_Точки'].isin(auditor_point_ids)
+        ]
+        
+        if auditor_points_data.empty:
+            continue
+        
+        # Преобразуем в список словарей с учетом количества посещений
+        auditor_points = []
+        for _, row in auditor_points_data.iterrows():
+            # Учитываем количество посещений за квартал
+            visits_needed = int(row.get('Кол-во_посещений', 1))
+            
+            for visit_num in range(visits_needed):
+                auditor_points.append({
+                    'ID_Точки': row['ID_Точки'],
+                    'Широта': float(row['Широта']),
+                    'Долгота': float(row['Долгота']),
+                    'Название_Точки': row.get('Название_Точки', str(row['ID_Точки'])),
+                    'Адрес': row.get('Адрес', ''),
+                    'Тип': row.get('Тип', 'Неизвестно')
+                })
+        
+        # Создаем ежедневные маршруты
+        daily_visits = create_daily_routes_for_auditor(
+            auditor_points, working_days, auditor
+        )
+        all_visits.extend(daily_visits)
+    
+    # 3. Преобразуем в DataFrame
+    if not all_visits:
+        return pd.DataFrame()
+    
+    results_df = pd.DataFrame(all_visits)
+    
+    # 4. Группируем по неделям для формата EasyMerch
+    # Добавляем информацию о неделе
+    results_df['Неделя'] = results_df['Дата'].apply(get_iso_week)
+    results_df['Дата_начала_недели'] = results_df['Дата'].apply(
+        lambda d: d - timedelta(days=d.weekday())
+    )
+    
+    # 5. Создаем финальную таблицу в формате EasyMerch
+    final_rows = []
+    
+    # Группируем по точкам и неделям
+    grouped = results_df.groupby(['ID_Точки', 'Неделя', 'Аудитор'])
+    
+    for (point_id, week_num, auditor), group in grouped:
+        # Находим информацию о точке
+        point_mask = points_df['ID_Точки'] == point_id
+        if not point_mask.any():
+            continue
+            
+        point_info = points_df[point_mask].iloc[0]
+        
+        # Количество визитов на этой неделе
+        visits_this_week = len(group)
+        
+        # Дни недели когда есть визиты
+        days_visited = set(group['День_недели'].tolist())
+        
+        # Дата начала недели (понедельник)
+        week_start_date = group['Дата_начала_недели'].iloc[0]
+        
+        # Преобразуем в строку YYYYMMDD
+        if isinstance(week_start_date, (datetime, pd.Timestamp)):
+            start_date_str = week_start_date.strftime('%Y%m%d')
+        else:
+            start_date_str = str(week_start_date).replace('-', '')
+        
+        # Получаем координаты
+        try:
+            latitude = float(point_info.get('Широта', 0))
+            longitude = float(point_info.get('Долгота', 0))
+        except (ValueError, TypeError):
+            latitude = 0
+            longitude = 0
+        
+        # Создаем строку
+        row = {
+            'Address': point_info.get('Адрес', ''),
+            'L1 Name': point_info.get('Название_Точки', str(point_id)),
+            'ЧИСЛО визитов в НЕДЕЛЮ': visits_this_week,
+            'Login пользователя': auditor,
+            'Понедельник': 1 if 0 in days_visited else '',
+            'Вторник': 1 if 1 in days_visited else '',
+            'Среда': 1 if 2 in days_visited else '',
+            'Четверг': 1 if 3 in days_visited else '',
+            'Пятница': 1 if 4 in days_visited else '',
+            'Суббота': 1 if 5 in days_visited else '',
+            'Воскресенье': 1 if 6 in days_visited else '',
+            'Цикл посещения': week_num,
+            'Дата начала цикла посещения': start_date_str,
+            'Широта': f"{latitude:.6f}",  # Добавлено: 6 знаков после запятой
+            'Долгота': f"{longitude:.6f}"   # Добавлено: 6 знаков после запятой
+        }
+        
+        final_rows.append(row)
+    
+    if not final_rows:
+        return pd.DataFrame()
+    
+    final_df = pd.DataFrame(final_rows)
+    
+    # Сортируем
+    final_df = final_df.sort_values(['Login пользователя', 'Дата начала цикла посещения', 'L1 Name'])
+    
+    return final_df
+
+def create_easymerch_excel(routes_df):
+    """Создает Excel файл в формате EasyMerch с несколькими листами"""
+    import io
+    
+    if routes_df is None or routes_df.empty:
+        return None
+    
+    excel_buffer = io.BytesIO()
+    
+    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
+        # Лист 1: Основные данные в формате EasyMerch
+        routes_df.to_excel(writer, sheet_name='Маршруты', index=False)
+        
+        # Автонастройка ширины колонок для основного листа
+        worksheet = writer.sheets['Маршруты']
+        for column in worksheet.columns:
+            max_length = 0
+            column_letter = column[0].column_letter
+            for cell in column:
+                try:
+                    if len(str(cell.value)) > max_length:
+                        max_length = len(str(cell.value))
+                except:
+                    pass
+            adjusted_width = min(max_length + 2, 50)
+            worksheet.column_dimensions[column_letter].width = adjusted_width
+        
+        # Лист 2: Инструкция по использованию
+        instructions_data = [
+            ["ПОЛЕ", "ОПИСАНИЕ", "ПРИМЕР", "ОБЯЗАТЕЛЬНОСТЬ"],
+            ["Address", "Полный адрес точки", "ул. Ленина, д. 1, Москва", "Да"],
+            ["L1 Name", "Название торговой точки", 'Магазин "Продукты"', "Да"],
+            ["ЧИСЛО визитов в НЕДЕЛЮ", "Количество визитов в неделю (цифра)", "1, 2, 3", "Да"],
+            ["Login пользователя", "Уникальный ID аудитора", "SOVIAUD10", "Да"],
+            ["Понедельник", "Визит в понедельник (1-да, пусто-нет)", "1", "Нет"],
+            ["Вторник", "Визит во вторник (1-да, пусто-нет)", "", "Нет"],
+            ["Среда", "Визит в среду (1-да, пусто-нет)", "1", "Нет"],
+            ["Четверг", "Визит в четверг (1-да, пусто-нет)", "", "Нет"],
+            ["Пятница", "Визит в пятницу (1-да, пусто-нет)", "1", "Нет"],
+            ["Суббота", "Визит в субботу (1-да, пусто-нет)", "", "Нет"],
+            ["Воскресенье", "Визит в воскресенье (1-да, пусто-нет)", "", "Нет"],
+            ["Цикл посещения", "Номер недели (ISO стандарт)", "15", "Да"],
+            ["Дата начала цикла посещения", "Дата понедельника в формате ГГГГММДД", "20250407", "Да"],
+            ["", "", "", ""],
+            ["ИНСТРУКЦИЯ ПО ИСПОЛЬЗОВАНИЮ:", "", "", ""],
+            ["1. Файл готов для загрузки в EasyMerch", "", "", ""],
+            ["2. Формат даты: YYYYMMDD (например: 20250407)", "", "", ""],
+            ["3. Пустые ячейки в днях недели = нет визита", "", "", ""],
+            ["4. Ячейки с цифрой 1 = визит запланирован", "", "", ""],
+            ["5. Не изменяйте названия колонок", "", "", ""]
+        ]
+        
+        instructions_df = pd.DataFrame(instructions_data[1:], columns=instructions_data[0])
+        instructions_df.to_excel(writer, sheet_name='Инструкция', index=False)
+        
+        # Автонастройка ширины для инструкции
+        worksheet = writer.sheets['Инструкция']
+        worksheet.column_dimensions['A'].width = 25
+        worksheet.column_dimensions['B'].width = 40
+        worksheet.column_dimensions['C'].width = 25
+        worksheet.column_dimensions['D'].width = 15
+        
+        # Лист 3: Сводка и статистика
+        summary_data = {
+            'Статистика': [
+                'Всего записей в плане',
+                'Уникальных аудиторов',
+                'Уникальных торговых точек',
+                'Общее количество визитов в неделю',
+                'Количество недель в плане',
+                'Первая неделя',
+                'Последняя неделя',
+                'Среднее визитов на аудитора',
+                'Дата создания отчета'
+            ],
+            'Значение': [
+                len(routes_df),
+                routes_df['Login пользователя'].nunique(),
+                routes_df['L1 Name'].nunique(),
+                routes_df['ЧИСЛО визитов в НЕДЕЛЮ'].sum(),
+                routes_df['Цикл посещения'].nunique(),
+                routes_df['Цикл посещения'].min() if not routes_df.empty else '-',
+                routes_df['Цикл посещения'].max() if not routes_df.empty else '-',
+                round(routes_df['ЧИСЛО визитов в НЕДЕЛЮ'].sum() / routes_df['Login пользователя'].nunique(), 1) 
+                if routes_df['Login пользователя'].nunique() > 0 else 0,
+                datetime.now().strftime('%d.%m.%Y %H:%M')
+            ]
+        }
+        
+        summary_df = pd.DataFrame(summary_data)
+        summary_df.to_excel(writer, sheet_name='Сводка', index=False)
+        
+        # Автонастройка ширины для сводки
+        worksheet = writer.sheets['Сводка']
+        worksheet.column_dimensions['A'].width = 35
+        worksheet.column_dimensions['B'].width = 20
+        
+        # Лист 4: Распределение по аудиторам (дополнительно)
+        if 'Login пользователя' in routes_df.columns:
+            auditor_stats = routes_df.groupby('Login пользователя').agg({
+                'L1 Name': 'nunique',
+                'ЧИСЛО визитов в НЕДЕЛЮ': 'sum',
+                'Цикл посещения': 'nunique'
+            }).reset_index()
+            
+            auditor_stats.columns = ['Аудитор', 'Уникальных точек', 'Всего визитов', 'Недель в работе']
+            auditor_stats = auditor_stats.sort_values('Всего визитов', ascending=False)
+            auditor_stats.to_excel(writer, sheet_name='Аудиторы', index=False)
+            
+            # Автонастройка ширины
+            worksheet = writer.sheets['Аудиторы']
+            for i, column in enumerate(['A', 'B', 'C', 'D'], 1):
+                worksheet.column_dimensions[column].width = 20
+    
+    return excel_buffer.getvalue()
+                                     
+# ==============================================
+# ФУНКЦИИ ДЛЯ ГЕНЕРАЦИИ ПОЛИГОНОВ И РАСПРЕДЕЛЕНИЯ
+# ==============================================
+
+def create_simple_polygon(points):
+    """Создает простой полигон (прямоугольник) без SciPy"""
+    if len(points) == 0:
+        return []
+    
+    # ИСПРАВЛЕНИЕ: безопасное извлечение координат из разных форматов
+    coords = []
+    
+    if isinstance(points, np.ndarray):
+        # Формат numpy array
+        if points.ndim == 2 and points.shape[1] >= 3:
+            # Предполагаем формат: [ID, широта, долгота, ...]
+            for point in points:
+                if len(point) >= 3:
+                    try:
+                        lat = float(point[1])
+                        lon = float(point[2])
+                        coords.append([lat, lon])
+                    except (ValueError, TypeError, IndexError):
+                        continue
+    else:
+        # Формат списка/кортежа
+        for point in points:
+            if isinstance(point, (list, tuple, np.ndarray)) and len(point) >= 3:
+                try:
+                    # Формат: [ID, широта, долгота]
+                    lat = float(point[1])
+                    lon = float(point[2])
+                    coords.append([lat, lon])
+                except (ValueError, TypeError, IndexError):
+                    continue
+    
+    # ИСПРАВЛЕНИЕ: если не удалось извлечь координаты
+    if not coords:
+        return []
+    
+    if len(coords) == 1:
+        # Одна точка - возвращаем пустой список
+        return []
+    elif len(coords) == 2:
+        # Две точки - создаем линию
+        return [coords[0], coords[1], coords[0]]
+    else:
+        # Несколько точек - создаем bounding box
+        lats = [c[0] for c in coords]
+        lons = [c[1] for c in coords]
+        
+        min_lat, max_lat = min(lats), max(lats)
+        min_lon, max_lon = min(lons), max(lons)
+        
+        # Создаем прямоугольник
+        polygon = [
+            [min_lat, min_lon],  # нижний левый
+            [min_lat, max_lon],  # нижний правый
+            [max_lat, max_lon],  # верхний правый
+            [max_lat, min_lon],  # верхний левый
+            [min_lat, min_lon]   # замыкаем полигон
+        ]
+
+        return polygon
+
+def generate_polygons(polygons_info):
+    """Генерирует полигоны на основе информации о точках"""
+    polygons = {}
+    
+    if not polygons_info or not isinstance(polygons_info, dict):
+        return {}
+    
+    try:
+        for polygon_name, info in polygons_info.items():
+            if not info or not isinstance(info, dict) or 'points' not in info:
+                continue
+                
+            points = np.array(info['points'])
+            
+            if len(points) == 0:
+                polygons[polygon_name] = {
+                    'auditor': info.get('auditor', 'Неизвестно'),
+                    'city': info.get('city', 'Неизвестно'),  # ← ДОБАВЛЕНО
+                    'coordinates': [],
+                    'points_count': 0,
+                    'points': []
+                }
+                continue
+                
+            if len(points) < 2:
+                polygons[polygon_name] = {
+                    'auditor': info.get('auditor', 'Неизвестно'),
+                    'city': info.get('city', 'Неизвестно'),  # ← ДОБАВЛЕНО
+                    'coordinates': [],
+                    'points_count': len(points),
+                    'points': points.tolist()  # ← ДОБАВЛЕНО
+                }
+                continue
+            
+            polygon_coords = create_simple_polygon(points)
+            
+            polygons[polygon_name] = {
+                'auditor': info['auditor'],
+                'city': info.get('city', polygon_name.split('-')[0]),  # ← ДОБАВЛЕНО
+                'coordinates': polygon_coords,
+                'points_count': len(points),
+                'points': points.tolist(),  # ← ДОБАВЛЕНО
+                'workload_hours': info.get('workload_hours')
+            }
+        
+        return polygons
+    except Exception as e:
+        diag.error(f"❌ Ошибка при генерации полигонов: {str(e)}")
+        import traceback
+        diag.error(f"Детали ошибки:\n{traceback.format_exc()}")
+        return {}
+
+# ==============================================
+# ФУНКЦИИ ДЛЯ РАСПРЕДЕЛЕНИЯ ПО НЕДЕЛЯМ
+# ==============================================
+
+def distribute_visits_by_weeks(points_assignment_df, points_df, year, quarter, coefficients):
+    """Распределяет посещения по неделям на основе личных планов аудиторов"""
+    try:
+        # 1. Получаем недели в квартале
+        weeks_info = get_weeks_in_quarter(year, quarter)
+        if not weeks_info:
+            return pd.DataFrame()
+        
+        # 2. Объединяем точки с их аудиторами и планом посещений
+        merged_df = pd.merge(
+            points_df[['ID_Точки', 'Кол-во_посещений', 'Город']],
+            points_assignment_df[['ID_Точки', 'Аудитор', 'Полигон']],
+            on='ID_Точки',
+            how='left'
+        )
+        
+        # 3. Рассчитываем личный план каждого аудитора
+        auditor_plans = merged_df.groupby(['Город', 'Аудитор', 'Полигон'])['Кол-во_посещений'].sum().reset_index()
+        auditor_plans = auditor_plans.rename(columns={'Кол-во_посещений': 'Личный_план'})
+        
+        # 4. Распределяем каждый личный план по неделям
+        weekly_plan = []
+        
+        for _, auditor_row in auditor_plans.iterrows():
+            city = auditor_row['Город']
+            auditor = auditor_row['Аудитор']
+            polygon = auditor_row['Полигон']
+            personal_plan = auditor_row['Личный_план']
+            
+            if personal_plan <= 0:
+                continue
+            
+            # 5. Распределяем личный план аудитора по неделям с учетом коэффициентов
+            weeks_in_quarter = len(weeks_info)
+            
+            # Базовая нагрузка по неделям (равномерно)
+            base_per_week = max(1, personal_plan // weeks_in_quarter)
+            
+            for week_info in weeks_info:
+                iso_week = week_info['iso_week_number']
+                week_index = (iso_week - 1) % 4  # Для коэффициентов (0-3)
+                
+                # Применяем коэффициент
+                coefficient = coefficients[week_index % len(coefficients)]
+                weekly_visits = int(round(base_per_week * coefficient))
+                
+                # Минимум 0 посещений
+                weekly_visits = max(0, weekly_visits)
+                
+                if weekly_visits > 0:
+                    weekly_plan.append({
+                        'Город': city,
+                        'Полигон': polygon,
+                        'Аудитор': auditor,
+                        'ISO_Неделя': iso_week,
+                        'Дата_начала': week_info['start_date'],
+                        'Дата_окончания': week_info['end_date'],
+                        'План_посещений': weekly_visits
+                    })
+        
+        # 6. Создаем DataFrame и корректируем округления
+        result_df = pd.DataFrame(weekly_plan)
+        
+        if not result_df.empty:
+            # Группируем по аудиторам и перераспределяем остаток
+            for (city, auditor), group in result_df.groupby(['Город', 'Аудитор']):
+                # Находим целевой личный план
+                target_plan = auditor_plans[
+                    (auditor_plans['Город'] == city) & 
+                    (auditor_plans['Аудитор'] == auditor)
+                ]['Личный_план'].sum()
+                
+                # Находим текущую сумму в распределении
+                current_sum = group['План_посещений'].sum()
+                
+                # Корректируем разницу
+                difference = target_plan - current_sum
+                
+                if difference != 0:
+                    # Добавляем/убираем разницу у первой недели этого аудитора
+                    first_week_idx = result_df[
+                        (result_df['Город'] == city) & 
+                        (result_df['Аудитор'] == auditor)
+                    ].index[0]
+                    
+                    new_value = result_df.at[first_week_idx, 'План_посещений'] + difference
+                    result_df.at[first_week_idx, 'План_посещений'] = max(0, new_value)
+        
+        # 7. Проверяем итоговую сумму
+        total_expected = points_df['Кол-во_посещений'].sum()
+        total_distributed = result_df['План_посещений'].sum()
+        
+        if total_expected != total_distributed:
+            diag.warning(f"⚠️ Небольшое расхождение в распределении: {total_expected} ≠ {total_distributed}")
+            # Корректируем у первого аудитора
+            if not result_df.empty:
+                result_df.iloc[0, result_df.columns.get_loc('План_посещений')] += (total_expected - total_distributed)
+        
+        return result_df
+        
+    except Exception as e:
+        import traceback
+        diag.error(f"❌ Ошибка при распределении посещений по неделям: {str(e)}")
+        diag.error(f"Детали:\n{traceback.format_exc()}")
+        return pd.DataFrame()
+
+def split_indices_by_sizes(lat, lon, point_idx, target_sizes, depth=0):
+    """
+    Рекурсивно делит точки географически на части заданных размеров.
+    lat, lon - массивы координат PointStore, point_idx - индексы делимых точек.
+    Возвращает список массивов индексов (по одному на каждый размер).
+    """
+    empty = np.array([], dtype=np.int64)
+
+    # БАЗОВЫЕ СЛУЧАИ
+    # 1. Если точек нет или sizes нет
+    if len(point_idx) == 0 or not target_sizes:
+        return [empty for _ in range(len(target_sizes))]
+
+    # 2. Если нужна только одна часть
+    if len(target_sizes) == 1:
+        return [point_idx]
+
+    # 3. Если точек меньше, чем нужно частей - по одной точке в кластер
+    if len(point_idx) <= len(target_sizes):
+        return [
+            point_idx[i:i + 1] if i < len(point_idx) and target_size > 0 else empty
+            for i, target_size in enumerate(target_sizes)
+        ]
+
+    # ОСНОВНАЯ ЛОГИКА
+    # Определяем ось деления
+    axis = 'latitude' if depth % 2 == 0 else 'longitude'
+
+    # Сортируем точки по выбранной оси (север -> юг, запад -> восток)
+    if axis == 'latitude':
+        sorted_idx = point_idx[np.argsort(-lat[point_idx], kind='stable')]
+    else:
+        sorted_idx = point_idx[np.argsort(lon[point_idx], kind='stable')]
+
+    # Разделяем target_sizes на две группы
+    split_index = len(target_sizes) // 2
+    first_sizes = target_sizes[:split_index]
+    second_sizes = target_sizes[split_index:]
+
+    # Точка раздела = сколько точек должно быть в первой группе
+    split_point_idx = max(0, min(sum(first_sizes), len(sorted_idx)))
+    first_part = sorted_idx[:split_point_idx]
+    second_part = sorted_idx[split_point_idx:]
+
+    # Рекурсивно делим только если есть точки
+    if len(first_part) > 0 and first_sizes:
+        first_clusters = split_indices_by_sizes(lat, lon, first_part, first_sizes, depth + 1)
+    else:
+        first_clusters = [empty for _ in range(len(first_sizes))]
+
+    if len(second_part) > 0 and second_sizes:
+        second_clusters = split_indices_by_sizes(lat, lon, second_part, second_sizes, depth + 1)
+    else:
+        second_clusters = [empty for _ in range(len(second_sizes))]
+
+    # Объединяем результаты
+    all_clusters = first_clusters + second_clusters
+
+    # ГАРАНТИРУЕМ, что количество кластеров = len(target_sizes)
+    if len(all_clusters) < len(target_sizes):
+        all_clusters += [empty for _ in range(len(target_sizes) - len(all_clusters))]
+    else:
+        all_clusters = all_clusters[:len(target_sizes)]
+
+    # СОРТИРОВКА КЛАСТЕРОВ ПО ГЕОГРАФИИ
+    cluster_data = []
+    for i, cluster in enumerate(all_clusters):
+        if len(cluster) > 0:
+            centroid_lat = lat[cluster].mean()
+            centroid_lon = lon[cluster].mean()
+        else:
+            # Для пустого кластера используем крайние значения
+            if axis == 'latitude':
+                centroid_lat = -90 if i % 2 == 0 else 90  # чередуем
+                centroid_lon = 0
+            else:
+                centroid_lat = 0
+                centroid_lon = -180 if i % 2 == 0 else 180
+
+        cluster_data.append((cluster, centroid_lat, centroid_lon))
+
+    # Сортируем по оси
+    if axis == 'latitude':
+        cluster_data.sort(key=lambda x: -x[1])
+    else:
+        cluster_data.sort(key=lambda x: x[2])
+
+    return [item[0] for item in cluster_data]
+
+def recursive_geographic_split_by_sizes(points_df, target_sizes, depth=0):
+    """
+    Рекурсивно делит точки географически на части заданных размеров.
+    Обертка над split_indices_by_sizes для DataFrame.
+    """
+    if points_df.empty or 'Широта' not in points_df.columns or 'Долгота' not in points_df.columns:
+        return [pd.DataFrame(columns=points_df.columns) for _ in range(len(target_sizes))]
+
+    lat = pd.to_numeric(points_df['Широта'], errors='coerce').to_numpy(dtype=np.float64)
+    lon = pd.to_numeric(points_df['Долгота'], errors='coerce').to_numpy(dtype=np.float64)
+
+    parts = split_indices_by_sizes(lat, lon, np.arange(len(points_df)), target_sizes, depth)
+    return [points_df.iloc[part].copy() for part in parts]
+
+def _repeat_values(values, counts):
+    """Повторяет значения по длинам групп (для сборки колонок из массивов индексов)"""
+    return np.repeat(np.array(values, dtype=object), counts)
+
+def create_weekly_geographic_clusters(points_assignment_df, points_df, year, quarter, coefficients, store=None):
+    """
+    Создает недельные географические кластеры для каждого аудитора.
+    Использует коэффициенты нагрузки и географическое деление.
+    """
+
+    store = get_point_store(points_df, store)
+    weeks_info = get_weeks_in_quarter(year, quarter)
+
+    if not weeks_info:
+        diag.warning("⚠️ Не удалось получить недели квартала")
+        return pd.DataFrame()
+
+    # Кластеры копим как массивы индексов: (индексы, аудитор, неделя, номер кластера)
+    week_clusters = []
+
+    for auditor, auditor_rows in points_assignment_df.groupby('Аудитор', sort=False):
+        # 1. Находим точки аудитора
+        auditor_idx = store.indices_for_ids(auditor_rows['ID_Точки'])
+
+        if len(auditor_idx) == 0:
+            diag.warning(f"⚠️ Аудитор {auditor}: не найдены точки с координатами")
+            continue
+
+        # 2. Рассчитываем целевые размеры недель
+        total_points = len(auditor_idx)
+        weekly_targets = calculate_weekly_targets(
+            total_points, year, quarter, coefficients
+        )
+
+        # 3. СИНХРОНИЗИРУЕМ: если размеры не совпадают, берем минимум
+        n_weeks_to_use = min(len(weekly_targets), len(weeks_info))
+
+        if n_weeks_to_use == 0:
+            diag.warning(f"⚠️ Аудитор {auditor}: нет недель для распределения")
+            continue
+
+        if len(weekly_targets) != len(weeks_info):
+            diag.warning(f"⚠️ Аудитор {auditor}: недель расчёта {len(weekly_targets)} != календарных {len(weeks_info)}. "
+                      f"Используем {n_weeks_to_use} недель.")
+
+        # Берём только первые n_weeks_to_use недель
+        weekly_targets = weekly_targets[:n_weeks_to_use]
+        weeks_to_use = weeks_info[:n_weeks_to_use]
+
+        # 4. Делим точки географически
+        clusters = split_indices_by_sizes(store.lat, store.lon, auditor_idx, weekly_targets)
+
+        # 5. Назначаем кластеры неделям (пустые недели пропускаем)
+        for week_index, week_info in enumerate(weeks_to_use):
+            if week_index >= len(clusters) or len(clusters[week_index]) == 0:
+                continue
+
+            week_clusters.append((clusters[week_index], auditor, week_info, week_index))
+
+    # Создаём DataFrame
+    if not week_clusters:
+        diag.warning("⚠️ Не удалось создать ни одного кластера")
+        return pd.DataFrame()
+
+    point_idx = np.concatenate([item[0] for item in week_clusters])
+    counts = [len(item[0]) for item in week_clusters]
+
+    result_df = pd.DataFrame({
+        'ID_Точки': store.ids[point_idx],
+        'Аудитор': _repeat_values([item[1] for item in week_clusters], counts),
+        'Неделя': np.repeat([item[2]['iso_week_number'] for item in week_clusters], counts),
+        'Кластер_номер': np.repeat([item[3] for item in week_clusters], counts),
+        'Дата_начала_недели': _repeat_values([item[2]['start_date'] for item in week_clusters], counts),
+        'Дата_окончания_недели': _repeat_values([item[2]['end_date'] for item in week_clusters], counts),
+        'План_посещений': 1
+    })
+
+    # Проверка распределения
+    total_assigned = len(result_df)
+    total_expected = len(points_assignment_df)
+
+    if total_assigned != total_expected:
+        diag.warning(f"⚠️ Распределено {total_assigned} из {total_expected} точек "
+                  f"(разница: {total_expected - total_assigned})")
+        # Можно добавить логику для поиска потерянных точек
+
+    return result_df
+
+def convert_clusters_to_weekly_plan(weekly_clusters_df, points_df, store=None):
+    """
+    Преобразует DataFrame с недельными кластерами в формат weekly plan.
+    Совместимость с существующей системой.
+
+    Возвращает DataFrame в формате detailed_plan_df:
+    ['Город', 'Полигон', 'Аудитор', 'ISO_Неделя',
+     'Дата_начала', 'Дата_окончания', 'План_посещений',
+     'Факт_посещений', '%_выполнения']
+    """
+
+    if weekly_clusters_df.empty:
+        return pd.DataFrame()
+
+    store = get_point_store(points_df, store)
+
+    # 1. Группируем по аудитору и неделе
+    grouped = weekly_clusters_df.groupby([
+        'Аудитор',
+        'Неделя',
+        'Дата_начала_недели',
+        'Дата_окончания_недели'
+    ]).agg({
+        'ID_Точки': 'count',
+        'Кластер_номер': 'first'
+    }).reset_index()
+
+    # 2. Переименовываем для совместимости
+    grouped = grouped.rename(columns={
+        'ID_Точки': 'План_посещений',
+        'Неделя': 'ISO_Неделя',
+        'Дата_начала_недели': 'Дата_начала',
+        'Дата_окончания_недели': 'Дата_окончания'
+    })
+
+    # 3. Добавляем обязательные колонки
+    grouped['Полигон'] = 'Гео-кластер'
+    grouped['Факт_посещений'] = 0
+    grouped['%_выполнения'] = 0.0
+
+    # 4. Определяем город для каждого аудитора
+    # (берем город первой точки аудитора)
+    first_points = weekly_clusters_df.drop_duplicates('Аудитор')
+    first_positions = store.first_positions(first_points['ID_Точки'])
+    cities = store.column('Город', 'Неизвестно')
+    auditor_city = {
+        auditor: cities[position]
+        for auditor, position in zip(first_points['Аудитор'], first_positions)
+        if position >= 0
+    }
+    grouped['Город'] = grouped['Аудитор'].map(auditor_city).fillna('Неизвестно')
+
+    # 5. Упорядочиваем колонки как в оригинальном detailed_plan_df
+    column_order = [
+        'Город',
+        'Полигон',
+        'Аудитор',
+        'ISO_Неделя',
+        'Дата_начала',
+        'Дата_окончания',
+        'План_посещений',
+        'Факт_посещений',
+        '%_выполнения'
+    ]
+
+    return grouped[column_order]
+
+# ==============================================
+# МАТРИЦЫ РАССТОЯНИЙ КЛАСТЕРОВ (КЭШ)
+# ==============================================
+
+# Кластер до стольких точек хранит полную матрицу float32 (2000 точек - 16 МБ)
+DISTANCE_MATRIX_MAX_POINTS = 2000
+# Больший кластер хранит только списки ближайших соседей каждой точки
+DISTANCE_SPARSE_NEIGHBOURS = 16
+# Объем матриц в кэше одного процесса; сверх него вытесняются давно не использованные
+DISTANCE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+class ClusterDistances:
+    """
+    Расстояния между точками одного кластера (x, y в км, см. project_to_km).
+    Небольшой кластер - полная матрица float32, большой - DISTANCE_SPARSE_NEIGHBOURS
+    ближайших соседей каждой точки по пространственному индексу (остальные расстояния
+    считаются по координатам).
+    Точки задаются позициями в кластере.
+    """
+
+    def __init__(self, x, y):
+        self.x = np.ascontiguousarray(x, dtype=np.float64)
+        self.y = np.ascontiguousarray(y, dtype=np.float64)
+        self.n = len(self.x)
+        self.matrix = None
+        self.sparse_neighbours = None
+        self.index = None
+
+        if self.n <= DISTANCE_MATRIX_MAX_POINTS:
+            self.matrix = np.hypot(self.x[:, None] - self.x[None, :],
+                                   self.y[:, None] - self.y[None, :]).astype(np.float32)
+            self.dtype = np.float32
+        else:
+            # Соседи по возрастанию расстояния: первые k - это k ближайших
+            self.index = SpatialIndex(self.x, self.y)
+            neighbours = self.index.knn(DISTANCE_SPARSE_NEIGHBOURS)
+            rows = np.arange(self.n)[:, None]
+            order = np.argsort(self.between(rows, neighbours), axis=1, kind='stable')
+            self.sparse_neighbours = np.take_along_axis(neighbours, order, axis=1)
+            self.dtype = np.float64
+
+    @property
+    def nbytes(self):
+        # Индекс хранит те же массивы x, y - они учтены в его размере
+        total = self.index.nbytes if self.index is not None else self.x.nbytes + self.y.nbytes
+        if self.matrix is not None:
+            total += self.matrix.nbytes
+        if self.sparse_neighbours is not None:
+            total += self.sparse_neighbours.nbytes
+        return total
+
+    def between(self, a, b):
+        """Расстояния между точками a и b (числа или массивы позиций), float64"""
+        if self.matrix is not None:
+            return self.matrix[a, b].astype(np.float64)
+        return np.hypot(self.x[a] - self.x[b], self.y[a] - self.y[b])
+
+    def row(self, a):
+        """Расстояния от точки a до всех точек кластера (только для чтения)"""
+        if self.matrix is not None:
+            return self.matrix[a]
+        return np.hypot(self.x - self.x[a], self.y - self.y[a])
+
+    def neighbours(self, k):
+        """k ближайших соседей каждой точки - массив (n, k) позиций"""
+        k = min(k, self.n - 1)
+        if k <= 0:
+            return np.empty((self.n, 0), dtype=np.int64)
+        if self.matrix is None:
+            if k <= self.sparse_neighbours.shape[1]:
+                return self.sparse_neighbours[:, :k]
+            return self.index.knn(k)
+
+        masked = self.matrix.copy()
+        np.fill_diagonal(masked, np.inf)
+        return np.argpartition(masked, k - 1, axis=1)[:, :k].astype(np.int64)
+
+    def route_length(self, route):
+        """Длина маршрута (без возврата в начало) для порядка обхода route"""
+        if len(route) < 2:
+            return 0.0
+        return float(self.between(route[:-1], route[1:]).sum())
+
+class DistanceMatrixCache:
+    """
+    LRU-кэш ClusterDistances в памяти процесса. Ключ - состав кластера (хэш координат
+    его точек по порядку), поэтому повторные построения и улучшения маршрутов тех же
+    дней не пересчитывают расстояния. Общий объем - не больше max_bytes.
+    У каждого рабочего процесса parallel_map свой кэш: повторный расчет дня
+    берет расстояния из кэша, только если попал в тот же процесс.
+    """
+
+    def __init__(self, max_bytes=DISTANCE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(x, y):
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+        hasher.update(np.ascontiguousarray(y, dtype=np.float64).tobytes())
+        return hasher.digest()
+
+    def get(self, x, y):
+        """Расстояния кластера с координатами x, y (из кэша или новые)"""
+        key = self.key(x, y)
+        with self._lock:
+            distances = self.entries.pop(key, None)
+            if distances is not None:
+                # Последний использованный - в конец очереди вытеснения
+                self.entries[key] = distances
+                self.hits += 1
+                return distances
+
+        distances = ClusterDistances(x, y)
+
+        with self._lock:
+            self.misses += 1
+            if key not in self.entries:
+                self.entries[key] = distances
+                self.nbytes += distances.nbytes
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                evicted = self.entries.pop(next(iter(self.entries)))
+                self.nbytes -= evicted.nbytes
+        return distances
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+_distance_cache = DistanceMatrixCache()
+
+def cluster_distances(x, y):
+    """Расстояния между точками кластера (x, y в км) из кэша процесса"""
+    return _distance_cache.get(x, y)
+
+# ==============================================
+# УЛУЧШЕНИЕ МАРШРУТОВ (2-OPT / OR-OPT)
+# ==============================================
+
+# Сколько ближайших соседей точки просматривается при поиске улучшающих ходов
+ROUTE_IMPROVE_NEIGHBOURS = 8
+# Бюджет улучшения одного маршрута: число ходов и время (секунды)
+ROUTE_IMPROVE_MAX_MOVES = 1000
+ROUTE_IMPROVE_MAX_SECONDS = 0.5
+# Длины участков, которые Or-opt переносит в другое место маршрута
+OR_OPT_SEGMENT_LENGTHS = (1, 2, 3)
+# Ход применяется, только если укорачивает маршрут больше чем на эту величину
+ROUTE_IMPROVE_EPSILON = 1e-12
+
+class _RouteMoves:
+    """
+    Оценка ходов 2-opt и Or-opt для текущего порядка обхода.
+    Кандидаты - пары (точка, ее ближайший сосед): новое ребро хода соединяет соседей.
+    Все ходы одного вида оцениваются одним векторным расчетом.
+    """
+
+    def __init__(self, distances, neighbours):
+        self.distances = distances
+        self.n = distances.n
+        self.u = np.repeat(np.arange(self.n), neighbours.shape[1])
+        self.v = neighbours.ravel()
+
+    def dist(self, a, b):
+        """Расстояния между точками маршрута на позициях a и b"""
+        return self.distances.between(self.route[a], self.route[b])
+
+    def edge(self, a, b, valid):
+        """Длина ребра a-b, 0 там, где ребра нет (конец маршрута)"""
+        last = self.n - 1
+        return np.where(valid, self.dist(np.clip(a, 0, last), np.clip(b, 0, last)), 0.0)
+
+    def best(self, route, position):
+        """Лучший ход для порядка route: (изменение длины, ход) или (0, None)"""
+        self.route = route
+        p, q = position[self.u], position[self.v]
+        best_delta, best_move = 0.0, None
+        for delta, move in [self._two_opt(p, q)] + [self._or_opt(p, q, length) for length in OR_OPT_SEGMENT_LENGTHS]:
+            if delta is not None and delta < best_delta:
+                best_delta, best_move = delta, move
+        return best_delta, best_move
+
+    def _two_opt(self, p, q):
+        """
+        2-opt: разворот участка маршрута. Для пары позиций lo < hi соседних точек
+        разворот [lo+1..hi] или [lo..hi-1] делает их соседями в маршруте.
+        """
+        n = self.n
+        lo, hi = np.minimum(p, q), np.maximum(p, q)
+        joined = self.dist(lo, hi)
+
+        # Разворот [lo+1..hi]: ребра (lo, lo+1), (hi, hi+1) -> (lo, hi), (lo+1, hi+1)
+        has_right = hi < n - 1
+        delta_a = (joined - self.dist(lo, lo + 1) + self.edge(lo + 1, hi + 1, has_right)
+                   - self.edge(hi, hi + 1, has_right))
+        delta_a[hi <= lo + 1] = np.inf
+
+        # Разворот [lo..hi-1]: ребра (lo-1, lo), (hi-1, hi) -> (lo-1, hi-1), (lo, hi)
+        has_left = lo > 0
+        delta_b = (joined - self.dist(hi - 1, hi) + self.edge(lo - 1, hi - 1, has_left)
+                   - self.edge(lo - 1, lo, has_left))
+        delta_b[hi - 1 <= lo] = np.inf
+
+        deltas = np.concatenate([delta_a, delta_b])
+        if len(deltas) == 0:
+            return None, None
+        k = int(deltas.argmin())
+        if k < len(delta_a):
+            return deltas[k], ('2-opt', int(lo[k]) + 1, int(hi[k]))
+        k_b = k - len(delta_a)
+        return deltas[k], ('2-opt', int(lo[k_b]), int(hi[k_b]) - 1)
+
+    def _or_opt(self, p, q, length):
+        """
+        Or-opt: перенос участка из length точек (прямо или развернутым) в другой
+        промежуток маршрута - к ближайшему соседу его первой или последней точки.
+        Промежуток g - между позициями g и g+1 (-1 - перед началом, n-1 - после конца).
+        """
+        n = self.n
+        if n <= length + 1:
+            return None, None
+
+        # Начало участка: точка u - первая (start = p) или последняя (start = p - length + 1)
+        starts, gaps, reverse = [], [], []
+        for start, forward_gap, reverse_gap in [
+            (p, q, q - 1),                   # u - первая точка: после соседа или развернутым перед ним
+            (p - length + 1, q - 1, q)       # u - последняя точка: перед соседом или развернутым после него
+        ]:
+            starts += [start, start]
+            gaps += [forward_gap, reverse_gap]
+            reverse += [np.zeros(len(p), dtype=bool), np.ones(len(p), dtype=bool)]
+        start = np.concatenate(starts)
+        gap = np.concatenate(gaps)
+        reverse = np.concatenate(reverse)
+        end = start + length - 1
+
+        valid = (start >= 0) & (end <= n - 1) & (gap >= -1) & (gap <= n - 1) & ((gap < start - 1) | (gap > end))
+        if not valid.any():
+            return None, None
+        start, gap, reverse, end = start[valid], gap[valid], reverse[valid], end[valid]
+
+        # Выигрыш от удаления участка: ребра (start-1, start), (end, end+1) -> (start-1, end+1)
+        has_prev, has_next = start > 0, end < n - 1
+        removed = (self.edge(start - 1, start, has_prev) + self.edge(end, end + 1, has_next)
+                   - self.edge(start - 1, end + 1, has_prev & has_next))
+
+        # Стоимость вставки в промежуток (gap, gap+1): левый конец участка - к gap, правый - к gap+1
+        left = np.where(reverse, end, start)
+        right = np.where(reverse, start, end)
+        has_before, has_after = gap >= 0, gap < n - 1
+        inserted = (self.edge(gap, left, has_before) + self.edge(right, gap + 1, has_after)
+                    - self.edge(gap, gap + 1, has_before & has_after))
+
+        deltas = inserted - removed
+        k = int(deltas.argmin())
+        return deltas[k], ('or-opt', int(start[k]), int(end[k]), int(gap[k]), bool(reverse[k]))
+
+def _apply_route_move(route, move):
+    """Новый порядок обхода после хода 2-opt или Or-opt"""
+    if move[0] == '2-opt':
+        _, i, j = move
+        route = route.copy()
+        route[i:j + 1] = route[i:j + 1][::-1]
+        return route
+
+    _, start, end, gap, reverse = move
+    segment = route[start:end + 1]
+    if reverse:
+        segment = segment[::-1]
+    rest = np.concatenate([route[:start], route[end + 1:]])
+    # Промежуток после удаления участка сдвигается, если он был правее участка
+    insert_at = gap + 1 if gap < start else gap - len(segment) + 1
+    return np.concatenate([rest[:insert_at], segment, rest[insert_at:]])
+
+def improve_route(distances, route, max_moves=ROUTE_IMPROVE_MAX_MOVES, max_seconds=ROUTE_IMPROVE_MAX_SECONDS):
+    """
+    Улучшает маршрут ходами 2-opt и Or-opt (каждый раз - лучший ход среди ближайших
+    соседей), пока ходы укорачивают маршрут и не исчерпан бюджет (ходы, секунды).
+    distances - расстояния кластера (ClusterDistances), route - порядок обхода всех его точек.
+    Возвращает (новый порядок, длина до, длина после).
+    """
+    route = np.asarray(route, dtype=np.int64)
+    length_before = distances.route_length(route)
+    if len(route) < 4:
+        return route, length_before, length_before
+
+    moves = _RouteMoves(distances, distances.neighbours(ROUTE_IMPROVE_NEIGHBOURS))
+    position = np.empty_like(route)
+    deadline = time.monotonic() + max_seconds
+
+    for _ in range(max_moves):
+        position[route] = np.arange(len(route))
+        delta, move = moves.best(route, position)
+        if move is None or delta >= -ROUTE_IMPROVE_EPSILON or time.monotonic() > deadline:
+            break
+        route = _apply_route_move(route, move)
+
+    return route, length_before, distances.route_length(route)
+
+def _week_day_routes_task(task):
+    """
+    Задача пула: (x, y в км, улучшать ли маршруты) точек недели аудитора ->
+    (маршруты 5 рабочих дней, длина маршрутов до улучшения, после улучшения).
+    Неделя делится на 5 географических суб-кластеров, внутри дня - жадный маршрут,
+    затем (если включено) 2-opt / Or-opt.
+    Маршрут - массив позиций во входных массивах (пустой, если день без точек).
+    """
+    x, y, improve = task
+
+    # Вычисляем размеры для каждого дня
+    n_points = len(x)
+    base_size = n_points // 5
+    remainder = n_points % 5
+
+    daily_targets = [base_size] * 5
+    for i in range(remainder):
+        daily_targets[i] += 1
+
+    # Делим географически (y растет с широтой, x - с долготой)
+    daily_clusters = split_indices_by_sizes(y, x, np.arange(n_points, dtype=np.int64), daily_targets)
+
+    routes = []
+    length_before = length_after = 0.0
+    for day_cluster in daily_clusters:
+        if len(day_cluster) == 0:
+            routes.append(day_cluster)
+            continue
+
+        # Расстояния дня считаются один раз: жадный маршрут и улучшение используют их вместе
+        distances = cluster_distances(x[day_cluster], y[day_cluster])
+
+        # Строим оптимальный маршрут внутри дня
+        try:
+            order = WeeklyRouteOptimizer.greedy_permutation(distances)
+        except:
+            # Если оптимизация не сработала, используем исходный порядок
+            order = np.arange(len(day_cluster), dtype=np.int64)
+
+        if improve:
+            order, before, after = improve_route(distances, order)
+            length_before += before
+            length_after += after
+
+        routes.append(day_cluster[order])
+
+    return routes, length_before, length_after
+
+def create_geographic_daily_routes(points_df, weekly_clusters_df, store=None, improve=False):
+    """
+    Создает ежедневные маршруты на основе недельных географических кластеров.
+    Каждая неделя делится на 5 географических суб-кластеров (дней).
+    improve - улучшать жадные маршруты ходами 2-opt / Or-opt (improve_route).
+    """
+
+    if weekly_clusters_df.empty:
+        return pd.DataFrame()
+
+    store = get_point_store(points_df, store)
+    days_of_week = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница']
+
+    # Маршруты копим как массивы индексов: (индексы, аудитор, день, неделя, дата начала)
+    day_routes = []
+
+    # 1. Группируем по аудиторам и неделям: строки групп - одним проходом (порядок групп как у groupby)
+    grouped = weekly_clusters_df.groupby(['Аудитор', 'Неделя'])
+    group_keys = grouped.size().index
+    group_codes = grouped.ngroup().to_numpy()
+    row_order = np.argsort(group_codes, kind='stable')
+    bounds = np.searchsorted(group_codes[row_order], np.arange(len(group_keys) + 1))
+
+    week_point_ids = weekly_clusters_df['ID_Точки'].to_numpy(dtype=object)
+    week_start_dates = weekly_clusters_df['Дата_начала_недели'].to_numpy(dtype=object)
+
+    # 2. Получаем все точки каждой недели у каждого аудитора
+    weeks = []
+    for code, (auditor, week_num) in enumerate(group_keys):
+        rows = row_order[bounds[code]:bounds[code + 1]]
+        week_idx = store.indices_for_ids(week_point_ids[rows])
+
+        if len(week_idx) == 0:
+            continue
+
+        weeks.append((week_idx, auditor, week_num, rows[0]))
+
+    # 3. Делим недели на дни и строим маршруты (недели независимы - параллельно,
+    # в рабочий процесс уходят только координаты точек недели)
+    week_day_routes = parallel_map(
+        _week_day_routes_task,
+        [(store.x_km[week_idx], store.y_km[week_idx], improve) for week_idx, *_ in weeks],
+        [len(week_idx) for week_idx, *_ in weeks]
+    )
+
+    if improve and week_day_routes:
+        length_before = sum(item[1] for item in week_day_routes)
+        length_after = sum(item[2] for item in week_day_routes)
+        saved = (1 - length_after / length_before) * 100 if length_before > 0 else 0.0
+        diag.info(f"📏 Маршруты улучшены (2-opt / Or-opt): суммарная длина "
+                  f"{length_before:.1f} → {length_after:.1f} км (−{saved:.1f}%)")
+
+    for (week_idx, auditor, week_num, first_row), (local_routes, _, _) in zip(weeks, week_day_routes):
+        # 4. Получаем дату начала недели (понедельник)
+        try:
+            start_date = week_start_dates[first_row]
+            if hasattr(start_date, 'strftime'):
+                date_str = start_date.strftime('%Y%m%d')
+            else:
+                date_str = str(start_date).replace('-', '')[:8]
+        except:
+            date_str = f"2025{week_num:02d}01"  # fallback
+
+        # 5. Назначаем дни недели (понедельник-пятница)
+        for local_route, day_name in zip(local_routes, days_of_week):
+            if len(local_route) == 0:
+                continue
+
+            day_routes.append((week_idx[local_route], auditor, day_name, week_num, date_str))
+
+    if not day_routes:
+        return pd.DataFrame()
+
+    # 7. Собираем результат в формате EasyMerch одним проходом по массивам
+    point_idx = np.concatenate([item[0] for item in day_routes])
+    counts = [len(item[0]) for item in day_routes]
+    day_names = _repeat_values([item[2] for item in day_routes], counts)
+
+    if 'Название_Точки' in store.frame.columns:
+        names = store.column('Название_Точки')[point_idx]
+    else:
+        names = store.ids[point_idx]
+
+    routes_df = pd.DataFrame({
+        'ID_Точки': store.ids[point_idx],
+        'Address': store.column('Адрес')[point_idx],
+        'L1 Name': names,
+        'ЧИСЛО визитов в НЕДЕЛЮ': 1,
+        'Login пользователя': _repeat_values([item[1] for item in day_routes], counts)
+    })
+
+    # Отметки для дней недели
+    for day_col in ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']:
+        marks = np.full(len(point_idx), '', dtype=object)
+        marks[day_names == day_col] = 1
+        routes_df[day_col] = marks
+
+    routes_df['Вне графика'] = ''
+    routes_df['Цикл посещения'] = np.repeat([item[3] for item in day_routes], counts)
+    routes_df['Дата начала цикла посещения'] = _repeat_values([item[4] for item in day_routes], counts)
+    routes_df['Широта'] = [f"{value:.6f}" for value in store.lat[point_idx].tolist()]
+    routes_df['Долгота'] = [f"{value:.6f}" for value in store.lon[point_idx].tolist()]
+    routes_df['Город'] = store.column('Город')[point_idx]
+
+    # Упорядочиваем колонки
+    column_order = [
+        'ID_Точки',
+        'Address',
+        'L1 Name',
+        'ЧИСЛО визитов в НЕДЕЛЮ',
+        'Login пользователя',
+        'Понедельник',
+        'Вторник',
+        'Среда',
+        'Четверг',
+        'Пятница',
+        'Суббота',
+        'Воскресенье',
+        'Вне графика',
+        'Цикл посещения',
+        'Дата начала цикла посещения',
+        'Широта',
+        'Долгота',
+        'Город'
+    ]
+
+    # Оставляем только существующие колонки
+    column_order = [col for col in column_order if col in routes_df.columns]
+
+    return routes_df[column_order]
+
+
+# ==============================================
+# ПУЛ ПРОЦЕССОВ ДЛЯ НЕЗАВИСИМЫХ ЧАСТЕЙ РАСЧЕТА
+# ==============================================
+
+# Процессов в пуле (города и недели аудиторов считаются параллельно)
+PARALLEL_WORKERS = max(1, os.cpu_count() or 1)
+# Меньше точек - считаем в текущем процессе: запуск пула и передача массивов дороже расчета
+PARALLEL_MIN_POINTS = 20000
+
+_parallel_pool = None
+_parallel_pool_pid = None
+_parallel_pool_lock = threading.Lock()
+
+def get_parallel_pool():
+    """
+    Пул процессов (создается при первом обращении).
+    Процесс, созданный через fork (например, рабочий процесс фонового расчета),
+    не может пользоваться пулом родителя и заводит свой.
+    """
+    global _parallel_pool, _parallel_pool_pid
+    with _parallel_pool_lock:
+        if _parallel_pool is None or _parallel_pool_pid != os.getpid():
+            # spawn, а не fork: у процесса уже есть потоки (Streamlit, служебные потоки
+            # пулов), копия чужой блокировки в fork-процессе может его подвесить
+            _parallel_pool = ProcessPoolExecutor(
+                max_workers=PARALLEL_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            _parallel_pool_pid = os.getpid()
+            # При выходе процесса multiprocessing ждет свои дочерние процессы - пул закрываем
+            # раньше очередей пула, иначе рабочий процесс фонового расчета не завершится
+            multiprocessing.util.Finalize(_parallel_pool, _parallel_pool.shutdown, exitpriority=100)
+        return _parallel_pool
+
+def _reset_parallel_pool():
+    """Сбрасывает сломанный пул (упал рабочий процесс) - следующий вызов создаст новый"""
+    global _parallel_pool
+    with _parallel_pool_lock:
+        if _parallel_pool is not None and _parallel_pool_pid == os.getpid():
+            _parallel_pool.shutdown(wait=False, cancel_futures=True)
+        _parallel_pool = None
+
+def parallel_map(func, tasks, sizes):
+    """
+    func(задача) для каждой задачи, результаты - в порядке задач.
+    sizes - объем каждой задачи (число точек): крупные задачи уходят в пул первыми,
+    а при малом общем объеме, одной задаче или одном процессе расчет идет в текущем процессе.
+    func и задачи должны передаваться в другой процесс (функция уровня модуля, массивы NumPy).
+    """
+    tasks = list(tasks)
+    if PARALLEL_WORKERS <= 1 or len(tasks) <= 1 or sum(sizes) < PARALLEL_MIN_POINTS:
+        return [func(task) for task in tasks]
+
+    order = np.argsort(-np.asarray(sizes, dtype=np.int64), kind='stable')
+    chunksize = max(1, len(tasks) // (PARALLEL_WORKERS * 4))
+    try:
+        ordered_results = list(get_parallel_pool().map(func, [tasks[i] for i in order], chunksize=chunksize))
+    except (BrokenProcessPool, OSError) as e:
+        logger.warning(f"Пул процессов недоступен, расчет в текущем процессе: {e}")
+        _reset_parallel_pool()
+        return [func(task) for task in tasks]
+
+    results = [None] * len(tasks)
+    for position, result in zip(order, ordered_results):
+        results[position] = result
+    return results
+
+# ==============================================
+# КЛАСТЕРИЗАЦИЯ С ОГРАНИЧЕНИЕМ РАЗМЕРА (KMEANS + ПЕРЕНАЗНАЧЕНИЕ)
+# ==============================================
+
+# С этого числа точек центры ищет MiniBatchKMeans (быстрее на десятках тысяч точек)
+KMEANS_MINIBATCH_MIN_POINTS = 10000
+KMEANS_N_INIT = 3
+KMEANS_RANDOM_STATE = 42
+# Сколько раз пересчитываются центры после назначения с учетом емкости
+KMEANS_MAX_ITERATIONS = 10
+
+def kmeans_centers(x, y, n_clusters, weights=None):
+    """
+    Начальные центры кластеров (x, y в км): KMeans / MiniBatchKMeans,
+    без scikit-learn - центры зон balanced_territories.
+    """
+    coords = np.column_stack([x, y])
+    if SKLEARN_AVAILABLE:
+        if len(coords) >= KMEANS_MINIBATCH_MIN_POINTS:
+            model = MiniBatchKMeans(n_clusters=n_clusters, n_init=KMEANS_N_INIT,
+                                    random_state=KMEANS_RANDOM_STATE, batch_size=4096)
+        else:
+            model = KMeans(n_clusters=n_clusters, n_init=KMEANS_N_INIT, random_state=KMEANS_RANDOM_STATE)
+        model.fit(coords, sample_weight=weights)
+        return model.cluster_centers_
+
+    parts = balanced_territories(x, y, n_clusters, weights)
+    return np.array([coords[part].mean(axis=0) if len(part) else coords.mean(axis=0) for part in parts])
+
+def _assign_with_capacity(coords, centers, weights, capacity):
+    """
+    Назначает точки ближайшему центру, у которого осталась емкость. Первыми идут точки,
+    которые больше всего теряют, попав не в ближайший кластер (разница расстояний
+    до второго и первого центров). Точка, не помещающаяся никуда, идет в кластер
+    с наибольшим остатком емкости.
+    """
+    squared = ((coords[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+    preference = np.argsort(squared, axis=1, kind='stable')
+    nearest = np.take_along_axis(squared, preference[:, :2], axis=1)
+    order = np.argsort(nearest[:, 0] - nearest[:, 1], kind='stable')
+
+    labels = np.empty(len(coords), dtype=np.int64)
+    remaining = capacity.astype(np.float64).tolist()
+    point_weights = weights.tolist()
+    preferences = preference.tolist()
+    for point in order.tolist():
+        weight = point_weights[point]
+        for cluster in preferences[point]:
+            if remaining[cluster] >= weight - 1e-9:
+                break
+        else:
+            cluster = int(np.argmax(remaining))
+        labels[point] = cluster
+        remaining[cluster] -= weight
+    return labels
+
+def size_constrained_clusters(x, y, sizes, weights=None, centers=None, max_iterations=KMEANS_MAX_ITERATIONS):
+    """
+    Кластеризация с ограничением размера: центры из KMeans (или заданные centers),
+    затем точки назначаются с учетом емкости кластеров и центры пересчитываются,
+    пока назначение меняется.
+    x, y - координаты в км, sizes - емкость кластеров в единицах weights
+    (по умолчанию - число точек, тогда сумма sizes должна быть не меньше числа точек).
+    Возвращает метки кластеров - массив длины n.
+    """
+    n, n_clusters = len(x), len(sizes)
+    if n == 0 or n_clusters <= 1:
+        return np.zeros(n, dtype=np.int64)
+
+    weights = np.ones(n, dtype=np.float64) if weights is None else np.asarray(weights, dtype=np.float64)
+    coords = np.column_stack([x, y]).astype(np.float64)
+    capacity = np.asarray(sizes, dtype=np.float64)
+
+    if centers is None:
+        if n <= n_clusters:
+            # Точек не больше, чем кластеров - по точке в кластер
+            return np.arange(n, dtype=np.int64)
+        centers = kmeans_centers(coords[:, 0], coords[:, 1], n_clusters, weights)
+    centers = np.array(centers, dtype=np.float64)
+
+    labels = None
+    for _ in range(max_iterations):
+        new_labels = _assign_with_capacity(coords, centers, weights, capacity)
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+        # Новые центры - взвешенные средние точек кластера (пустой кластер сохраняет центр)
+        totals = np.bincount(labels, weights=weights, minlength=n_clusters)
+        filled = totals > 0
+        for axis in range(2):
+            sums = np.bincount(labels, weights=weights * coords[:, axis], minlength=n_clusters)
+            centers[filled, axis] = sums[filled] / totals[filled]
+    return labels
+
+# ==============================================
+
+def get_service_minutes(service_minutes=None):
+    """Время визита по типам точек (минуты): заданные значения поверх DEFAULT_SERVICE_MINUTES"""
+    service_minutes = service_minutes or {}
+    return {
+        point_type: float(service_minutes.get(point_type, minutes))
+        for point_type, minutes in DEFAULT_SERVICE_MINUTES.items()
+    }
+
+def point_workload_minutes(store, service_minutes=None):
+    """Нагрузка точек (минуты за квартал): число посещений x время визита по типу точки"""
+    service_minutes = get_service_minutes(service_minutes)
+    default_minutes = service_minutes[DEFAULT_POINT_TYPE]
+    type_minutes = np.array(
+        [service_minutes.get(str(point_type), default_minutes) for point_type in store.types] + [default_minutes],
+        dtype=np.float64
+    )
+    # Код -1 (тип не указан) попадает на последний элемент - время типа по умолчанию
+    return store.visits * type_minutes[store.type_codes]
+
+def auditor_capacities(auditors_df, city, city_auditors):
+    """
+    Емкость аудиторов города city (часов в неделю) в порядке city_auditors - из строки
+    аудитора этого города (у аудитора нескольких городов емкость в каждом своя).
+    Не указанная емкость - средняя по городу; без колонки емкости - None.
+    """
+    if AUDITOR_CAPACITY_COLUMN not in auditors_df.columns:
+        return None
+    city_rows = auditors_df[auditors_df['Город'].astype(str) == str(city)]
+    capacity = city_rows.drop_duplicates('ID_Сотрудника').set_index('ID_Сотрудника')[AUDITOR_CAPACITY_COLUMN]
+    values = pd.to_numeric(capacity.reindex(city_auditors), errors='coerce').to_numpy(dtype=np.float64)
+    values[~(values > 0)] = np.nan
+    if np.isnan(values).all():
+        return None
+    return np.where(np.isnan(values), np.nanmean(values), values)
+
+def calculate_auditor_workload(polygons_info, weeks=None):
+    """
+    Прогноз нагрузки аудиторов по полигонам распределения:
+    Город, Полигон, Аудитор, Точек, Посещений, Нагрузка_ч (часы за квартал).
+    Если у аудиторов указана емкость и задано число недель квартала weeks - также
+    Часов_в_неделю, Емкость_ч (за квартал) и Загрузка_% (нагрузка / емкость).
+    """
+    columns = ['Город', 'Полигон', 'Аудитор', 'Точек', 'Посещений', 'Нагрузка_ч']
+    rows = [
+        {
+            'Город': info.get('city'),
+            'Полигон': polygon_name,
+            'Аудитор': info.get('auditor'),
+            'Точек': len(info.get('points', [])),
+            'Посещений': info.get('visits'),
+            'Нагрузка_ч': info.get('workload_hours'),
+            'Часов_в_неделю': info.get('capacity_week_hours')
+        }
+        for polygon_name, info in (polygons_info or {}).items()
+        if isinstance(info, dict) and info.get('workload_hours') is not None
+    ]
+    workload_df = pd.DataFrame(rows, columns=columns + ['Часов_в_неделю'])
+
+    if not weeks or workload_df['Часов_в_неделю'].isna().all():
+        return workload_df[columns]
+
+    capacity_hours = pd.to_numeric(workload_df['Часов_в_неделю'], errors='coerce') * weeks
+    workload_df['Емкость_ч'] = capacity_hours.round(1)
+    workload_df['Загрузка_%'] = (workload_df['Нагрузка_ч'] / capacity_hours * 100).round(1)
+    return workload_df
+
+def weighted_cut(weights, share):
+    """
+    Сколько первых точек взять, чтобы их нагрузка была ближе всего к доле share
+    общей нагрузки (при двух и более точках - хотя бы одну с каждой стороны)
+    """
+    n = len(weights)
+    if n == 0:
+        return 0
+    cumulative = np.cumsum(weights)
+    target = cumulative[-1] * share
+    cut = int(np.searchsorted(cumulative, target))
+    if cut < n and (cut == 0 or cumulative[cut] - target <= target - cumulative[cut - 1]):
+        cut += 1
+    if n > 1:
+        cut = min(max(cut, 1), n - 1)
+    return cut
+
+def balanced_territories(x, y, n_parts, weights=None, shares=None):
+    """
+    Делит точки на n_parts компактных территорий рекурсивной бисекцией: точки режутся
+    поперек более длинной стороны охватывающего прямоугольника так, чтобы нагрузка
+    по обе стороны разреза была пропорциональна долям территорий этой стороны.
+    x, y - координаты в км, weights - нагрузка точек (по умолчанию - 1 на точку,
+    размеры территорий тогда как у np.array_split), shares - доли территорий.
+    Возвращает список массивов позиций (север раньше юга, запад раньше востока).
+    """
+    n = len(x)
+    if weights is None:
+        weights = np.ones(n, dtype=np.float64)
+        if shares is None:
+            shares = [len(part) for part in np.array_split(np.arange(n), n_parts)]
+    if shares is None:
+        shares = [1.0] * n_parts
+    weights = np.asarray(weights, dtype=np.float64)
+    shares = np.asarray(shares, dtype=np.float64)
+
+    def split(positions, part_shares):
+        if len(part_shares) == 1:
+            return [positions]
+        if len(positions) == 0:
+            return [positions for _ in part_shares]
+
+        # Режем поперек более длинной стороны: по y - с севера, по x - с запада
+        extent_x = np.ptp(x[positions])
+        extent_y = np.ptp(y[positions])
+        keys = -y[positions] if extent_y >= extent_x else x[positions]
+        positions = positions[np.argsort(keys, kind='stable')]
+
+        # Разрез - там, где накопленная нагрузка ближе всего к доле первой половины
+        half = len(part_shares) // 2
+        cut = weighted_cut(weights[positions], part_shares[:half].sum() / part_shares.sum())
+
+        return split(positions[:cut], part_shares[:half]) + split(positions[cut:], part_shares[half:])
+
+    return split(np.arange(n, dtype=np.int64), shares)
+
+def divide_points_by_direction(store, point_idx, n_auditors, city, weights=None, shares=None):
+    """
+    Разделяет точки на географические полигоны с равной нагрузкой.
+    point_idx - индексы точек города в PointStore, weights - нагрузка точек (по индексам
+    PointStore, по умолчанию - 1 на точку), shares - доли нагрузки полигонов (емкость
+    аудиторов, по умолчанию поровну). Возвращает список массивов индексов
+    """
+    if n_auditors == 1:
+        return [point_idx]
+
+    if n_auditors <= 0 or len(point_idx) == 0:
+        return []
+
+    # Для воспроизводимости сортируем по ID
+    point_idx = point_idx[np.argsort(store.ids[point_idx], kind='stable')]
+    lat = store.lat[point_idx]
+    lon = store.lon[point_idx]
+    point_weights = np.ones(len(point_idx)) if weights is None else np.asarray(weights, dtype=np.float64)[point_idx]
+    if point_weights.sum() <= 0:
+        # Нагрузки нет (нет плановых посещений) - делим поровну по числу точек
+        point_weights = np.ones(len(point_idx))
+    shares = np.ones(n_auditors) if shares is None else np.asarray(shares, dtype=np.float64)
+
+    def share(first, second):
+        """Доля полигонов first в нагрузке полигонов first + second"""
+        return shares[list(first)].sum() / shares[list(first) + list(second)].sum()
+
+    def split_north_south(order, share):
+        """Позиции по убыванию широты: (север с долей нагрузки share, юг)"""
+        order = order[np.argsort(-lat[order], kind='stable')]
+        cut = weighted_cut(point_weights[order], share)
+        return order[:cut], order[cut:]
+
+    def split_west_east(order, share):
+        """Позиции по возрастанию долготы: (запад с долей нагрузки share, восток)"""
+        order = order[np.argsort(lon[order], kind='stable')]
+        cut = weighted_cut(point_weights[order], share)
+        return order[:cut], order[cut:]
+
+    positions = np.arange(len(point_idx))
+
+    if n_auditors == 2:
+        # Север-Юг: по широте
+        north, south = split_north_south(positions, share([0], [1]))
+        return [point_idx[north], point_idx[south]]
+
+    elif n_auditors == 3:
+        # Север - самые северные точки (треть нагрузки при равной емкости),
+        # остальное - Юго-Восток и Юго-Запад по долготе
+        north, south = split_north_south(positions, share([0], [1, 2]))
+        southwest, southeast = split_west_east(south, share([2], [1]))
+        return [point_idx[north], point_idx[southeast], point_idx[southwest]]
+
+    elif n_auditors == 4:
+        # Север-Восток-Юг-Запад: половины по широте, каждая - пополам по долготе
+        north, south = split_north_south(positions, share([0, 3], [1, 2]))
+        northwest, northeast = split_west_east(north, share([3], [0]))
+        southwest, southeast = split_west_east(south, share([2], [1]))
+
+        # Возвращаем в порядке: Север (СВ), Восток (ЮВ), Юг (ЮЗ), Запад (СЗ)
+        return [point_idx[northeast], point_idx[southeast], point_idx[southwest], point_idx[northwest]]
+
+    else:
+        # Больше 4 аудиторов - компактные зоны с равной нагрузкой
+        x, y = project_to_km(lat, lon)
+        return [point_idx[part] for part in balanced_territories(x, y, n_auditors, weights=point_weights, shares=shares)]
+
+
+class CityPoints:
+    """
+    Координаты точек одного города (вместо PointStore в рабочем процессе пула):
+    в процесс передаются только массивы ID, широт и долгот города.
+    """
+
+    def __init__(self, ids, lat, lon):
+        self.ids = ids
+        self.lat = lat
+        self.lon = lon
+
+def _divide_city_task(task):
+    """
+    Задача пула: (ID, широты, долготы, нагрузка, доли аудиторов) точек города ->
+    группы позиций точек внутри города (см. divide_points_by_direction)
+    """
+    ids, lat, lon, weights, shares = task
+    city_points = CityPoints(ids, lat, lon)
+    return divide_points_by_direction(city_points, np.arange(len(ids), dtype=np.int64), len(shares), None,
+                                      weights, shares)
+
+def divide_city_groups(store, city_tasks, weights=None):
+    """
+    Делит точки городов на полигоны. city_tasks - список (индексы точек города, доли нагрузки
+    аудиторов города), weights - нагрузка точек (по индексам PointStore).
+    Города независимы: при большом объеме они считаются в пуле процессов.
+    Возвращает для каждого города список массивов индексов PointStore.
+    """
+    if weights is None:
+        weights = np.ones(len(store), dtype=np.float64)
+
+    # Город с одним аудитором - один полигон, в пул его не отправляем
+    shipped = [i for i, (city_idx, shares) in enumerate(city_tasks) if len(shares) > 1]
+    tasks = [
+        (store.ids[city_tasks[i][0]], store.lat[city_tasks[i][0]], store.lon[city_tasks[i][0]],
+         weights[city_tasks[i][0]], city_tasks[i][1])
+        for i in shipped
+    ]
+    local_groups = parallel_map(_divide_city_task, tasks, [len(city_tasks[i][0]) for i in shipped])
+
+    city_groups = [[city_idx] for city_idx, _ in city_tasks]
+    for i, groups in zip(shipped, local_groups):
+        city_idx = city_tasks[i][0]
+        city_groups[i] = [city_idx[group] for group in groups]
+    return city_groups
+
+
+def distribute_points_to_auditors(points_df, auditors_df, store=None, service_minutes=None):
+    """
+    Распределяет точки по аудиторам с географическим разделением.
+    Полигоны выравниваются по нагрузке: посещения x время визита по типу точки
+    (service_minutes - минуты по типам, см. DEFAULT_SERVICE_MINUTES).
+    """
+
+    if points_df is None or points_df.empty:
+        diag.error("❌ Нет данных о точках для распределения")
+        return None, None
+
+    store = get_point_store(points_df, store)
+    empty = np.array([], dtype=np.int64)
+
+    # Назначения копим как массивы индексов: (индексы, аудитор, город, полигон)
+    assignments = []
+    polygons_info = {}
+
+    # Аудиторы по городам - одна группировка вместо фильтра на каждый город
+    auditors_by_city = auditors_df.groupby('Город', sort=False)['ID_Сотрудника'].agg(list).to_dict()
+
+    # Города с аудиторами (в порядке появления в точках)
+    cities = []
+    for city, city_idx in store.city_groups():
+        city_auditors = auditors_by_city.get(city, [])
+
+        if len(city_auditors) == 0:
+            diag.warning(f"⚠️ В городе {city} нет аудиторов")
+            continue
+
+        cities.append((city, city_idx, city_auditors))
+
+    # Нагрузка точек в минутах за квартал
+    workload = point_workload_minutes(store, service_minutes)
+
+    # Емкость аудиторов (часов в неделю): полигоны делятся пропорционально ей
+    capacities = [auditor_capacities(auditors_df, city, city_auditors) for city, _, city_auditors in cities]
+
+    # Разделяем точки по географическим направлениям (города независимы - параллельно)
+    city_point_groups = divide_city_groups(
+        store,
+        [
+            (city_idx, np.ones(len(city_auditors)) if capacity is None else capacity)
+            for (_, city_idx, city_auditors), capacity in zip(cities, capacities)
+        ],
+        workload
+    )
+
+    # Собираем назначения и полигоны в порядке городов
+    for (city, city_idx, city_auditors), capacity, point_groups in zip(cities, capacities, city_point_groups):
+        n_auditors = len(city_auditors)
+
+        # Финальная балансировка (если групп больше чем аудиторов)
+        if len(point_groups) > n_auditors:
+            point_groups = point_groups[:n_auditors]
+        elif len(point_groups) < n_auditors:
+            # Добавляем пустые группы если нужно
+            point_groups = list(point_groups) + [empty] * (n_auditors - len(point_groups))
+
+        # Направления для названий полигонов
+        directions = polygon_directions(city, n_auditors)
+
+        # Распределяем группы точек по аудиторам
+        for i in range(n_auditors):
+            if i >= len(city_auditors) or i >= len(point_groups) or i >= len(directions):
+                continue
+
+            auditor = city_auditors[i]
+            point_group = point_groups[i]
+            polygon_name = directions[i]
+
+            if len(point_group) == 0:
+                diag.warning(f"⚠️ Аудитор {auditor} в городе {city} не получил точек")
+                continue
+
+            assignments.append((point_group, auditor, city, polygon_name))
+            polygons_info[polygon_name] = polygon_info(
+                store, point_group, auditor, city, workload, None if capacity is None else capacity[i]
+            )
+
+    if not assignments:
+        diag.warning("⚠️ Не удалось распределить точки по аудиторам")
+        return None, None
+
+    report_workload_forecast(polygons_info)
+    return assignment_frame(store, assignments), polygons_info
+
+def polygon_directions(city, n_auditors):
+    """Названия полигонов города в порядке групп divide_points_by_direction"""
+    if n_auditors == 1:
+        return [f"{city}"]
+    elif n_auditors == 2:
+        return [f"{city}-Север", f"{city}-Юг"]
+    elif n_auditors == 3:
+        return [f"{city}-Север", f"{city}-Юго-Восток", f"{city}-Юго-Запад"]
+    elif n_auditors == 4:
+        return [f"{city}-Север", f"{city}-Восток", f"{city}-Юг", f"{city}-Запад"]
+    return [f"{city}-Зона-{i+1}" for i in range(n_auditors)]
+
+def polygon_info(store, point_group, auditor, city, workload, capacity_week_hours=None):
+    """Описание полигона для polygons_info (точки, посещения, нагрузка в часах, емкость)"""
+    return {
+        'auditor': auditor,
+        'city': city,
+        'points': store.point_records(point_group),
+        'visits': int(store.visits[point_group].sum()),
+        'workload_hours': round(float(workload[point_group].sum()) / 60, 1),
+        'capacity_week_hours': None if capacity_week_hours is None else float(capacity_week_hours)
+    }
+
+def report_workload_forecast(polygons_info):
+    """Сообщение о разбросе прогноза нагрузки аудиторов"""
+    hours = [info['workload_hours'] for info in polygons_info.values()]
+    if hours:
+        diag.info(f"⏱️ Прогноз нагрузки аудиторов за квартал: от {min(hours):.1f} до {max(hours):.1f} ч "
+                  f"(в среднем {np.mean(hours):.1f} ч)")
+
+def assignment_frame(store, assignments):
+    """points_assignment_df из списка (индексы точек, аудитор, город, полигон)"""
+    point_idx = np.concatenate([item[0] for item in assignments])
+    counts = [len(item[0]) for item in assignments]
+
+    return pd.DataFrame({
+        'ID_Точки': store.ids[point_idx],
+        'Аудитор': _repeat_values([item[1] for item in assignments], counts),
+        'Город': _repeat_values([item[2] for item in assignments], counts),
+        'Полигон': _repeat_values([item[3] for item in assignments], counts)
+    })
+
+# ==============================================
+# СТАБИЛЬНОЕ ПЕРЕРАСПРЕДЕЛЕНИЕ (МИНИМУМ ПЕРЕНОСОВ ТОЧЕК)
+# ==============================================
+
+# Допуск нагрузки аудитора относительно его доли (0.1 - ±10%): пока нагрузка всех
+# аудиторов города в допуске, точки через границы территорий не переносятся
+REBALANCE_TOLERANCE = 0.1
+# Ближайшие соседи точки: территории соседей - граница, через которую точку можно перенести
+REBALANCE_NEIGHBOURS = 8
+
+# Колонки таблицы переносов точек
+REBALANCE_MOVES_COLUMNS = ['ID_Точки', 'Город', 'Аудитор_был', 'Аудитор', 'Полигон', 'Причина']
+
+def rebalance_city_territories(x, y, weights, owners, shares, auditors, tolerance=REBALANCE_TOLERANCE, index=None):
+    """
+    Перераспределение точек одного города с минимумом переносов.
+    x, y - координаты в км, weights - нагрузка точек, owners - прежний аудитор точки
+    (позиция в auditors, -1 - у точки нет аудитора: новая точка или аудитор выбыл),
+    shares - доли нагрузки аудиторов (емкость). Хотя бы у одной точки аудитор есть.
+    index - пространственный индекс точек (SpatialIndex по x, y), по умолчанию строится.
+
+    1. Точки без аудитора присоединяются к соседним территориям (к наименее загруженной).
+    2. Новый аудитор (без точек) получает самую дальнюю от центра точку самой загруженной территории.
+    3. Пока нагрузка аудиторов не в допуске tolerance от их долей, по одной переносятся точки
+       на границе территорий (точка и ее сосед - у разных аудиторов; соседство в обе стороны,
+       чтобы росла и территория на отшибе) от более загруженного аудитора к менее загруженному;
+       из подходящих - ближайшая к центру принимающей территории. Если на границах переносить
+       нечего, самому загруженному аудитору разрешен перенос ближайшей к центру наименее
+       загруженной территории точки. Перенос не меняет загруженность местами, поэтому
+       процесс конечен; если допуск так и не достигнут - предупреждение.
+
+    Возвращает (новые owners, причины переносов - массив строк или None по точкам).
+    """
+    n = len(x)
+    owners = np.asarray(owners, dtype=np.int64).copy()
+    n_auditors = len(shares)
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.sum() <= 0:
+        # Нагрузки нет (нет плановых посещений) - выравниваем число точек
+        weights = np.ones(n, dtype=np.float64)
+    shares = np.asarray(shares, dtype=np.float64)
+    target = weights.sum() * shares / shares.sum()
+    reasons = np.full(n, None, dtype=object)
+
+    if index is None:
+        index = SpatialIndex(x, y)
+    nearest = index.knn(REBALANCE_NEIGHBOURS)
+
+    def territory_loads():
+        assigned = owners >= 0
+        return np.bincount(owners[assigned], weights=weights[assigned], minlength=n_auditors)
+
+    def territory_centers():
+        assigned = owners >= 0
+        counts = np.maximum(np.bincount(owners[assigned], minlength=n_auditors), 1)
+        return (np.bincount(owners[assigned], weights=x[assigned], minlength=n_auditors) / counts,
+                np.bincount(owners[assigned], weights=y[assigned], minlength=n_auditors) / counts)
+
+    load = territory_loads()
+
+    # 1. Точки без аудитора - к соседним территориям (волнами от границы)
+    while (owners < 0).any():
+        orphans = np.flatnonzero(owners < 0)
+        neighbour_owners = owners[nearest[orphans]]
+        frontier = (neighbour_owners >= 0).any(axis=1)
+
+        if not frontier.any():
+            # Среди соседей нет точек с аудитором - ближайшая к центру территории точка
+            center_x, center_y = territory_centers()
+            has_points = np.bincount(owners[owners >= 0], minlength=n_auditors) > 0
+            distances = np.hypot(x[orphans, None] - center_x[None, :], y[orphans, None] - center_y[None, :])
+            distances[:, ~has_points] = np.inf
+            orphan, auditor = np.unravel_index(np.argmin(distances), distances.shape)
+            owners[orphans[orphan]] = auditor
+            load[auditor] += weights[orphans[orphan]]
+            continue
+
+        for point, candidates in zip(orphans[frontier], neighbour_owners[frontier]):
+            candidates = np.unique(candidates[candidates >= 0])
+            auditor = candidates[np.argmin(load[candidates] / target[candidates])]
+            owners[point] = auditor
+            load[auditor] += weights[point]
+
+    # 2. Новые аудиторы - крайняя точка самой загруженной территории
+    for auditor in np.flatnonzero(np.bincount(owners, minlength=n_auditors) == 0):
+        sizes = np.bincount(owners, minlength=n_auditors)
+        donors = np.flatnonzero(sizes > 1)
+        if len(donors) == 0:
+            break
+        donor = donors[np.argmax(load[donors] / target[donors])]
+        center_x, center_y = territory_centers()
+        donor_points = np.flatnonzero(owners == donor)
+        seed = donor_points[np.argmax(np.hypot(x[donor_points] - center_x[donor], y[donor_points] - center_y[donor]))]
+        owners[seed] = auditor
+        load[donor] -= weights[seed]
+        load[auditor] += weights[seed]
+        reasons[seed] = f"Новый аудитор {auditors[auditor]}: первая точка территории {auditors[donor]}"
+
+    # 3. Переносы через границы территорий. Пары (точка, сосед) - в обе стороны:
+    # kNN несимметричен, и до точек на отшибе ближайших соседей у остальных нет
+    point_pairs = np.concatenate([np.repeat(np.arange(n), nearest.shape[1]), nearest.ravel()])
+    other_pairs = np.concatenate([nearest.ravel(), np.repeat(np.arange(n), nearest.shape[1])])
+
+    relative = load / target
+    for _ in range(n * n_auditors):
+        if relative.max() <= 1 + tolerance and relative.min() >= 1 - tolerance:
+            break
+
+        point = point_pairs
+        donor = owners[point]
+        receiver = owners[other_pairs]
+        moved = weights[point]
+
+        # Перенос от более загруженного к менее загруженному, без смены их порядка
+        allowed = (
+            (donor != receiver) & (moved > 0) &
+            (relative[donor] - moved / target[donor] >= relative[receiver] + moved / target[receiver])
+        )
+        center_x, center_y = territory_centers()
+
+        if not allowed.any():
+            # На границах переносить нечего - от самого загруженного к наименее загруженному
+            donor, receiver = int(np.argmax(relative)), int(np.argmin(relative))
+            point = np.flatnonzero(owners == donor)
+            moved = weights[point]
+            fits = (moved > 0) & (relative[donor] - moved / target[donor] >= relative[receiver] + moved / target[receiver])
+            if not fits.any():
+                break
+            point = point[fits]
+            point = point[np.argmin(np.hypot(x[point] - center_x[receiver], y[point] - center_y[receiver]))]
+        else:
+            donor, receiver, point = donor[allowed], receiver[allowed], point[allowed]
+
+            # Сначала самая разбалансированная пара, в ней - точка ближе к принимающей территории
+            compactness = (np.hypot(x[point] - center_x[receiver], y[point] - center_y[receiver]) -
+                           np.hypot(x[point] - center_x[donor], y[point] - center_y[donor]))
+            best = np.lexsort((compactness, -(relative[donor] - relative[receiver])))[0]
+            donor, receiver, point = donor[best], receiver[best], point[best]
+
+        owners[point] = receiver
+        load[donor] -= weights[point]
+        load[receiver] += weights[point]
+        reasons[point] = (f"Выравнивание нагрузки: {auditors[donor]} {relative[donor]:.0%} доли → "
+                          f"{auditors[receiver]} {relative[receiver]:.0%} доли")
+        relative = load / target
+
+    if relative.max() > 1 + tolerance or relative.min() < 1 - tolerance:
+        diag.warning(f"⚠️ Нагрузка не выровнена до ±{tolerance:.0%} доли: "
+                     f"{auditors[int(np.argmax(relative))]} {relative.max():.0%}, "
+                     f"{auditors[int(np.argmin(relative))]} {relative.min():.0%}")
+
+    return owners, reasons
+
+def rebalance_points_to_auditors(previous_assignment_df, points_df, auditors_df, store=None, service_minutes=None,
+                                 tolerance=REBALANCE_TOLERANCE):
+    """
+    Перераспределяет точки по аудиторам от прежнего распределения (points_assignment_df),
+    переносит как можно меньше точек. Точки остаются у прежних аудиторов; переносятся новые
+    точки, точки выбывших аудиторов и точки на границах территорий, пока нагрузка аудиторов
+    не войдет в допуск tolerance от их долей (см. rebalance_city_territories).
+    Прежние аудиторы сохраняют названия полигонов. Город без прежних территорий
+    (все аудиторы новые) делится заново, как в distribute_points_to_auditors.
+    Возвращает (points_assignment_df, polygons_info, moves_df) - moves_df: перенесенные точки
+    с прежним и новым аудитором и причиной переноса (колонки REBALANCE_MOVES_COLUMNS).
+    """
+    if points_df is None or points_df.empty:
+        diag.error("❌ Нет данных о точках для распределения")
+        return None, None, None
+
+    store = get_point_store(points_df, store)
+    workload = point_workload_minutes(store, service_minutes)
+
+    # Прежнее распределение: ID точки -> (аудитор, город, полигон)
+    previous = previous_assignment_df if previous_assignment_df is not None else pd.DataFrame(
+        columns=['ID_Точки', 'Аудитор', 'Город', 'Полигон']
+    )
+    previous = previous.assign(_id=_id_strings(previous['ID_Точки'])).drop_duplicates('_id').set_index('_id')
+    point_keys = _id_strings(pd.Series(store.ids)).to_numpy(dtype=object)
+    previous_auditor = previous['Аудитор'].reindex(point_keys).to_numpy(dtype=object)
+    previous_city = previous['Город'].reindex(point_keys).astype(object).to_numpy(dtype=object)
+
+    auditors_by_city = auditors_df.groupby('Город', sort=False)['ID_Сотрудника'].agg(list).to_dict()
+
+    assignments = []
+    polygons_info = {}
+    moves = []
+    fresh_tasks = []
+
+    for city, city_idx in store.city_groups():
+        city_auditors = auditors_by_city.get(city, [])
+
+        if len(city_auditors) == 0:
+            diag.warning(f"⚠️ В городе {city} нет аудиторов")
+            continue
+
+        capacity = auditor_capacities(auditors_df, city, city_auditors)
+        shares = np.ones(len(city_auditors)) if capacity is None else capacity
+
+        # Прежний аудитор точки - если он остался в этом городе и точка не сменила город
+        position = {str(auditor): i for i, auditor in enumerate(city_auditors)}
+        same_city = np.array([str(value) == str(city) for value in previous_city[city_idx]], dtype=bool)
+        owners = np.array([
+            position.get(str(auditor), -1) if kept else -1
+            for auditor, kept in zip(previous_auditor[city_idx], same_city)
+        ], dtype=np.int64)
+
+        if not (owners >= 0).any():
+            # Прежних территорий нет - город делится заново
+            fresh_tasks.append((city, city_idx, city_auditors, capacity, shares))
+            continue
+
+        owners, reasons = rebalance_city_territories(
+            store.x_km[city_idx], store.y_km[city_idx], workload[city_idx], owners, shares,
+            [str(auditor) for auditor in city_auditors], tolerance, index=store.city_spatial_index(city_idx)
+        )
+
+        # Названия полигонов: прежние - у прежних аудиторов, новым - свободные номера зон
+        previous_polygons = previous[previous['Город'].astype(str) == str(city)]
+        polygon_of = dict(zip(previous_polygons['Аудитор'].astype(str), previous_polygons['Полигон']))
+        directions = [polygon_of.get(str(auditor)) for auditor in city_auditors]
+        zone = 0
+        for i, name in enumerate(directions):
+            while name is None or name in polygons_info or name in directions[:i]:
+                zone += 1
+                name = f"{city}-Зона-{zone}"
+            directions[i] = name
+
+        for i, auditor in enumerate(city_auditors):
+            point_group = city_idx[owners == i]
+            if len(point_group) == 0:
+                diag.warning(f"⚠️ Аудитор {auditor} в городе {city} не получил точек")
+                continue
+
+            assignments.append((point_group, auditor, city, directions[i]))
+            polygons_info[directions[i]] = polygon_info(
+                store, point_group, auditor, city, workload, None if capacity is None else capacity[i]
+            )
+
+        for local in range(len(city_idx)):
+            point = city_idx[local]
+            auditor = city_auditors[owners[local]]
+            was = previous_auditor[point]
+            if not pd.isna(was) and same_city[local] and str(was) == str(auditor):
+                continue
+            if pd.isna(was):
+                reason = "Новая точка"
+            elif not same_city[local]:
+                reason = f"Точка перенесена из города {previous_city[point]}"
+            elif str(was) not in position:
+                reason = f"Аудитор {was} выбыл из города"
+            else:
+                reason = reasons[local]
+            moves.append((point, city, was, auditor, directions[owners[local]], reason))
+
+    # Города без прежних территорий - деление как в distribute_points_to_auditors
+    fresh_groups = divide_city_groups(store, [(city_idx, shares) for _, city_idx, _, _, shares in fresh_tasks], workload)
+    for (city, city_idx, city_auditors, capacity, _), point_groups in zip(fresh_tasks, fresh_groups):
+        directions = polygon_directions(city, len(city_auditors))
+        for i, (auditor, point_group) in enumerate(zip(city_auditors, point_groups)):
+            if len(point_group) == 0:
+                diag.warning(f"⚠️ Аудитор {auditor} в городе {city} не получил точек")
+                continue
+
+            assignments.append((point_group, auditor, city, directions[i]))
+            polygons_info[directions[i]] = polygon_info(
+                store, point_group, auditor, city, workload, None if capacity is None else capacity[i]
+            )
+            for point in point_group:
+                was = previous_auditor[point]
+                moves.append((point, city, was, auditor, directions[i],
+                              "Новая точка" if pd.isna(was) else "Город распределен заново: прежних аудиторов нет"))
+
+    if not assignments:
+        diag.warning("⚠️ Не удалось распределить точки по аудиторам")
+        return None, None, None
+
+    moves_df = pd.DataFrame(
+        [(store.ids[point], city, None if pd.isna(was) else was, auditor, polygon, reason)
+         for point, city, was, auditor, polygon, reason in moves],
+        columns=REBALANCE_MOVES_COLUMNS
+    )
+    diag.info(f"🔁 Перераспределение с минимумом переносов: перенесено {len(moves_df)} из {len(store)} точек")
+    report_workload_forecast(polygons_info)
+
+    return assignment_frame(store, assignments), polygons_info, moves_df
+
+# ==============================================
+# ИНКРЕМЕНТАЛЬНЫЙ ПЕРЕСЧЕТ (ДЕЛЬТА-ЗАГРУЗКА)
+# ==============================================
+
+# Вкладки файла изменений: добавленные/измененные строки и списки ID на удаление
+DELTA_SHEETS = ['Точки', 'Точки_удалить', 'Аудиторы', 'Аудиторы_удалить']
+
+# Ключи строк таблиц: точка - по ID, аудитор - по ID и городу (строка на каждый город работы)
+POINTS_DELTA_KEY = ['ID_Точки']
+AUDITORS_DELTA_KEY = ['ID_Сотрудника', 'Город']
+
+# Таблицы плана, которые хранятся в session state и пересчитываются по городам
+PLAN_TABLES = ['points_assignment_df', 'polygons_info', 'polygons',
+               'weekly_clusters_df', 'detailed_plan_df', 'routes_df']
+
+def _id_strings(values):
+    """ID как строки без пробелов по краям (для сравнения базы и дельты)"""
+    return values.astype(str).str.strip()
+
+def _row_keys(df, key_columns):
+    """Ключи строк таблицы - кортежи значений key_columns (строки без пробелов по краям)"""
+    return list(zip(*[_id_strings(df[col]) for col in key_columns]))
+
+def _removed_keys(df, resolver, key_columns):
+    """
+    Множество ключей из вкладки удаления (колонки ищутся по альтернативным названиям).
+    Первая колонка ключа - ID, остальные (город) необязательные: без колонки или значения
+    в ключе None - удаляются строки этого ID с любым значением.
+    """
+    if df is None or df.empty:
+        return set()
+    column = resolver.find(df.columns, key_columns[0])
+    if column is None:
+        # Вкладка из одной колонки без заголовка ID - берем первую колонку
+        column = df.columns[0]
+    df = df[df[column].notna()]
+    ids = _id_strings(df[column])
+
+    parts = [ids]
+    for key_column in key_columns[1:]:
+        column = resolver.find(df.columns, key_column)
+        if column is None:
+            parts.append([None] * len(df))
+            continue
+        values = _id_strings(df[column])
+        parts.append(values.where(df[column].notna() & (values != ''), None))
+
+    return {key for key in zip(*parts) if key[0] != ''}
+
+def _removed_rows(keys, removed_keys):
+    """Маска строк с ключами keys, попадающих под удаление (None в ключе удаления - любое значение)"""
+    exact = {key for key in removed_keys if None not in key}
+    any_value = {key[0] for key in removed_keys if None in key}
+    return np.array([key in exact or key[0] in any_value for key in keys], dtype=bool)
+
+def read_delta_file(file):
+    """
+    Читает файл изменений (Excel или zip/папка с CSV/Parquet).
+    Возвращает словарь: points / auditors - нормализованные добавленные и измененные строки
+    (или None), removed_points / removed_auditors - множества ключей на удаление
+    (точка - (ID,), аудитор - (ID, город или None - во всех городах)),
+    rejections - отклоненные при проверке строки.
+    """
+    if is_table_bundle(file):
+        frames, _ = read_table_bundle(file)
+    else:
+        frames, _ = read_workbook_sheets(file, DELTA_SHEETS)
+
+    delta = {'points': None, 'auditors': None, 'rejections': []}
+
+    if frames.get('Точки') is not None and not frames['Точки'].empty:
+        delta['points'], report = load_and_process_points(frames['Точки'])
+        delta['rejections'].append(report)
+    if frames.get('Аудиторы') is not None and not frames['Аудиторы'].empty:
+        delta['auditors'], report = load_and_process_auditors(frames['Аудиторы'])
+        delta['rejections'].append(report)
+
+    delta['removed_points'] = _removed_keys(frames.get('Точки_удалить'), POINTS_COLUMNS, POINTS_DELTA_KEY)
+    delta['removed_auditors'] = _removed_keys(frames.get('Аудиторы_удалить'), AUDITORS_COLUMNS, AUDITORS_DELTA_KEY)
+
+    reports = [report for report in delta['rejections'] if not report.empty]
+    delta['rejections'] = pd.concat(reports, ignore_index=True) if reports else empty_rejection_report()
+
+    return delta
+
+def _changed_rows(base_df, upserts, key_columns):
+    """
+    Маска строк дельты, которые отличаются от базы (новые ключи или измененные значения).
+    Каждая строка сравнивается с базовой строкой того же ключа; значение в колонке,
+    которой нет в базе, - тоже изменение. Строки, совпадающие с базовыми, город не затрагивают.
+    """
+    position = {}
+    for i, key in enumerate(_row_keys(base_df, key_columns)):
+        position.setdefault(key, i)
+    rows = np.array([position.get(key, -1) for key in _row_keys(upserts, key_columns)], dtype=np.int64)
+
+    # Сравниваем только строки с известными ключами (новые ключи всегда считаются изменением)
+    known = rows >= 0
+    same = known.copy()
+    if known.any():
+        old = base_df.iloc[rows[known]]
+        new = upserts[known]
+        equal = np.ones(int(known.sum()), dtype=bool)
+        for col in [col for col in upserts.columns if col not in key_columns]:
+            if col in base_df.columns:
+                equal &= new[col].astype(str).to_numpy() == old[col].astype(str).to_numpy()
+            else:
+                equal &= new[col].isna().to_numpy()
+        same[known] = equal
+
+    return ~same
+
+def _apply_table_delta(base_df, upserts, removed_keys, key_columns):
+    """
+    Применяет дельту к одной таблице (строки сопоставляются по ключу key_columns).
+    Возвращает (новая таблица, затронутые города, счетчики добавлено/изменено/удалено).
+    """
+    base_keys = _row_keys(base_df, key_columns)
+    affected = set()
+
+    if upserts is not None and not upserts.empty:
+        upserts = upserts[_changed_rows(base_df, upserts, key_columns)]
+    else:
+        upserts = None
+
+    upsert_keys = set(_row_keys(upserts, key_columns)) if upserts is not None else set()
+    removed = _removed_rows(base_keys, removed_keys)
+    touched = removed | np.array([key in upsert_keys for key in base_keys], dtype=bool)
+
+    # Город затронут и по старому значению (удаление, переезд), и по новому
+    affected |= set(base_df.loc[touched, 'Город'].astype(str))
+    if upserts is not None:
+        affected |= set(upserts['Город'].astype(str))
+
+    parts = [base_df.loc[~touched]]
+    if upserts is not None and not upserts.empty:
+        parts.append(upserts)
+    new_df = pd.concat(parts, ignore_index=True)
+
+    removed_keys = {key for key, hit in zip(base_keys, removed) if hit}
+    counts = {
+        'added': len(upsert_keys - set(base_keys)),
+        'changed': len(upsert_keys & set(base_keys)),
+        'removed': len(removed_keys - upsert_keys)
+    }
+    return new_df, affected, counts
+
+def apply_input_delta(points_df, auditors_df, delta):
+    """
+    Применяет файл изменений к базовым точкам и аудиторам.
+    Возвращает (points_df, auditors_df, затронутые города, сводка изменений).
+    """
+    new_points, points_cities, points_counts = _apply_table_delta(
+        points_df, delta.get('points'), delta.get('removed_points', set()), POINTS_DELTA_KEY
+    )
+    new_auditors, auditors_cities, auditors_counts = _apply_table_delta(
+        auditors_df, delta.get('auditors'), delta.get('removed_auditors', set()), AUDITORS_DELTA_KEY
+    )
+
+    summary = {
+        'Точек добавлено': points_counts['added'],
+        'Точек изменено': points_counts['changed'],
+        'Точек удалено': points_counts['removed'],
+        'Аудиторов добавлено': auditors_counts['added'],
+        'Аудиторов изменено': auditors_counts['changed'],
+        'Аудиторов удалено': auditors_counts['removed']
+    }
+
+    return new_points, new_auditors, points_cities | auditors_cities, summary
+
+def _drop_cities(df, cities, column='Город'):
+    """Строки таблицы плана вне пересчитываемых городов"""
+    if df is None or df.empty or column not in df.columns:
+        return df
+    return df[~df[column].astype(str).isin(cities)]
+
+def replan_affected_cities(baseline, points_df, auditors_df, affected_cities, year, quarter, coefficients,
+                           improve_routes=False, service_minutes=None, rebalance=False):
+    """
+    Пересчитывает распределение, недельные кластеры и маршруты только для затронутых городов.
+    baseline - таблицы базового плана (ключи PLAN_TABLES); для остальных городов они
+    переносятся без изменений. Возвращает новый план в том же формате.
+    rebalance - города не делятся заново: точки перераспределяются от базового распределения
+    с минимумом переносов (rebalance_points_to_auditors), поэтому график аудиторов с прежним
+    набором точек не меняется. Тогда в плане есть и 'moves_df' - перенесенные точки и причины.
+    """
+    cities = {str(city) for city in affected_cities}
+
+    # 1. Базовый план без затронутых городов
+    kept_assignment = _drop_cities(baseline['points_assignment_df'], cities)
+    kept_pairs = set()
+    if kept_assignment is not None and not kept_assignment.empty:
+        kept_pairs = set(zip(kept_assignment['Аудитор'].astype(str), kept_assignment['Город'].astype(str)))
+
+    # В кластерах нет города - он берется по точке. Аудитор может работать в нескольких
+    # городах, поэтому сохраняются пары (аудитор, город) вне пересчитываемых городов
+    kept_clusters = baseline.get('weekly_clusters_df')
+    if kept_clusters is not None and not kept_clusters.empty:
+        assignment = baseline['points_assignment_df']
+        point_city = dict(zip(_id_strings(assignment['ID_Точки']), assignment['Город'].astype(str)))
+        cluster_cities = _id_strings(kept_clusters['ID_Точки']).map(point_city)
+        keep = [pair in kept_pairs for pair in zip(kept_clusters['Аудитор'].astype(str), cluster_cities)]
+        kept_clusters = kept_clusters[np.array(keep, dtype=bool)]
+
+    kept_polygons_info = {
+        name: info for name, info in (baseline.get('polygons_info') or {}).items()
+        if str(info.get('city')) not in cities
+    }
+    kept_polygons = {
+        name: info for name, info in (baseline.get('polygons') or {}).items()
+        if name in kept_polygons_info
+    }
+
+    plan = {
+        'points_assignment_df': kept_assignment,
+        'polygons_info': kept_polygons_info,
+        'polygons': kept_polygons,
+        'weekly_clusters_df': kept_clusters,
+        'detailed_plan_df': _drop_cities(baseline.get('detailed_plan_df'), cities),
+        'routes_df': _drop_cities(baseline.get('routes_df'), cities)
+    }
+
+    # 2. Пересчет затронутых городов
+    city_points = points_df[points_df['Город'].astype(str).isin(cities)].reset_index(drop=True)
+    city_auditors = auditors_df[auditors_df['Город'].astype(str).isin(cities)]
+
+    if city_points.empty or city_auditors.empty:
+        return plan
+
+    store = PointStore(city_points)
+    if rebalance:
+        assignment_df, polygons_info, plan['moves_df'] = rebalance_points_to_auditors(
+            baseline['points_assignment_df'], city_points, city_auditors, store=store,
+            service_minutes=service_minutes
+        )
+    else:
+        assignment_df, polygons_info = distribute_points_to_auditors(
+            city_points, city_auditors, store=store, service_minutes=service_minutes
+        )
+    if assignment_df is None:
+        return plan
+
+    weekly_clusters_df = create_weekly_geographic_clusters(
+        assignment_df, city_points, year, quarter, coefficients, store=store
+    )
+    detailed_plan_df = convert_clusters_to_weekly_plan(weekly_clusters_df, city_points, store=store)
+    routes_df = create_geographic_daily_routes(city_points, weekly_clusters_df, store=store, improve=improve_routes)
+
+    # 3. Объединяем сохраненные и пересчитанные части
+    def merge(kept, new):
+        parts = [df for df in [kept, new] if df is not None and not df.empty]
+        return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+    plan['points_assignment_df'] = merge(plan['points_assignment_df'], assignment_df)
+    plan['weekly_clusters_df'] = merge(plan['weekly_clusters_df'], weekly_clusters_df)
+    plan['detailed_plan_df'] = merge(plan['detailed_plan_df'], detailed_plan_df)
+    plan['routes_df'] = merge(plan['routes_df'], routes_df)
+    plan['polygons_info'].update(polygons_info)
+    plan['polygons'].update(generate_polygons(polygons_info))
+
+    return plan
+
+# ==============================================
+# ГРАФ ЭТАПОВ РАСЧЕТА С МЕМОИЗАЦИЕЙ
+# ==============================================
+
+# Сколько последних результатов хранится на каждый этап
+# (например, чтобы переключение коэффициентов туда-обратно не пересчитывало план)
+STAGE_CACHE_SIZE = 4
+
+def _weekly_plan_stage(weekly_clusters, distribute, points, year, quarter, coefficients, store=None):
+    """Недельный план из кластеров; без кластеров - распределение по старой логике"""
+    detailed_plan_df = pd.DataFrame()
+    if not weekly_clusters.empty:
+        detailed_plan_df = convert_clusters_to_weekly_plan(weekly_clusters, points, store=store)
+    if detailed_plan_df.empty:
+        detailed_plan_df = distribute_visits_by_weeks(distribute[0], points, year, quarter, coefficients)
+    return detailed_plan_df
+
+def _routes_stage(weekly_clusters, distribute, points, auditors, year, quarter, improve_routes, store=None):
+    """Маршруты по дням из кластеров; без кластеров - расписание по старой логике"""
+    if not weekly_clusters.empty:
+        return create_geographic_daily_routes(points, weekly_clusters, store=store, improve=improve_routes)
+    return create_weekly_route_schedule(points, distribute[0], auditors, year, quarter)
+
+# Этапы расчета плана: имя -> (входы, функция).
+# Вход - исходные данные ('points', 'auditors', 'visits', 'year', 'quarter', 'coefficients',
+# 'improve_routes', 'service_minutes') или результат другого этапа.
+# Функция получает входы в объявленном порядке
+PLAN_STAGES = {
+    'distribute': (
+        ['points', 'auditors', 'service_minutes'],
+        lambda points, auditors, service_minutes, store=None: distribute_points_to_auditors(
+            points, auditors, store=store, service_minutes=service_minutes
+        )
+    ),
+    'polygons': (
+        ['distribute'],
+        lambda distribute, store=None: generate_polygons(distribute[1])
+    ),
+    'weekly_clusters': (
+        ['distribute', 'points', 'year', 'quarter', 'coefficients'],
+        lambda distribute, points, year, quarter, coefficients, store=None: create_weekly_geographic_clusters(
+            distribute[0], points, year, quarter, coefficients, store=store
+        )
+    ),
+    'weekly_plan': (
+        ['weekly_clusters', 'distribute', 'points', 'year', 'quarter', 'coefficients'],
+        _weekly_plan_stage
+    ),
+    'routes': (
+        ['weekly_clusters', 'distribute', 'points', 'auditors', 'year', 'quarter', 'improve_routes'],
+        _routes_stage
+    ),
+    'statistics': (
+        ['points', 'visits', 'weekly_plan', 'year', 'quarter'],
+        lambda points, visits, weekly_plan, year, quarter, store=None: calculate_statistics(
+            points, visits, weekly_plan, year, quarter
+        )
+    )
+}
+
+STAGE_NAMES = {
+    'distribute': 'распределение точек',
+    'polygons': 'полигоны',
+    'weekly_clusters': 'недельные кластеры',
+    'weekly_plan': 'недельный план',
+    'routes': 'маршруты',
+    'statistics': 'статистика'
+}
+
+def value_fingerprint(value):
+    """Хэш исходных данных этапа: содержимое таблицы или значение настройки"""
+    hasher = hashlib.sha256()
+    if isinstance(value, pd.DataFrame):
+        hasher.update(json.dumps([str(column) for column in value.columns]).encode('utf-8'))
+        hasher.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+    else:
+        hasher.update(json.dumps(value, default=str).encode('utf-8'))
+    return hasher.hexdigest()
+
+def _stage_failed(result):
+    """Этап не дал результата (такой результат не запоминается)"""
+    if result is None:
+        return True
+    return isinstance(result, tuple) and any(part is None for part in result)
+
+def remember_stage_result(cache, name, key, result):
+    """Запоминает результат этапа (не больше STAGE_CACHE_SIZE на этап)"""
+    if _stage_failed(result):
+        return
+    entries = cache.setdefault(name, {})
+    entries[key] = result
+    while len(entries) > STAGE_CACHE_SIZE:
+        entries.pop(next(iter(entries)))
+
+class StageRunner:
+    """
+    Выполняет этапы PLAN_STAGES с мемоизацией.
+    Ключ этапа - хэш его имени и ключей входов, поэтому изменение настройки
+    пересчитывает только этапы ниже по графу (коэффициенты этапов не трогают распределение).
+    sources - исходные данные, cache - словарь результатов (хранится в session state),
+    resources - общие объекты, не влияющие на результат (PointStore).
+    """
+
+    def __init__(self, sources, cache, **resources):
+        self.sources = sources
+        self.cache = cache
+        self.resources = resources
+        self.keys = {}
+        self.computed = set()
+        # Этапы, взятые из кэша предыдущих расчетов
+        self.hits = []
+
+    def key(self, name):
+        if name not in self.keys:
+            if name in PLAN_STAGES:
+                parts = [name] + [self.key(input_name) for input_name in PLAN_STAGES[name][0]]
+            else:
+                parts = [name, value_fingerprint(self.sources[name])]
+            self.keys[name] = hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()
+        return self.keys[name]
+
+    def cached(self, name):
+        """Результат этапа уже есть в кэше"""
+        return self.key(name) in self.cache.get(name, {})
+
+    def run(self, name):
+        """Результат этапа: из кэша, если входы не менялись, иначе расчет"""
+        inputs, func = PLAN_STAGES[name]
+        key = self.key(name)
+        entries = self.cache.setdefault(name, {})
+
+        if key in entries:
+            # Отмечаем обращение для LRU (последний использованный - в конце словаря)
+            entries[key] = entries.pop(key)
+            if name not in self.computed and name not in self.hits:
+                self.hits.append(name)
+            return entries[key]
+
+        args = [self.run(input_name) if input_name in PLAN_STAGES else self.sources[input_name]
+                for input_name in inputs]
+        result = func(*args, **self.resources)
+        self.computed.add(name)
+
+        remember_stage_result(self.cache, name, key, result)
+        return result
+
+# ==============================================
+# ФОНОВЫЙ РАСЧЕТ ПЛАНА (ОЧЕРЕДЬ ЗАДАНИЙ)
+# ==============================================
+
+# Сколько планов считается одновременно (остальные ждут в очереди)
+PLAN_JOB_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+PLAN_JOB_POLL_SECONDS = 1.0
+# Дольше задание не считается: рабочий процесс останавливается, задание - с ошибкой
+PLAN_JOB_TIMEOUT_SECONDS = 2 * 60 * 60
+PLAN_JOB_TTL_SECONDS = 2 * 60 * 60  # завершенные задания хранятся 2 часа
+
+PLAN_JOB_STATUSES = {
+    'queued': 'в очереди',
+    'running': 'выполняется',
+    'done': 'готово',
+    'failed': 'ошибка'
+}
+
+def run_plan_stages(runner, stages, on_stage=None):
+    """
+    Выполняет этапы по порядку. Ошибка этапа не прерывает расчет:
+    этапы, зависящие от него, пропускаются, остальные выполняются.
+    Возвращает (результаты, ошибки) - словари по именам этапов.
+    """
+    results, errors = {}, {}
+    for name in stages:
+        failed_inputs = [input_name for input_name in PLAN_STAGES[name][0] if input_name in errors]
+        if failed_inputs:
+            errors[name] = f"не выполнен: ошибка на этапе {STAGE_NAMES[failed_inputs[0]]}"
+            continue
+        if on_stage is not None:
+            on_stage(name)
+        try:
+            results[name] = runner.run(name)
+        except Exception:
+            errors[name] = traceback.format_exc()
+    return results, errors
+
+def _plan_job_worker(runner, stages, conn, parallel_workers=PARALLEL_WORKERS):
+    """
+    Рабочий процесс: считает этапы и отправляет в канал прогресс, результаты
+    и сообщения диагностики (их показывает сеанс, забравший результат).
+    parallel_workers - размер пула процессов этого задания (ядра делятся между заданиями).
+    """
+    global PARALLEL_WORKERS
+    PARALLEL_WORKERS = parallel_workers
+    try:
+        channel = Diagnostics()
+        set_diagnostics(channel)
+        results, errors = run_plan_stages(runner, stages, on_stage=lambda name: conn.send(('stage', name)))
+        conn.send(('done', (results, errors, runner.hits, channel.messages)))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+class PlanJob:
+    """Задание расчета плана: статус, текущий этап, результаты"""
+
+    def __init__(self, job_id, stages, context):
+        self.id = job_id
+        self.stages = stages
+        self.context = context
+        self.status = 'queued'
+        self.stage = None
+        self.completed = 0
+        self.results = None
+        self.errors = {}
+        self.hits = []
+        self.messages = []
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    @property
+    def progress(self):
+        return self.completed / len(self.stages) if self.stages else 1.0
+
+class PlanJobRegistry:
+    """
+    Очередь заданий расчета плана, общая для всех сеансов сервера.
+    Каждое задание выполняется в отдельном рабочем процессе, одновременно - не больше max_workers.
+    Процесс запускается через spawn (не fork: у сервера Streamlit есть потоки, и копия
+    занятой ими блокировки подвесила бы процесс), входные таблицы и кэш этапов он получает
+    по каналу. Пул процессов задания - не больше своей доли ядер (parallel_workers).
+    Сеанс Streamlit только опрашивает статус, поэтому интерфейс не блокируется.
+    """
+
+    def __init__(self, max_workers=PLAN_JOB_WORKERS, timeout=PLAN_JOB_TIMEOUT_SECONDS):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='plan-job')
+        self.parallel_workers = max(1, PARALLEL_WORKERS // max_workers)
+        self.timeout = timeout
+
+    def submit(self, runner, context):
+        """Ставит расчет в очередь, возвращает ID задания"""
+        job = PlanJob(uuid.uuid4().hex[:12], list(PLAN_STAGES), context)
+        with self.lock:
+            self._evict()
+            self.jobs[job.id] = job
+        self.executor.submit(self._run, job, runner)
+        return job.id
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def queue_position(self, job_id):
+        """Сколько заданий в очереди перед этим (0 - следующее)"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status != 'queued':
+                return 0
+            return sum(1 for other in self.jobs.values()
+                       if other.status == 'queued' and other.created < job.created)
+
+    def _evict(self):
+        """Удаляет давно завершенные задания"""
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.finished is not None and now - job.finished > PLAN_JOB_TTL_SECONDS]:
+            del self.jobs[job_id]
+
+    def _on_stage(self, job, name):
+        job.stage = name
+        job.completed = job.stages.index(name)
+
+    def _run(self, job, runner):
+        job.status = 'running'
+        try:
+            self._run_in_process(job, runner)
+        except Exception:
+            job.error = traceback.format_exc()
+
+        job.completed = len(job.stages) if job.error is None else job.completed
+        job.status = 'failed' if job.error is not None else 'done'
+        job.finished = time.time()
+
+    def _run_in_process(self, job, runner):
+        context = multiprocessing.get_context('spawn')
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_plan_job_worker,
+                                  args=(runner, job.stages, sender, self.parallel_workers))
+        process.start()
+        sender.close()
+        deadline = time.time() + self.timeout
+
+        try:
+            while True:
+                # Ждем сообщение с таймаутом: процесс мог упасть или зависнуть
+                if not receiver.poll(PLAN_JOB_POLL_SECONDS):
+                    if not process.is_alive() and not receiver.poll(0):
+                        job.error = f"рабочий процесс завершился без результата (код {process.exitcode})"
+                        break
+                    if time.time() > deadline:
+                        job.error = f"расчет не завершился за {self.timeout // 60} мин"
+                        break
+                    continue
+                try:
+                    kind, payload = receiver.recv()
+                except EOFError:
+                    job.error = "рабочий процесс завершился без результата"
+                    break
+                if kind == 'stage':
+                    self._on_stage(job, payload)
+                elif kind == 'done':
+                    job.results, job.errors, job.hits, job.messages = payload
+                    break
+                else:
+                    job.error = payload
+                    break
+        finally:
+            receiver.close()
+            if job.error is not None and process.is_alive():
+                process.terminate()
+            process.join()
+
+# ==============================================
+# ФУНКЦИИ ДЛЯ ОБРАБОТКИ ФАКТИЧЕСКИХ ПОСЕЩЕНИЙ И СТАТИСТИКИ
+# ==============================================
+
+def process_actual_visits(visits_df, points_df, year, quarter):
+    """Обрабатывает фактические посещения за квартал"""
+    
+    if visits_df.empty:
+        return pd.DataFrame(columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника', 'ISO_Неделя'])
+    
+    # Получаем даты квартала
+    quarter_start, quarter_end = get_quarter_dates(year, quarter)
+    
+    # Преобразуем даты для сравнения
+    # ИСПРАВЛЕНИЕ: используем уже импортированный datetime
+    quarter_start_dt = pd.Timestamp(datetime.combine(quarter_start, datetime.min.time()))
+    quarter_end_dt = pd.Timestamp(datetime.combine(quarter_end, datetime.max.time()))
+    
+    # Фильтруем посещения по кварталу
+    visits_in_quarter = visits_df[
+        (visits_df['Дата_визита'] >= quarter_start_dt) &
+        (visits_df['Дата_визита'] <= quarter_end_dt)
+    ].copy()
+    
+    if visits_in_quarter.empty:
+        return pd.DataFrame(columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника', 'ISO_Неделя'])
+    
+    # Добавляем ISO неделю
+    visits_in_quarter['ISO_Неделя'] = visits_in_quarter['Дата_визита'].apply(get_iso_week)
+    
+    # Проверяем соответствие точек (только те, что есть в файле Точки)
+    valid_point_ids = set(points_df['ID_Точки'].unique())
+    invalid_visits = visits_in_quarter[~visits_in_quarter['ID_Точки'].isin(valid_point_ids)]
+    
+    if len(invalid_visits) > 0:
+        diag.warning(f"⚠️ Найдено {len(invalid_visits)} посещений несуществующих точек")
+    
+    # Оставляем только валидные посещения
+    visits_in_quarter = visits_in_quarter[visits_in_quarter['ID_Точки'].isin(valid_point_ids)]
+    
+    return visits_in_quarter.reset_index(drop=True)
+
+def calculate_statistics(points_df, visits_df, detailed_plan_df, year, quarter):
+    """Минимальная версия - только самое необходимое"""
+    
+    # 1. Статистика по городам
+    city_stats = []
+    for city in points_df['Город'].unique():
+        city_points = points_df[points_df['Город'] == city]
+        city_stats.append({
+            'Город': city,
+            'Всего_точек': len(city_points),
+            'План_посещений': city_points['Кол-во_посещений'].sum(),
+            'Факт_посещений': 0,
+            '%_выполнения': 0.0
+        })
+    
+    # 2. Статистика по типам
+    type_stats = []
+    for point_type in points_df['Тип'].unique():
+        type_points = points_df[points_df['Тип'] == point_type]
+        type_stats.append({
+            'Тип': point_type,
+            'План_посещений': type_points['Кол-во_посещений'].sum(),
+            'Факт_посещений': 0,
+            '%_выполнения': 0.0
+        })
+    
+    # 3. Сводный план = detailed_plan_df (уже распределен по неделям и аудиторам)
+    summary_df = detailed_plan_df.copy()
+    
+    # Добавляем недостающие колонки
+    if 'Факт_посещений' not in summary_df.columns:
+        summary_df['Факт_посещений'] = 0
+    
+    if '%_выполнения' not in summary_df.columns:
+        summary_df['%_выполнения'] = 0.0
+    
+    # 4. Детализация = та же detailed_plan_df
+    detailed_with_fact = detailed_plan_df.copy()
+    
+    # Проверка
+    total_expected = points_df['Кол-во_посещений'].sum()
+    total_in_summary = summary_df['План_посещений'].sum()
+    
+    if total_expected != total_in_summary:
+        diag.warning(f"⚠️ Расхождение: {total_expected} ≠ {total_in_summary}")
+    
+    return (
+        pd.DataFrame(city_stats),
+        pd.DataFrame(type_stats),
+        summary_df,
+        detailed_with_fact
+    )
+
+def create_google_maps_excel(points_df, polygons, points_assignment_df=None, store=None):
+    """Создает Excel файл для импорта в Google Maps с разбиением по городам/полигонам"""
+    
+    excel_buffer = io.BytesIO()
+    store = get_point_store(points_df, store)
+    
+    # Создаем словарь для сопоставления точек
+    point_to_polygon = {}
+    point_to_auditor = {}
+    
+    # 1. Используем points_assignment_df
+    if points_assignment_df is not None and not points_assignment_df.empty:
+        assigned_ids = points_assignment_df['ID_Точки'].astype(str).str.strip()
+        assigned = assigned_ids != ''
+        polygons_col = points_assignment_df.get('Полигон', pd.Series('Не назначен', index=points_assignment_df.index))
+        auditors_col = points_assignment_df.get('Аудитор', pd.Series('Неизвестно', index=points_assignment_df.index))
+        point_to_polygon = dict(zip(assigned_ids[assigned], polygons_col[assigned]))
+        point_to_auditor = dict(zip(assigned_ids[assigned], auditors_col[assigned]))
+    
+    # 2. Если нет assignment_df, используем полигоны
+    if not point_to_polygon and polygons:
+        for poly_name, poly_info in polygons.items():
+            if 'points' in poly_info and poly_info['points']:
+                for point_info in poly_info['points']:
+                    if point_info and len(point_info) >= 3:
+                        try:
+                            point_id = str(point_info[0]).strip() if point_info[0] is not None else ''
+                            if point_id:
+                                point_to_polygon[point_id] = poly_name
+                                point_to_auditor[point_id] = poly_info.get('auditor', 'Неизвестно')
+                        except (IndexError, AttributeError):
+                            continue
+    
+    # 3. Подготавливаем данные с группировкой (колонки собираются из массивов хранилища)
+    point_ids = pd.Series(
+        ['' if point_id is None else str(point_id).strip() for point_id in store.ids],
+        dtype=object
+    )
+    
+    cities = pd.Series(store.column('Город', 'Неизвестно')).fillna('Неизвестно').astype(str)
+    names = pd.Series(store.column('Название_Точки', None))
+    names = names.where(names.notna(), point_ids).astype(str)
+    types = pd.Series(store.column('Тип', 'Неизвестно')).fillna('Неизвестно').astype(str)
+    
+    export_df = pd.DataFrame({
+        'ID точки': point_ids,
+        'Имя точки': names,
+        'Тип точки': types,
+        'Город': cities,
+        'Полигон': point_ids.map(point_to_polygon).fillna('Не назначен').astype(str),
+        'Аудитор': point_ids.map(point_to_auditor).fillna('Неизвестно').astype(str),
+        'Широта': [f"{value:.6f}" for value in store.lat.tolist()],
+        'Долгота': [f"{value:.6f}" for value in store.lon.tolist()]
+    })
+    export_df = export_df[point_ids != '']
+    
+    # Группа = город точки (в порядке появления городов)
+    grouped_data = {
+        city: city_points.reset_index(drop=True)
+        for city, city_points in export_df.groupby('Город', sort=False)
+    }
+    
+    # 4. Проверяем общее количество строк
+    total_rows = sum(len(points) for points in grouped_data.values())
+    
+    # Храним информацию о вкладках для сводки
+    sheet_info = []
+    
+    # 5. Создаем Excel файл
+    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
+        sheet_counter = 0
+        
+        # Если строк меньше 2000 - создаем одну вкладку
+        if total_rows <= 2000:
+            # Объединяем все данные
+            if grouped_data:
+                df_all = pd.concat(grouped_data.values(), ignore_index=True)
+                column_order = ['ID точки', 'Имя точки', 'Тип точки', 'Город', 'Полигон', 'Аудитор', 'Широта', 'Долгота']
+                column_order = [col for col in column_order if col in df_all.columns]
+                df_all = df_all[column_order]
+                
+                sheet_name = 'Все точки'
+                df_all.to_excel(writer, sheet_name=sheet_name, index=False)
+                
+                sheet_info.append({
+                    'Вкладка': sheet_name,
+                    'Количество точек': len(df_all),
+                    'Город': 'Все',
+                    'Полигон': 'Все',
+                    'Аудиторов': df_all['Аудитор'].nunique()
+                })
+        
+        else:
+            # Разбиваем на вкладки
+            for city, city_points in grouped_data.items():
+                if len(city_points) <= 2000:
+                    # Весь город помещается на одну вкладку
+                    df_city = city_points
+                    column_order = ['ID точки', 'Имя точки', 'Тип точки', 'Город', 'Полигон', 'Аудитор', 'Широта', 'Долгота']
+                    column_order = [col for col in column_order if col in df_city.columns]
+                    df_city = df_city[column_order]
+                    
+                    # Формируем имя вкладки
+                    sheet_name = city[:31]  # Ограничение Excel
+                    
+                    # Заменяем запрещенные символы
+                    invalid_chars = ['/', '\\', '?', '*', ':', '[', ']']
+                    for char in invalid_chars:
+                        sheet_name = sheet_name.replace(char, '_')
+                    
+                    # Проверяем уникальность имени
+                    original_name = sheet_name
+                    counter = 1
+                    while sheet_name in writer.sheets:
+                        sheet_name = f"{original_name[:28]}_{counter}"
+                        counter += 1
+                    
+                    df_city.to_excel(writer, sheet_name=sheet_name, index=False)
+                    
+                    sheet_info.append({
+                        'Вкладка': sheet_name,
+                        'Количество точек': len(df_city),
+                        'Город': city,
+                        'Полигон': 'Весь город',
+                        'Аудиторов': df_city['Аудитор'].nunique()
+                    })
+                    
+                    sheet_counter += 1
+                else:
+                    # Город нужно разбить по полигонам
+                    city_points_df = city_points
+                    
+                    # Группируем по полигонам внутри города
+                    for polygon in sorted(city_points_df['Полигон'].unique()):
+                        polygon_points = city_points_df[city_points_df['Полигон'] == polygon].copy()
+                        
+                        if len(polygon_points) > 0:
+                            # Готовим данные для полигона
+                            column_order = ['ID точки', 'Имя точки', 'Тип точки', 'Город', 'Полигон', 'Аудитор', 'Широта', 'Долгота']
+                            column_order = [col for col in column_order if col in polygon_points.columns]
+                            polygon_points = polygon_points[column_order]
+                            
+                            # Формируем имя вкладки
+                            if polygon != 'Не назначен':
+                                sheet_name = f"{city[:15]}_{polygon[:15]}"
+                            else:
+                                sheet_name = f"{city[:20]}_Без полигона"
+                            
+                            # Очищаем имя вкладки
+                            sheet_name = sheet_name[:31]
+                            invalid_chars = ['/', '\\', '?', '*', ':', '[', ']']
+                            for char in invalid_chars:
+                                sheet_name = sheet_name.replace(char, '_')
+                            
+                            # Проверяем уникальность
+                            original_name = sheet_name
+                            counter = 1
+                            while sheet_name in writer.sheets:
+                                sheet_name = f"{original_name[:28]}_{counter}"
+                                counter += 1
+                            
+                            polygon_points.to_excel(writer, sheet_name=sheet_name, index=False)
+                            
+                            sheet_info.append({
+                                'Вкладка': sheet_name,
+                                'Количество точек': len(polygon_points),
+                                'Город': city,
+                                'Полигон': polygon,
+                                'Аудиторов': polygon_points['Аудитор'].nunique()
+                            })
+                            
+                            sheet_counter += 1
+        
+        # 6. Добавляем сводную вкладку
+        if sheet_info:
+            df_summary = pd.DataFrame(sheet_info)
+            df_summary = df_summary.sort_values('Количество точек', ascending=False)
+            df_summary.to_excel(writer, sheet_name='Сводка', index=False)
+        
+        # 7. Добавляем итоговую статистику
+        total_summary = pd.DataFrame([{
+            'Всего точек': total_rows,
+            'Количество вкладок': len(sheet_info),
+            'Количество городов': len(grouped_data),
+            'Дата выгрузки': datetime.now().strftime('%d.%m.%Y %H:%M'),
+            'Статус': '✅ Успешно создано' if total_rows > 0 else '⚠️ Нет данных'
+        }])
+        total_summary.to_excel(writer, sheet_name='Итог', index=False)
+    
+    return excel_buffer.getvalue()
+
+def create_kml_file(points_df, polygons, store=None):
+    """Создает KML файл для Google Earth"""
+    store = get_point_store(points_df, store)
+    kml_header = '''<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+<Document>
+<name>Полигоны и точки аудиторов</name>
+'''
+    
+    kml_content = kml_header
+    
+    # Добавляем полигоны
+    for poly_name, poly_info in polygons.items():
+        if 'coordinates' in poly_info and len(poly_info['coordinates']) > 0:
+            coords = poly_info['coordinates']
+            coord_string = " ".join([f"{lon},{lat},0" for lat, lon in coords if len([lat, lon]) >= 2])
+            
+            if coord_string:
+                kml_content += f'''
+<Placemark>
+<name>🗺️ {poly_name}</name>
+<description>Аудитор: {poly_info.get('auditor', 'Неизвестно')}
+Город: {poly_info.get('city', 'Неизвестно')}
+Количество точек: {len(poly_info.get('points', []))}</description>
+<styleUrl>#polygonStyle</styleUrl>
+<Polygon>
+<outerBoundaryIs>
+<LinearRing>
+<coordinates>{coord_string}</coordinates>
+</LinearRing>
+</outerBoundaryIs>
+</Polygon>
+</Placemark>
+'''
+    
+    # Добавляем точки (одним проходом по массивам хранилища)
+    point_placemarks = [
+        f'''
+<Placemark>
+<name>🏪 {str(name)[:30]}</name>
+<description>ID: {point_id}
+Тип: {point_type}
+Адрес: {address}</description>
+<Point>
+<coordinates>{lon},{lat},0</coordinates>
+</Point>
+</Placemark>
+'''
+        for name, point_id, point_type, address, lat, lon in zip(
+            store.column('Название_Точки'),
+            store.ids,
+            store.column('Тип', 'Неизвестно'),
+            store.column('Адрес', 'Не указан'),
+            store.lat.tolist(),
+            store.lon.tolist()
+        )
+    ]
+    kml_content += ''.join(point_placemarks)
+    
+    kml_content += '''
+<Style id="polygonStyle">
+<LineStyle>
+<color>ff0000ff</color>
+<width>2</width>
+</LineStyle>
+<PolyStyle>
+<color>400000ff</color>
+<fill>1</fill>
+<outline>1</outline>
+</PolyStyle>
+</Style>
+</Document>
+</kml>
+'''
+    
+    return kml_content
+
+def create_full_excel_report(points_df, auditors_df, city_stats_df, 
+                            type_stats_df, summary_df, polygons, workload_df=None):
+    """
+    Создает полный отчет Excel со всеми данными
+    workload_df - нагрузка и загрузка аудиторов (см. calculate_auditor_workload)
+    """
+    import io
+    
+    excel_buffer = io.BytesIO()
+    
+    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
+        # Лист 1: Точки
+        if points_df is not None:
+            points_df.to_excel(writer, sheet_name='Точки', index=False)
+        
+        # Лист 2: Аудиторы
+        if auditors_df is not None:
+            auditors_df.to_excel(writer, sheet_name='Аудиторы', index=False)
+        
+        # Лист 3: Статистика по городам
+        if city_stats_df is not None:
+            city_stats_df.to_excel(writer, sheet_name='Статистика_городов', index=False)
+        
+        # Лист 4: План посещений
+        if summary_df is not None:
+            summary_df.to_excel(writer, sheet_name='План_посещений', index=False)
+        
+        # Лист 5: Полигоны
+        if polygons:
+            poly_data = []
+            for poly_name, poly_info in polygons.items():
+                poly_data.append({
+                    'Полигон': poly_name,
+                    'Аудитор': poly_info.get('auditor', 'Неизвестно'),
+                    'Город': poly_info.get('city', 'Неизвестно'),
+                    'Количество_точек': len(poly_info.get('points', [])),
+                    'Нагрузка_ч': poly_info.get('workload_hours'),
+                    'Координаты_полигона': str(poly_info.get('coordinates', []))
+                })
+            
+            pd.DataFrame(poly_data).to_excel(writer, sheet_name='Полигоны', index=False)
+        
+        # Лист 6: Нагрузка аудиторов
+        if workload_df is not None and not workload_df.empty:
+            workload_df.to_excel(writer, sheet_name='Нагрузка_аудиторов', index=False)
+    
+    return excel_buffer.getvalue()
+
+def calculate_polygon_center(poly_info):
+    """Вычисляет центроид полигона"""
+    try:
+        # Из координат полигона
+        if 'coordinates' in poly_info and poly_info['coordinates']:
+            coords = poly_info['coordinates']
+            lats = [c[0] for c in coords if len(c) >= 2]
+            lons = [c[1] for c in coords if len(c) >= 2]
+            
+            if lats and lons:
+                return sum(lats) / len(lats), sum(lons) / len(lons)
+        
+        # Из точек полигона
+        if 'points' in poly_info and poly_info['points']:
+            points = poly_info['points']
+            lats = []
+            lons = []
+            
+            for point in points:
+                if len(point) >= 3:
+                    lats.append(point[1])  # широта
+                    lons.append(point[2])  # долгота
+            
+            if lats and lons:
+                return sum(lats) / len(lats), sum(lons) / len(lons)
+    except:
+        pass
+    
+    return None, None
+
+# ==============================================
+# РАСЧЕТ ПЛАНА БЕЗ ИНТЕРФЕЙСА
+# ==============================================
+
+def stage_results_to_plan(results):
+    """Результаты этапов PLAN_STAGES -> таблицы плана (ключи как в session state интерфейса)"""
+    plan_tables = {}
+    if 'distribute' in results:
+        plan_tables['points_assignment_df'], plan_tables['polygons_info'] = results['distribute']
+    if 'polygons' in results:
+        plan_tables['polygons'] = results['polygons']
+    if 'weekly_clusters' in results:
+        plan_tables['weekly_clusters_df'] = results['weekly_clusters']
+    if 'weekly_plan' in results:
+        plan_tables['detailed_plan_df'] = results['weekly_plan']
+    if 'routes' in results:
+        plan_tables['routes_df'] = results['routes']
+    if 'statistics' in results:
+        (plan_tables['city_stats_df'], plan_tables['type_stats_df'],
+         plan_tables['summary_df'], plan_tables['details_df']) = results['statistics']
+    return plan_tables
+
+def plan(points, auditors, visits, year, quarter, coefficients, stage_cache=None, improve_routes=False,
+         service_minutes=None):
+    """
+    Расчет плана: распределение точек, полигоны, недельные кластеры, маршруты, статистика.
+    points / auditors / visits - нормализованные таблицы (см. load_input_frames), visits может быть None.
+    stage_cache - словарь мемоизации этапов между вызовами (см. StageRunner).
+    improve_routes - улучшать маршруты дней ходами 2-opt / Or-opt.
+    service_minutes - время визита по типам точек (минуты), по нагрузке выравниваются полигоны.
+    Возвращает словарь таблиц плана (ключи как в session state интерфейса), а также
+    'store' - PointStore точек, 'errors' - ошибки этапов, 'diagnostics' - сообщения [(уровень, текст)].
+    """
+    if visits is None:
+        visits = pd.DataFrame(columns=['ID_Точки', 'Дата_визита', 'ID_Сотрудника'])
+
+    store = PointStore(points)
+    runner = StageRunner(
+        {
+            'points': points, 'auditors': auditors, 'visits': visits,
+            'year': year, 'quarter': quarter, 'coefficients': list(coefficients),
+            'improve_routes': bool(improve_routes),
+            'service_minutes': get_service_minutes(service_minutes)
+        },
+        {} if stage_cache is None else stage_cache,
+        store=store
+    )
+
+    with collect_diagnostics() as channel:
+        results, errors = run_plan_stages(runner, list(PLAN_STAGES))
+
+    plan_tables = stage_results_to_plan(results)
+    plan_tables.update({'store': store, 'errors': errors, 'diagnostics': channel.messages})
+    return plan_tables
@@ -0,0 +1,84 @@
+"""Дельта-загрузка: аудитор, работающий в нескольких городах"""
+import numpy as np
+import pandas as pd
+
+import plan_engine as pe
+
+YEAR, QUARTER, COEFFICIENTS = 2025, 1, [1.0, 1.0, 1.0, 1.0]
+
+def make_points():
+    rng = np.random.default_rng(7)
+    frames = []
+    for city, (lat, lon) in {'Пермь': (58.0, 56.2), 'Казань': (55.8, 49.1)}.items():
+        n = 60
+        frames.append(pd.DataFrame({
+            'ID_Точки': [f"{city[:2]}{i}" for i in range(n)],
+            'Название_Точки': [f"Магазин {i}" for i in range(n)],
+            'Адрес': [f"ул. {i}" for i in range(n)],
+            'Широта': lat + rng.random(n) * 0.1,
+            'Долгота': lon + rng.random(n) * 0.1,
+            'Город': city,
+            'Тип': 'Мини'
+        }))
+    points_df, _ = pe.load_and_process_points(pd.concat(frames, ignore_index=True))
+    return points_df
+
+def make_auditors(rows):
+    auditors_df, _ = pe.load_and_process_auditors(pd.DataFrame(rows))
+    return auditors_df
+
+BASE_AUDITORS = [
+    {'ID_Сотрудника': 'X', 'Город': 'Пермь'},
+    {'ID_Сотрудника': 'X', 'Город': 'Казань'},
+    {'ID_Сотрудника': 'Y', 'Город': 'Пермь'},
+]
+
+def auditor_keys(auditors_df):
+    return sorted(zip(auditors_df['ID_Сотрудника'].astype(str), auditors_df['Город'].astype(str)))
+
+def test_upsert_changes_only_its_city_row():
+    points_df, auditors_df = make_points(), make_auditors(BASE_AUDITORS)
+    delta = {'auditors': make_auditors([{'ID_Сотрудника': 'X', 'Город': 'Казань', 'Часов_в_неделю': 20}])}
+
+    _, new_auditors, cities, summary = pe.apply_input_delta(points_df, auditors_df, delta)
+
+    assert auditor_keys(new_auditors) == auditor_keys(auditors_df)
+    assert cities == {'Казань'}
+    assert summary['Аудиторов изменено'] == 1
+    assert summary['Аудиторов удалено'] == 0
+    hours = new_auditors.set_index(['ID_Сотрудника', 'Город'])['Часов_в_неделю']
+    assert hours[('X', 'Казань')] == 20
+
+def test_removal_with_and_without_city():
+    points_df, auditors_df = make_points(), make_auditors(BASE_AUDITORS)
+
+    delta = {'removed_auditors': pe._removed_keys(
+        pd.DataFrame({'ID_Сотрудника': ['X'], 'Город': ['Казань']}), pe.AUDITORS_COLUMNS, pe.AUDITORS_DELTA_KEY)}
+    _, new_auditors, cities, summary = pe.apply_input_delta(points_df, auditors_df, delta)
+    assert auditor_keys(new_auditors) == [('X', 'Пермь'), ('Y', 'Пермь')]
+    assert cities == {'Казань'} and summary['Аудиторов удалено'] == 1
+
+    delta = {'removed_auditors': pe._removed_keys(
+        pd.DataFrame({'ID_Сотрудника': ['X']}), pe.AUDITORS_COLUMNS, pe.AUDITORS_DELTA_KEY)}
+    _, new_auditors, cities, summary = pe.apply_input_delta(points_df, auditors_df, delta)
+    assert auditor_keys(new_auditors) == [('Y', 'Пермь')]
+    assert cities == {'Казань', 'Пермь'} and summary['Аудиторов удалено'] == 2
+
+def test_replan_keeps_other_city_clusters_once():
+    points_df, auditors_df = make_points(), make_auditors(BASE_AUDITORS)
+    assignment_df, polygons_info = pe.distribute_points_to_auditors(points_df, auditors_df)
+    weekly_clusters_df = pe.create_weekly_geographic_clusters(assignment_df, points_df, YEAR, QUARTER, COEFFICIENTS)
+    baseline = {
+        'points_assignment_df': assignment_df,
+        'polygons_info': polygons_info,
+        'polygons': pe.generate_polygons(polygons_info),
+        'weekly_clusters_df': weekly_clusters_df,
+        'detailed_plan_df': pe.convert_clusters_to_weekly_plan(weekly_clusters_df, points_df),
+        'routes_df': pe.create_geographic_daily_routes(points_df, weekly_clusters_df),
+    }
+
+    plan = pe.replan_affected_cities(baseline, points_df, auditors_df, {'Казань'}, YEAR, QUARTER, COEFFICIENTS)
+
+    clusters = plan['weekly_clusters_df']
+    assert len(clusters) == len(weekly_clusters_df)
+    assert not clusters.duplicated(['ID_Точки', 'Неделя']).any()
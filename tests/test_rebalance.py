@@ -0,0 +1,23 @@
+"""Стабильное перераспределение: новый аудитор должен набрать свою долю нагрузки"""
+import numpy as np
+
+import plan_engine as pe
+
+def test_joining_auditor_with_remote_seed_reaches_tolerance():
+    rng = np.random.default_rng(3)
+    n = 600
+    x, y = rng.normal(0, 5, n), rng.normal(0, 5, n)
+    # Три точки на отшибе: первая точка нового аудитора берется оттуда,
+    # а в ближайших соседях остальных точек их нет
+    x[:3], y[:3] = 40 + rng.random(3), 40 + rng.random(3)
+    owners = np.digitize(x, np.quantile(x, [1 / 3, 2 / 3]))
+    weights = rng.integers(1, 4, n).astype(float)
+
+    new_owners, _ = pe.rebalance_city_territories(
+        x, y, weights, owners, np.ones(4), ['Пе1', 'Пе2', 'Пе3', 'NEW']
+    )
+
+    relative = np.bincount(new_owners, weights=weights, minlength=4) / (weights.sum() / 4)
+    assert relative.max() <= 1 + pe.REBALANCE_TOLERANCE
+    assert relative.min() >= 1 - pe.REBALANCE_TOLERANCE
+    assert (new_owners == 3).sum() > 3